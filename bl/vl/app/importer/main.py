@@ -31,35 +31,48 @@ import bl.vl.utils.ome_utils as vlu
 from bl.vl.utils import LOG_LEVELS, get_logger
 
 
-SUBMOD_NAMES = [
-  "study",
-  "individual",
-  "biosample",
-  "samples_container",
-  "device",
-  "data_sample",
-  "data_object",
-  "group",
-  "data_collection",
-  "vessels_collection",
-  "marker_alignment",
-  "markers_set",
-  "diagnosis",
-  "enrollment",
-  "birth_data",
-  "laneslot",
-  "sequencing_data_sample",
-  "agnostic",
-  "illumina_bead_chip_measures"
+# (sub-command, module): the module that implements a sub-command is
+# only imported when the sub-command is selected; when none is, e.g.,
+# for --help, all of them are imported, since each module supplies
+# the help of its sub-command.
+SUBCOMMANDS = [
+  ("study", "study"),
+  ("individual", "individual"),
+  ("biosample", "biosample"),
+  ("samples_container", "samples_container"),
+  ("device", "device"),
+  ("data_sample", "data_sample"),
+  ("data_object", "data_object"),
+  ("group", "group"),
+  ("data_collection", "data_collection"),
+  ("vessels_collection", "vessels_collection"),
+  ("marker_alignment", "marker_alignment"),
+  ("markers_set", "markers_set"),
+  ("diagnosis", "diagnosis"),
+  ("enrollment", "enrollment"),
+  ("birth_data", "birth_data"),
+  ("laneslot", "laneslot"),
+  ("seq_data_sample", "sequencing_data_sample"),
+  ("agnostic", "agnostic"),
+  ("illumina_bead_chip_measures", "illumina_bead_chip_measures"),
   ]
-SUBMODULES = [import_module("%s.%s" % (__package__, n)) for n in SUBMOD_NAMES]
 
 
 class App(object):
 
   def __init__(self):
     self.supported_submodules = []
-    for m in SUBMODULES:
+
+  def load_submodules(self, argv=None):
+    """
+    Import the modules of the sub-commands found in argv (sys.argv by
+    default), or of all sub-commands if none is found, and register
+    them.
+    """
+    args = set(sys.argv[1:] if argv is None else argv)
+    selected = [(k, m) for k, m in SUBCOMMANDS if k in args] or SUBCOMMANDS
+    for _, mod_name in selected:
+      m = import_module("%s.%s" % (__package__, mod_name))
       m.do_register(self.supported_submodules)
 
   def make_parser(self):
@@ -88,10 +101,15 @@ class App(object):
     parser.add_argument('-K', '--keep-tokens', type=int,
                         default=1, help='OMERO tokens for open session')
     subparsers = parser.add_subparsers()
-    for k, h, addp, impl in self.supported_submodules:
-      subparser = subparsers.add_parser(k, help=h)
-      addp(subparser)
-      subparser.set_defaults(func=impl)
+    registered = dict((r[0], r) for r in self.supported_submodules)
+    for k, _ in SUBCOMMANDS:
+      if k in registered:
+        _, h, addp, impl = registered[k]
+        subparser = subparsers.add_parser(k, help=h)
+        addp(subparser)
+        subparser.set_defaults(func=impl)
+      else:
+        subparsers.add_parser(k)
     self.parser = parser
     return parser
 
@@ -104,6 +122,7 @@ def close_handles(args):
 
 def main(argv=None):
   app = App()
+  app.load_submodules(argv)
   parser = app.make_parser()
   args = parser.parse_args(argv)
   logger = get_logger("main", level=args.loglevel, filename=args.logfile)
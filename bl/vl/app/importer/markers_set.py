@@ -53,6 +53,8 @@ info must be listed in the tab-separated input file.  For instance::
 """
 import os, time, csv, json, copy
 
+from bl.vl.kb.drivers.omero.genomics import MAX_GDO_BLOCKS
+
 import core
 from version import version
 
@@ -61,11 +63,14 @@ class Recorder(core.Core):
   
   def __init__(self, study_label, host=None, user=None, passwd=None,
                keep_tokens=1, operator='Alfred E. Neumann',
-               action_setup_conf=None, logger=None):
+               action_setup_conf=None, logger=None, gdo_block_size=None,
+               compact_gdos=False):
     super(Recorder, self).__init__(host, user, passwd, keep_tokens=keep_tokens,
                                    study_label=study_label, logger=logger)
     self.action_setup_conf = action_setup_conf
     self.operator = operator
+    self.gdo_block_size = gdo_block_size
+    self.compact_gdos = compact_gdos
 
   def record(self, records, otsv, rtsv):
     if len(records) == 0:
@@ -92,8 +97,10 @@ class Recorder(core.Core):
           r['op_vid'] = action.id
         #yield r['label'], r['mask'], r['index'], r['permutation']
         yield r
-    mset = self.kb.genomics.create_markers_array(label, maker, model, release,
-                                                 stream(), action)
+    mset = self.kb.genomics.create_markers_array(
+      label, maker, model, release, stream(), action,
+      gdo_block_size=self.gdo_block_size, compact_gdos=self.compact_gdos
+      )
     otsv.writerow({
       'study': study.label,
       'label': mset.label,
@@ -188,6 +195,15 @@ def make_parser(parser):
                       help="markers_set model")
   parser.add_argument('--release', metavar="STRING", required=True,
                       help="markers_set release")
+  parser.add_argument('--gdo-block-size', metavar="INT", type=int,
+                      help="store genotype data in blocks of this many "
+                      "markers, so that reading a few of them is faster. "
+                      "Each block takes two table columns, and HDF5 limits "
+                      "their number: markers can be split in at most %d "
+                      "blocks" % MAX_GDO_BLOCKS)
+  parser.add_argument('--compact-gdos', action='store_true',
+                      help="store genotype data with a lossy 8-bit encoding, "
+                      "which takes a third of the space")
 
 
 def implementation(logger, host, user, passwd, args, close_handles):
@@ -195,7 +211,9 @@ def implementation(logger, host, user, passwd, args, close_handles):
   recorder = Recorder(args.study,
                       host=host, user=user, passwd=passwd,
                       operator=args.operator,
-                      action_setup_conf=action_setup_conf, logger=logger)
+                      action_setup_conf=action_setup_conf, logger=logger,
+                      gdo_block_size=args.gdo_block_size,
+                      compact_gdos=args.compact_gdos)
   for m in recorder.kb.get_objects(recorder.kb.SNPMarkersSet):
     if m.label == args.ms_label:
       logger.error(
@@ -23,11 +23,16 @@ from bl.vl.app.importer.core import Core
 from bl.vl.genotype.algo import project_to_discrete_genotype
 
 
+# number of individuals whose data samples are fetched together
+FETCH_CHUNK_SIZE = 100
+
+
 class Writer(object):
 
-    def __init__(self, genotypes_out_file, samples_list_out_file,
+    def __init__(self, kb, genotypes_out_file, samples_list_out_file,
                  transpose_output=False, ignore_duplicated=False,
                  logger = None):
+        self.kb = kb
         self.out_gt_file = genotypes_out_file
         self.out_ds_file = samples_list_out_file
         self.out_gt_csvw = csv.writer(self.out_gt_file, delimiter='\t')
@@ -40,34 +45,46 @@ class Writer(object):
 
     def write_record(self, individual, data_samples,
                      data_collection_samples=None):
+        self.write_records([(individual, data_samples)],
+                           data_collection_samples)
+
+    def write_records(self, records, data_collection_samples=None):
+        """
+        Write the data samples of a list of (individual, data_samples)
+        records; genotypes for all of them are fetched at once.
+        """
         allele_patterns = {0: 'AA', 1: 'BB', 2:'AB', 3: 'NN'}
-        if data_collection_samples:
-            dsamples = [d for d in data_samples if d in data_collection_samples]
-        else:
-            dsamples = data_samples
-        if len(dsamples) > 0:
+        all_dsamples = []
+        for individual, data_samples in records:
+            if data_collection_samples:
+                dsamples = [d for d in data_samples
+                            if d in data_collection_samples]
+            else:
+                dsamples = data_samples
             if self.igd:
                 dsamples = dsamples[:1]
-            for ds in dsamples:
-                start = time.time()
-                probs, _ = ds.resolve_to_data()
-                end = time.time() - start
-                self.counter['total_fetch_time'] += end
-                if end < self.counter['faster_fetch'] or 'faster_fetch' not in self.counter:
-                    self.counter['faster_fetch'] = end
-                if end > self.counter['slower_fetch']:
-                    self.counter['slower_fetch'] = end
-                self.logger.debug('Retrieved data for %s in %f seconds' %
-                                  (ds.label, end))
-                if probs is not None:
-                    self.counter['fetched_samples'] += 1
-                    self.out_ds_csvw.writerow([ds.id])
-                    disc_probs = [allele_patterns[x]
-                                  for x in project_to_discrete_genotype(probs)]
-                    if self.tro:
-                        self.out_gt_csvw.writerow(disc_probs)
-                    else:
-                        self.out_data.append(disc_probs)
+            all_dsamples.extend(dsamples)
+        if not all_dsamples:
+            return
+        start = time.time()
+        all_probs, _ = self.kb.genomics.resolve_to_data(all_dsamples)
+        end = (time.time() - start) / len(all_dsamples)
+        self.counter['total_fetch_time'] += end * len(all_dsamples)
+        if end < self.counter['faster_fetch'] or 'faster_fetch' not in self.counter:
+            self.counter['faster_fetch'] = end
+        if end > self.counter['slower_fetch']:
+            self.counter['slower_fetch'] = end
+        self.logger.debug('Retrieved data for %d samples in %f seconds' %
+                          (len(all_dsamples), end * len(all_dsamples)))
+        for ds, probs in zip(all_dsamples, all_probs):
+            self.counter['fetched_samples'] += 1
+            self.out_ds_csvw.writerow([ds.id])
+            disc_probs = [allele_patterns[x]
+                          for x in project_to_discrete_genotype(probs)]
+            if self.tro:
+                self.out_gt_csvw.writerow(disc_probs)
+            else:
+                self.out_data.append(disc_probs)
 
     def close(self):
         if len(self.out_data) > 0:
@@ -129,6 +146,7 @@ class App(Core):
                 'w', compression_level
                 )
         kw_args = {
+            'kb': self.kb,
             'transpose_output': transpose_output,
             'ignore_duplicated': ignore_duplicated,
             'genotypes_out_file': genotypes_out_file,
@@ -137,14 +155,14 @@ class App(Core):
             }
         writer = Writer(**kw_args)
         self.logger.info('Writing records')
-        for ind, dsamples in data_samples_map.iteritems():
+        records = data_samples_map.items()
+        for i in xrange(0, len(records), FETCH_CHUNK_SIZE):
+            chunk = records[i:i+FETCH_CHUNK_SIZE]
             self.logger.debug(
-                'Writing record for individual %s (%d/%d)' % (
-                    ind.id,
-                    data_samples_map.keys().index(ind) + 1, 
-                    len(inds)
+                'Writing records for individuals %d-%d/%d' % (
+                    i + 1, i + len(chunk), len(inds)
                     ))
-            writer.write_record(ind, dsamples, dc_samples)
+            writer.write_records(chunk, dc_samples)
         self.logger.info('Closing writer')
         writer.close()
         self.kb.disconnect()
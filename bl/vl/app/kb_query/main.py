@@ -13,30 +13,43 @@ import bl.vl.utils.ome_utils as vlu
 from bl.vl.utils import LOG_LEVELS, get_logger
 
 
-SUBMOD_NAMES = [
-  "map_vid",
-  "global_stats",
-  "selector",
-  "query",
-  "extract_genotypes",
-  "build_gstudio_datasheet",
-  "plates_data_samples",
-  "vessels_by_individual",
-  "map_to_collection",
-  "flowcell_samplesheet",
-  "seq_run_results",
-  # "tabular",
-  "markers",
-  # "ehr",
+# (sub-command, module): the module that implements a sub-command is
+# only imported when the sub-command is selected; when none is, e.g.,
+# for --help, all of them are imported, since each module supplies
+# the help of its sub-command.
+SUBCOMMANDS = [
+  ("map_vid", "map_vid"),
+  ("global_stats", "global_stats"),
+  ("selector", "selector"),
+  ("query", "query"),
+  ("extract_gt", "extract_genotypes"),
+  ("gstudio_datasheet", "build_gstudio_datasheet"),
+  ("plate_data_samples", "plates_data_samples"),
+  ("vessels_by_individual", "vessels_by_individual"),
+  ("map_to_collection", "map_to_collection"),
+  ("flowcell_samplesheet", "flowcell_samplesheet"),
+  ("seq_results_report", "seq_run_results"),
+  # ("tabular", "tabular"),
+  ("markers", "markers"),
+  # ("ehr", "ehr"),
   ]
-SUBMODULES = [import_module("%s.%s" % (__package__, n)) for n in SUBMOD_NAMES]
 
 
 class App(object):
   
   def __init__(self):
     self.supported_submodules = []
-    for m in SUBMODULES:
+
+  def load_submodules(self, argv=None):
+    """
+    Import the modules of the sub-commands found in argv (sys.argv by
+    default), or of all sub-commands if none is found, and register
+    them.
+    """
+    args = set(sys.argv[1:] if argv is None else argv)
+    selected = [(k, m) for k, m in SUBCOMMANDS if k in args] or SUBCOMMANDS
+    for _, mod_name in selected:
+      m = import_module("%s.%s" % (__package__, mod_name))
       m.do_register(self.supported_submodules)
 
   def make_parser(self):
@@ -59,15 +72,21 @@ class App(object):
     parser.add_argument('-K', '--keep-tokens', type=int,
                         default=1, help='OMERO tokens for open session')
     subparsers = parser.add_subparsers()
-    for k, h, addp, impl in self.supported_submodules:
-      subparser = subparsers.add_parser(k, help=h)
-      addp(subparser)
-      subparser.set_defaults(func=impl)
+    registered = dict((r[0], r) for r in self.supported_submodules)
+    for k, _ in SUBCOMMANDS:
+      if k in registered:
+        _, h, addp, impl = registered[k]
+        subparser = subparsers.add_parser(k, help=h)
+        addp(subparser)
+        subparser.set_defaults(func=impl)
+      else:
+        subparsers.add_parser(k)
     self.parser = parser
     return parser
 
 def main(argv=None):
   app = App()
+  app.load_submodules(argv)
   parser = app.make_parser()
   args = parser.parse_args(argv)
   logger = get_logger("main", level=args.loglevel, filename=args.logfile)
@@ -14,6 +14,7 @@ import itertools as it
 
 from bl.vl.app.importer.core import Core
 from bl.vl.kb.drivers.omero.utils import make_unique_key
+from bl.vl.kb.drivers.omero.proxy import QUERY_BATCH_SIZE
 
 
 class MappingError(Exception):
@@ -53,22 +54,19 @@ class MapVIDApp(Core):
     labels = check_labels(labels)
     if len(labels) == 0:
       return mapping
-    known_studies = dict()
-    for lab in labels:
-      known_studies.setdefault(lab.split(':')[0], []).append(lab.split(':')[1])
-    known_enrollments = []
-    for kst, labs in known_studies.iteritems():
-      st = self.kb.get_study(kst)
-      for l in labs:
-        e = self.kb.get_enrollment(st, l)
-        if e:
-          known_enrollments.append(e)
-      self.logger.debug('Loaded enrollments for study %s' % kst)
-    for e in known_enrollments:
-      enroll_label = '%s:%s' % (e.study.label, e.studyCode)
-      if enroll_label in labels:
-        i = e.individual
-        mapping[enroll_label] = i.id
+    known_studies = set(lab.split(':')[0] for lab in labels)
+    wanted = set(labels)
+    query = """select s.label, e.studyCode, i.vid
+    from Enrollment e join e.study s join e.individual i
+    where s.label in (:slabels)
+    """
+    enrolled = self.kb.projection(query, {'slabels': list(known_studies)},
+                                  ['study', 'code', 'vid'])
+    self.logger.debug('Loaded %d enrollments' % len(enrolled))
+    for st, code, vid in enrolled:
+      enroll_label = '%s:%s' % (st, code)
+      if enroll_label in wanted:
+        mapping[enroll_label] = vid
     diff = set(labels).difference(mapping)
     if len(diff) > 0:
       for x in diff:
@@ -125,10 +123,13 @@ class MapVIDApp(Core):
     mapping = {}
     self.logger.info('start selecting %s' % source_type.get_ome_table())
     self.logger.debug('\tlabels: %s' % labels)
-    for l in labels:
-      obj = self.kb.get_by_label(source_type, l)
-      if obj:
-        mapping[obj.label] = obj.id
+    query = 'select o.label, o.vid from %s o where o.label in (:labels)' % \
+            source_type.get_ome_table()
+    labels = list(set(labels))
+    for i in xrange(0, len(labels), QUERY_BATCH_SIZE):
+      res = self.kb.projection(query, {'labels': labels[i:i+QUERY_BATCH_SIZE]},
+                               ['label', 'vid'])
+      mapping.update(it.izip(res['label'], res['vid']))
     self.logger.info('done selecting %s' % source_type.get_ome_table())
     self.logger.debug('mapping: %s' % mapping)
     return mapping
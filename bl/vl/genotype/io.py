@@ -18,6 +18,10 @@ from bl.core.io import MessageStreamReader
 from bl.vl.genotype.algo import project_to_discrete_genotype
 
 
+# Number of data samples resolved to data at a time by VCFWriter.
+RESOLVE_CHUNK_SIZE = 100
+
+
 class Error(Exception):
   pass
 
@@ -195,17 +199,22 @@ class VCFWriter(object):
       self.marker_selector = np.arange(probs.shape[1], dtype=np.uint32)
 
   def __load_data(self, data_samples):
+    if not data_samples:
+      M = 0 if self.marker_selector is None else len(self.marker_selector)
+      return [], np.zeros((0, M), dtype=np.uint8)
     self.__initialize_marker_selector(data_samples[0])
     N = len(data_samples)
     M = len(self.marker_selector)
     data = np.zeros((N, M), dtype=np.uint8)
-    labels = []
-    for i, d in enumerate(data_samples):
-      labels.append(d.label)
-      # FIXME: it would be better if we could directly tell resolve_to_data
-      # to fetch only as selected by marker_selector
-      probs, _ = d.resolve_to_data()
-      data[i, :] = project_to_discrete_genotype(probs[:, self.marker_selector])
+    labels = [d.label for d in data_samples]
+    genomics = data_samples[0].proxy.genomics
+    # resolved probs take 8 bytes per marker: keep them to a few samples
+    for i in xrange(0, N, RESOLVE_CHUNK_SIZE):
+      chunk = data_samples[i:i+RESOLVE_CHUNK_SIZE]
+      all_probs, _ = genomics.resolve_to_data(chunk, self.marker_selector)
+      for j, probs in enumerate(all_probs):
+        data[i+j, :] = project_to_discrete_genotype(probs)
+      del all_probs
     return labels, data
 
   def __write_header(self, fobj, labels):
@@ -363,7 +372,10 @@ class PedWriter(object):
           if not isinstance(v[mid], self.kb.GenotypeDataSample):
             raise ValueError('bad type for data_sample_by_id[%s][%s]' 
                              % (k, mid))
-          v[mid].reload()
+      self.kb.reload_many([v[mid] for v in data_sample_by_id.itervalues()
+                           for mid in self.mvids])
+      for k, v in data_sample_by_id.iteritems():
+        for mid in self.mvids:
           if v[mid].snpMarkersSet.id != mid:
             raise ValueError('bad mset for data_sample_by_id[%s][%s]' 
                              % (k, mid))
@@ -258,14 +258,14 @@ class Neo4JDriver(object):
 
     def __get_ome_obj__(self, node):
         try:
-            return self.kb._CACHE[int(node.obj_hash)]
+            return self.kb.object_cache[int(node.obj_hash)]
         except KeyError:
             return self.kb.get_by_vid(getattr(self.kb, node.obj_class),
                                       str(node.obj_id))
 
     def __get_ome_obj_by_info__(self, obj_info):
         try:
-            return self.kb._CACHE[int(obj_info['object_hash'])]
+            return self.kb.object_cache[int(obj_info['object_hash'])]
         except KeyError:
             return self.kb.get_by_vid(getattr(self.kb, obj_info['object_type']),
                                       obj_info['object_id'])
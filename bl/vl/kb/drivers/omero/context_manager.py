@@ -32,8 +32,8 @@ class Sandbox(ContextManager):
         self.kill_list = []
 
     def __exit__(self, exc_type, exc_value, traceback):
-        while self.kill_list:
-            self.kb.delete(self.kill_list.pop())
+        kill_list, self.kill_list = self.kill_list[::-1], []
+        self.kb.delete_array(kill_list)
         return super(Sandbox, self).__exit__(exc_type, exc_value, traceback)
 
     def register(self, obj):
@@ -1,7 +1,6 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-from bl.vl.kb import mimetypes
 import wrapper as wp
 from action import Action, OriginalFile
 from snp_markers_set import SNPMarkersSet
@@ -57,17 +56,10 @@ class GenotypeDataSample(DataSample):
   __fields__ = [('snpMarkersSet', SNPMarkersSet, wp.REQUIRED)]
 
   def resolve_to_data(self, indices=None):
-    dos = self.proxy.get_data_objects(self)
-    if not dos:
-      raise ValueError('no connected DataObject(s)')
-    for do in dos:
-      do.reload()
-      if do.mimetype == mimetypes.GDO_TABLE:
-        set_vid, vid, index = self.proxy.genomics.parse_gdo_path(do.path)
-        mset = self.snpMarkersSet
-        assert mset.id == set_vid
-        mset.reload()
-        res = self.proxy.genomics.get_gdo(mset, vid, index, indices=indices)
-        return res['probs'], res['confidence']
-    else:
-      raise ValueError('DataObject is not a %s' % mimetypes.GDO_TABLE)
+    """
+    Return the probs and confidence arrays of this data sample. To get
+    the data of many samples at once, use
+    GenomicsAdapter.resolve_to_data.
+    """
+    probs, confs = self.proxy.genomics.resolve_to_data([self], indices)
+    return probs[0], confs[0]
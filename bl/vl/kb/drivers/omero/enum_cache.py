@@ -0,0 +1,74 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Enum cache
+==========
+
+A local file that keeps the OMERO ids of enum values, so that
+short-lived processes do not have to look them up on the server every
+time they start:
+
+.. code-block:: python
+
+   cache = EnumCache('/tmp/enums.json', 'omero.example.org/4.4.9/0.4.0')
+   ids = cache.get('Gender')  # {'MALE': 1, 'FEMALE': 2} or None
+   cache.update({'Gender': {'MALE': 1, 'FEMALE': 2}})
+
+Entries are grouped by key, which should identify both the server and
+the version of the schema: enum ids never change for a given
+database, but they are not the same across servers.
+"""
+
+import os, json, tempfile, threading
+
+
+class EnumCache(object):
+
+  def __init__(self, path, key):
+    self.path = path
+    self.key = key
+    self.__lock = threading.Lock()
+    self.__tables = None
+
+  def __read(self):
+    try:
+      with open(self.path) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return {}
+
+  def __load(self):
+    if self.__tables is None:
+      self.__tables = self.__read().get(self.key, {})
+    return self.__tables
+
+  def get(self, table):
+    """
+    Return a dictionary that maps the values of enum table to their
+    ids, or None if table is not in the cache.
+    """
+    with self.__lock:
+      return self.__load().get(table)
+
+  def update(self, tables):
+    """
+    Add tables, a dictionary mapping enum table names to {value: id}
+    dictionaries, to the cache and write it back to disk. Failing to
+    write the file is not an error.
+    """
+    with self.__lock:
+      self.__load().update(tables)
+      content = self.__read()
+      content[self.key] = self.__tables
+      dirname = os.path.dirname(os.path.abspath(self.path))
+      try:
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+      except (IOError, OSError):
+        return
+      try:
+        with os.fdopen(fd, 'w') as f:
+          json.dump(content, f)
+        os.rename(tmp, self.path)
+      except (IOError, OSError):
+        os.remove(tmp)
@@ -0,0 +1,99 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Futures
+=======
+
+Results of asynchronous KB operations, built on Ice asynchronous
+method invocation (AMI). Requests are sent when the future is created,
+and replies are collected by :meth:`KBFuture.result`, so independent
+lookups can be overlapped without extra threads:
+
+.. code-block:: python
+
+   f_study = kb.get_by_vid_async(kb.Study, study_vid)
+   f_device = kb.get_by_vid_async(kb.Device, device_vid)
+   study, device = gather([f_study, f_device])
+
+Ice 3.3 does not provide the begin_/end_ API: in that case, calls are
+run synchronously and the futures are returned already done.
+"""
+
+import sys, threading
+
+
+_PENDING = object()
+
+
+class KBFuture(object):
+  """
+  The result of an asynchronous operation: wait is called, at most
+  once, to collect it; is_done, if given, tells whether result would
+  block.
+  """
+  def __init__(self, wait, is_done=None):
+    self.__wait = wait
+    self.__is_done = is_done
+    self.__value = _PENDING
+    self.__error = None
+    self.__lock = threading.Lock()
+
+  @classmethod
+  def from_call(klass, f, *args):
+    """
+    Run f(*args) right away and return its outcome as a done future.
+    """
+    future = klass(lambda: f(*args))
+    try:
+      future.result()
+    except Exception:
+      pass  # raised again by each call to result
+    return future
+
+  def done(self):
+    if self.__value is not _PENDING or self.__error is not None:
+      return True
+    return self.__is_done is not None and self.__is_done()
+
+  def result(self):
+    """
+    Wait for the operation to complete and return its result, or
+    raise its exception.
+    """
+    with self.__lock:
+      if self.__value is _PENDING and self.__error is None:
+        try:
+          self.__value = self.__wait()
+        except Exception:
+          self.__error = sys.exc_info()
+        self.__wait = self.__is_done = None
+    if self.__error is not None:
+      raise self.__error[0], self.__error[1], self.__error[2]
+    return self.__value
+
+  def then(self, f):
+    """
+    Return a future for f applied to the result of this one.
+    """
+    return KBFuture(lambda: f(self.result()), self.done)
+
+
+def ice_call(proxy, method, *args):
+  """
+  Invoke method on the Ice proxy with args and return a KBFuture for
+  its result.
+  """
+  begin = getattr(proxy, 'begin_%s' % method, None)
+  if begin is None:
+    return KBFuture.from_call(getattr(proxy, method), *args)
+  r = begin(*args)
+  end = getattr(proxy, 'end_%s' % method)
+  return KBFuture(lambda: end(r), r.isCompleted)
+
+
+def gather(futures):
+  """
+  Return the results of futures, in order.
+  """
+  return [f.result() for f in futures]
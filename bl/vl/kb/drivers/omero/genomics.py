@@ -40,13 +40,13 @@ import bl.vl.utils as vlu
 from bl.vl.kb import mimetypes
 import variant_call_support
 import wrapper as wp
-from proxy_core import convert_from_numpy
 from utils import assign_vid, make_unique_key
+from proxy_core import QUERY_PAGE_SIZE
 
 import numpy as np
 import hashlib
+import itertools as it
 
-BATCH_SIZE = 5000
 VID_SIZE = vlu.DEFAULT_VID_LEN
 
 MARKER_LABEL_SIZE = 128
@@ -71,18 +71,114 @@ MSET_TABLE_COLS  = [
     ]
 
 GDO_TABLE_NAME = 'gdo'
-def GDO_TABLE_COLS(N):
+# each marker block takes two columns: keep gdo tables within the 512
+# columns that PyTables (and the HDF5 object header) handle well
+MAX_GDO_BLOCKS = 255
+def GDO_TABLE_COLS(N, block_size=None, compact=False):
+    """
+    Column definitions of a gdo table for N markers. If block_size is
+    given, markers are split in blocks of block_size, and block i is
+    stored in columns probs_i and confidence_i, so that a subset of
+    markers can be read without moving the whole row.
+
+    If compact is True, probs are quantized to uint8 (see
+    quantize_probs) and confidence values are stored as float16, both
+    packed into long arrays: this takes 4 bytes per marker instead of
+    12. block_size must then be a multiple of 4.
+
+    Raise ValueError if block_size would split the markers in more
+    than MAX_GDO_BLOCKS blocks.
+    """
+    if block_size is not None:
+        if block_size < 1:
+            raise ValueError('block_size must be positive')
+        if -(-N // block_size) > MAX_GDO_BLOCKS:
+            raise ValueError(
+              'block_size %d splits %d markers in more than %d blocks, '
+              'use at least %d' % (block_size, N, MAX_GDO_BLOCKS,
+                                   -(-N // MAX_GDO_BLOCKS))
+              )
+    if compact and block_size is not None and block_size % 4:
+        raise ValueError('block_size must be a multiple of 4 for compact gdos')
     cols = [
       ('string', 'vid', 'gdo VID', VID_SIZE, None),
       ('string', 'op_vid', 'Last operation that modified this row',
        VID_SIZE, None),
-      ('float_array', 'probs', 'np.zeros((2,N), dtype=np.float32)',
-       2*N, None),
-      ('float_array', 'confidence', 'np.zeros((N,), dtype=np.float32)',
-       N, None),
       ]
+    if block_size is None:
+        blocks = [('', 0, N)]
+    else:
+        blocks = [('_%d' % i, start, min(N, start + block_size))
+                  for i, start in enumerate(xrange(0, N, block_size))]
+    for suffix, start, stop in blocks:
+        n = stop - start
+        if block_size is None:
+            size, markers = 'N', ''
+        else:
+            size, markers = n, ', markers %d-%d' % (start, stop - 1)
+        if compact:
+            cols.extend([
+              ('long_array', 'qprobs' + suffix,
+               'quantize_probs(np.zeros((2,%s))) as longs%s' % (size, markers),
+               -(-2*n // 8), None),
+              ('long_array', 'qconfidence' + suffix,
+               'np.zeros((%s,), dtype=np.float16) as longs%s' % (size, markers),
+               -(-n // 4), None),
+              ])
+        else:
+            cols.extend([
+              ('float_array', 'probs' + suffix,
+               'np.zeros((2,%s), dtype=np.float32)%s' % (size, markers),
+               2*n, None),
+              ('float_array', 'confidence' + suffix,
+               'np.zeros((%s,), dtype=np.float32)%s' % (size, markers),
+               n, None),
+              ])
     return cols
 
+# upper bound for the size of the gdo rows read at a time when
+# iterating over the gdos of many data samples
+GDO_FETCH_BYTES = 256 * 2**20
+
+# compact gdo tables map probabilities in [0, 1] to 0..GDO_PROB_SCALE
+# and missing (NaN) values to GDO_NAN_CODE
+GDO_PROB_SCALE = 254
+GDO_NAN_CODE = 255
+
+def quantize_probs(probs):
+    """
+    Return probs, clipped to [0, 1], as a uint8 array of the same
+    shape. The quantization step is 1/GDO_PROB_SCALE.
+    """
+    probs = np.asarray(probs, dtype=np.float32)
+    missing = np.isnan(probs)
+    q = np.rint(np.clip(np.where(missing, 0, probs), 0, 1) * GDO_PROB_SCALE)
+    q = q.astype(np.uint8)
+    q[missing] = GDO_NAN_CODE
+    return q
+
+def dequantize_probs(q):
+    "Inverse of quantize_probs, up to the quantization error."
+    probs = q.astype(np.float32) / GDO_PROB_SCALE
+    probs[q == GDO_NAN_CODE] = np.nan
+    return probs
+
+def _pack_longs(a):
+    """
+    Pack each row of the 2D array a into a zero-padded row of
+    little-endian longs, which is what OMERO.tables can store.
+    """
+    nbytes = a.shape[1] * a.itemsize
+    packed = np.zeros((len(a), -(-nbytes // 8) * 8), dtype=np.uint8)
+    packed[:, :nbytes] = np.ascontiguousarray(a).view(np.uint8).reshape(
+      len(a), nbytes
+      )
+    return packed.view('<i8')
+
+def _unpack_longs(x, dtype, count):
+    "Inverse of _pack_longs for a single row of count dtype values."
+    return np.ascontiguousarray(x, dtype='<i8').view(dtype)[:count]
+
 MA_TABLES = frozenset([MSET_TABLE_NAME, GDO_TABLE_NAME])
 
 class GenomicsAdapter(object):
@@ -94,9 +190,10 @@ class GenomicsAdapter(object):
 
     def __init__(self, kb):
         self.kb = kb
+        self.__gdo_layouts = {}
 
     def create_markers_array(self, label, maker, model, release, rows, 
-                             action):
+                             action, gdo_block_size=None, compact_gdos=False):
         """
         Create a new (SNP)MarkersSet object and associate to it all
         the markers information contained in rows.  Rows could be
@@ -106,8 +203,21 @@ class GenomicsAdapter(object):
         order of markers array records exactly the one given in
         stream.
 
+        If gdo_block_size is given, gdos of this markers array are
+        stored in blocks of gdo_block_size markers (see
+        GDO_TABLE_COLS): reading a few markers is then much cheaper,
+        reading all of them slightly more expensive. If compact_gdos
+        is True, gdos are stored in the compact, lossy, encoding (see
+        GDO_TABLE_COLS) and their DataObjects have the
+        GDO_COMPACT_TABLE mimetype. A ValueError is raised, and
+        nothing is left in the KB, if gdo_block_size would split the
+        markers in more than MAX_GDO_BLOCKS blocks.
+
         FIXME: confusedly enough, this currently returns a SNPMarkersSet
         """
+        if hasattr(rows, '__len__'):
+            # check the gdo layout before creating anything
+            GDO_TABLE_COLS(len(rows), gdo_block_size, compact_gdos)
         avid = self.kb.resolve_action_id(action)
         conf = {'label': label, 'maker': maker, 'model': model, 
                 'markersSetVID': vlu.make_vid(),
@@ -116,11 +226,17 @@ class GenomicsAdapter(object):
         self._create_markers_array_table(MSET_TABLE_NAME, MSET_TABLE_COLS, 
                                          marray.id)
         N = len(self._fill_markers_array_table(MSET_TABLE_NAME, marray.id,
-                                               rows, avid,
-                                               batch_size=BATCH_SIZE))
+                                               rows, avid))
+        try:
+            gdo_cols = GDO_TABLE_COLS(N, gdo_block_size, compact_gdos)
+        except ValueError:
+            self.kb.delete_table(
+              self._markers_array_table_name(MSET_TABLE_NAME, marray.id)
+              )
+            self.kb.delete(marray)
+            raise
         #FIXME we are actually considering only SNP gdo.
-        self._create_markers_array_table(GDO_TABLE_NAME, GDO_TABLE_COLS(N),
-                                         marray.id)
+        self._create_markers_array_table(GDO_TABLE_NAME, gdo_cols, marray.id)
         return marray
 
     def get_markers_array(self, label=None,
@@ -148,7 +264,7 @@ class GenomicsAdapter(object):
         return None if result is None else self.kb.factory.wrap(result)
 
     def get_markers_array_rows(self, marray, indices=None, col_names=None,
-                               batch_size=BATCH_SIZE):
+                               batch_size=None):
         "FIXME"
         table_name = self._markers_array_table_name(MSET_TABLE_NAME, marray.id)
         return self.kb.get_table_rows_by_indices(table_name, indices,
@@ -164,6 +280,7 @@ class GenomicsAdapter(object):
         for table in MA_TABLES:
             table_name = self._markers_array_table_name(table, marray_id)
             self.kb.delete_table(table_name)
+        self.__gdo_layouts.pop(marray_id, None)
 
     def make_gdo_path(self, marray, vid, index):
         table_name = self._markers_array_table_name(GDO_TABLE_NAME, marray.id)
@@ -178,6 +295,10 @@ class GenomicsAdapter(object):
         return set_vid, vid, index
 
     def add_gdo(self, set_vid, probs, confidence, op_vid):
+        compact, blocks = self._get_gdo_layout(set_vid)
+        if compact or len(blocks) > 1:
+            return self.add_gdos(set_vid, probs[np.newaxis],
+                                 confidence[np.newaxis], op_vid)[0]
         probs.shape = probs.size
         table_name = self._markers_array_table_name(GDO_TABLE_NAME, set_vid)
         row = {'op_vid': op_vid, 'probs': probs, 'confidence': confidence}
@@ -206,55 +327,283 @@ class GenomicsAdapter(object):
         mset = sample.snpMarkersSet
         # FIXME doesn't check that probs and confs have the right dtype and size
         gdo_vid, row_index = self.add_gdo(mset.id, probs, confs, avid)
-        size = 0
-        sha1 = hashlib.sha1()
-        s = probs.tostring();  size += len(s) ; sha1.update(s)
-        s = confs.tostring();  size += len(s) ; sha1.update(s)
+        layout = self._get_gdo_layout(mset.id)
+        sha1, size = self._gdo_checksum(probs, confs, layout[0])
         conf = {
           'sample': sample,
           'path': self.make_gdo_path(mset, gdo_vid, row_index),
-          'mimetype': mimetypes.GDO_TABLE,
-          'sha1': sha1.hexdigest(),
+          'mimetype': self._gdo_mimetype(layout),
+          'sha1': sha1,
           'size': size,
           }
         gds = self.kb.factory.create(self.kb.DataObject, conf).save()
         return gds
 
+    def add_gdos(self, set_vid, probs, confidence, op_vid, batch_size=None):
+        """
+        Append len(probs) rows to the gdo table of set_vid, with
+        probs[i] and confidence[i] in row i. Return the list of the
+        (vid, row_index) pairs assigned to the new rows.
+
+        :param probs: a <nsamples>x2x<nmarkers> array
+        :type probs: numpy.ndarray
+
+        :param confidence: a <nsamples>x<nmarkers> array
+        :type confidence: numpy.ndarray
+        """
+        table_name = self._markers_array_table_name(GDO_TABLE_NAME, set_vid)
+        records = self._make_gdo_records(
+          self._get_gdo_layout(set_vid),
+          [vlu.make_vid() for _ in xrange(len(probs))], op_vid,
+          probs, confidence
+          )
+        row_indices = self.kb.add_table_rows(table_name, records, batch_size)
+        return zip(records['vid'], row_indices)
+
+    def add_gdo_data_objects(self, action, samples, probs, confs,
+                             batch_size=None):
+        """
+        Bulk version of :meth:`add_gdo_data_object`: probs[i] and
+        confs[i] are the data for samples[i]. Rows are appended to each
+        gdo table with as few calls as the table byte budget (or
+        batch_size) allows, and all DataObjects are saved with a single
+        save_array. Return the saved DataObjects, in samples order.
+
+        :param probs: a <nsamples>x2x<nmarkers> array with the AA and
+          the BB homozygous probabilities.
+        :type probs: numpy.ndarray
+
+        :param confs: a <nsamples>x<nmarkers> array with the confidence
+          on the above probabilities.
+        :type confs: numpy.ndarray
+        """
+        avid = self.kb.resolve_action_id(action)
+        probs, confs = np.asarray(probs), np.asarray(confs)
+        if len(probs) != len(samples) or len(confs) != len(samples):
+          raise ValueError('probs and confs should have one item per sample')
+        for sample in samples:
+          if not isinstance(sample, self.kb.GenotypeDataSample):
+            raise ValueError('samples should be instances of GenotypeDataSample')
+        self.kb.prefetch(samples, ['snpMarkersSet'])
+        by_mset = {}
+        for i, sample in enumerate(samples):
+          mset = sample.snpMarkersSet
+          by_mset.setdefault(mset.id, (mset, []))[1].append(i)
+        dos = [None] * len(samples)
+        for mset, idx in by_mset.itervalues():
+          # FIXME doesn't check that probs and confs have the right size
+          gdos = self.add_gdos(mset.id, probs[idx], confs[idx], avid,
+                               batch_size)
+          layout = self._get_gdo_layout(mset.id)
+          for i, (gdo_vid, row_index) in it.izip(idx, gdos):
+            sha1, size = self._gdo_checksum(probs[i], confs[i], layout[0])
+            conf = {
+              'sample': samples[i],
+              'path': self.make_gdo_path(mset, gdo_vid, row_index),
+              'mimetype': self._gdo_mimetype(layout),
+              'sha1': sha1,
+              'size': size,
+              }
+            dos[i] = self.kb.factory.create(self.kb.DataObject, conf)
+        return self.kb.save_array(dos)
+
+    def convert_gdo_table(self, mset, compact=True, block_size=None,
+                          batch_size=None):
+        """
+        Rewrite the gdo table of mset with the layout given by compact
+        and block_size (see GDO_TABLE_COLS), and update the mimetype,
+        sha1 and size of its DataObjects. Vids and row indices do not
+        change, so gdo paths stay valid. Converting to the compact
+        layout is lossy.
+
+        Rows are copied to a temporary table, <table>.tmp, first, so
+        the original table is only deleted once all of its contents
+        have been converted; the table is then recreated and filled
+        from <table>.tmp. If a previous call failed during this last
+        step or while updating the DataObjects (the table is missing,
+        or has no more rows than a <table>.tmp with the same layout),
+        the copy is resumed from <table>.tmp, whose layout takes
+        precedence over compact and block_size; <table>.tmp is only
+        deleted once the DataObjects have been saved. DataObjects
+        pointing to a row that is not in the table are left untouched
+        and logged. Return the number of converted gdos.
+        """
+        set_vid = mset.id
+        table_name = self._markers_array_table_name(GDO_TABLE_NAME, set_vid)
+        tmp_name = '%s.tmp' % table_name
+        n_markers = self.kb.get_number_of_rows(
+          self._markers_array_table_name(MSET_TABLE_NAME, set_vid)
+          )
+        if self.__gdo_copy_back_interrupted(table_name, tmp_name):
+            layout = self._parse_gdo_layout(
+              set_vid, dict(self.kb.get_table_headers(tmp_name))
+              )
+            compact, blocks = layout
+            if blocks[0][0]:
+                block_size = blocks[0][2] - blocks[0][1]
+            else:
+                block_size = None
+            cols = GDO_TABLE_COLS(n_markers, block_size, compact)
+        else:
+            cols = GDO_TABLE_COLS(n_markers, block_size, compact)
+            old_layout = self._get_gdo_layout(set_vid)
+            if self.kb.table_exists(tmp_name):
+                self.kb.delete_table(tmp_name)
+            self.kb.create_table(tmp_name, cols)
+            layout = self._parse_gdo_layout(
+              set_vid, dict(self.kb.get_table_headers(tmp_name))
+              )
+            for block in self.kb.get_table_blocks_iterator(
+              table_name, batch_size=batch_size
+              ):
+                gdos = [self._unwrap_gdo(r, None, old_layout) for r in block]
+                probs = np.array([g['probs'] for g in gdos])
+                confs = np.array([g['confidence'] for g in gdos])
+                records = self._make_gdo_records(layout, block['vid'],
+                                                 block['op_vid'], probs, confs)
+                self.kb.add_table_rows(tmp_name, records, batch_size)
+        if self.kb.table_exists(table_name):
+            self.kb.delete_table(table_name)
+        self.__gdo_layouts.pop(set_vid, None)
+        self.kb.create_table(table_name, cols)
+        checksums = {}
+        for block in self.kb.get_table_blocks_iterator(tmp_name,
+                                                       batch_size=batch_size):
+            self.kb.add_table_rows(table_name, block, batch_size)
+            for r in block:
+                gdo = self._unwrap_gdo(r, None, layout)
+                # already decoded: these are the values read back
+                checksums[r['vid']] = self._gdo_checksum(
+                  gdo['probs'], gdo['confidence'], False
+                  )
+        query = 'from DataObject do where do.path like :path'
+        dos = []
+        for do in self.kb.find_all_by_query(
+          query, {'path': 'table:%s/%%' % table_name}
+          ):
+            _, vid, _ = self.parse_gdo_path(do.path)
+            if vid not in checksums:
+                self.kb.logger.warning('%s: no gdo row for %s, skipping'
+                                       % (do.id, do.path))
+                continue
+            do.mimetype = self._gdo_mimetype(layout)
+            do.sha1, do.size = checksums[vid]
+            dos.append(do)
+        self.kb.save_array(dos)
+        self.kb.delete_table(tmp_name)
+        return len(checksums)
+
+    def __gdo_copy_back_interrupted(self, table_name, tmp_name):
+        if not self.kb.table_exists(tmp_name):
+            return False
+        if not self.kb.table_exists(table_name):
+            return True
+        # while tmp_name is being filled, it has fewer rows than
+        # table_name; while copying back, the opposite holds, and both
+        # have the same rows until the DataObjects are saved
+        return (self.kb.get_table_headers(table_name) ==
+                self.kb.get_table_headers(tmp_name) and
+                self.kb.get_number_of_rows(table_name) <=
+                self.kb.get_number_of_rows(tmp_name))
+
     def get_gdo(self, mset, vid, row_index, indices=None):
         table_name = self._markers_array_table_name(GDO_TABLE_NAME, mset.id)
-        rows = self.kb.get_table_rows_by_indices(table_name, [row_index])
+        layout = self._get_gdo_layout(mset.id)
+        rows = self.kb.get_table_rows_by_indices(
+          table_name, [row_index],
+          col_names=self._gdo_col_names(layout, indices)
+          )
         assert len(rows) == 1
         assert rows[0]['vid'] == vid
-        return self._unwrap_gdo(rows[0], indices)
+        return self._unwrap_gdo(rows[0], indices, layout)
+
+    def get_gdos(self, data_samples, indices=None, batch_size=None):
+        """
+        Fetch the gdos of all data_samples. For each QUERY_PAGE_SIZE
+        data samples, the gdo DataObjects are looked up with a single
+        query, then row indices are grouped by gdo table, sorted and
+        read with one get_table_slice per table, so that contiguous
+        rows are fetched together. Reads on different tables are
+        overlapped.
+
+        Return a list of (data_sample, gdo) pairs, in data_samples
+        order; data samples with more than one gdo appear once for
+        each of them, those without a gdo are skipped.
+        """
+        return [(ds, gdo) for ds, _, gdo in
+                self._iter_gdos(data_samples, indices, batch_size)]
+
+    def resolve_to_data(self, data_samples, indices=None, batch_size=None):
+        """
+        Bulk version of GenotypeDataSample.resolve_to_data: return a
+        <nsamples>x2x<nmarkers> probs array and a <nsamples>x<nmarkers>
+        confidence array, with the data of data_samples[i] in position
+        i, restricted to indices if given. Gdos are fetched as in
+        :meth:`get_gdos`, for as many data samples at a time as
+        GDO_FETCH_BYTES allows. Data samples with more than one gdo
+        contribute the first one.
+
+        All data samples must have a gdo and their markers sets must
+        have the same number of markers, or ValueError is raised.
+        """
+        data_samples = list(data_samples)
+        self.kb.prefetch(data_samples, ['snpMarkersSet'])
+        positions = {}
+        for i, ds in enumerate(data_samples):
+            positions.setdefault(ds.omero_id, []).append(i)
+        chunk_size = self._gdo_chunk_size(
+          set(ds.snpMarkersSet.id for ds in data_samples)
+          )
+        probs = confs = None
+        for ds, set_vid, gdo in self._iter_gdos(data_samples, indices,
+                                                batch_size, chunk_size):
+            if set_vid != ds.snpMarkersSet.id:
+                raise ValueError(
+                    'gdo %s of %s maps to data with a wrong SNPMarkersSet'
+                    % (gdo['vid'], ds.id)
+                )
+            idx = positions.pop(ds.omero_id, None)
+            if idx is None:
+                continue
+            if probs is None:
+                n_markers = gdo['confidence'].size
+                probs = np.empty((len(data_samples), 2, n_markers),
+                                 dtype=np.float32)
+                confs = np.empty((len(data_samples), n_markers),
+                                 dtype=np.float32)
+            elif gdo['confidence'].size != confs.shape[1]:
+                raise ValueError('data samples have different numbers of markers')
+            probs[idx] = gdo['probs']
+            confs[idx] = gdo['confidence']
+        if positions:
+            i = min(min(idx) for idx in positions.itervalues())
+            raise ValueError('no gdo connected to %s' % data_samples[i].id)
+        if probs is None:
+            return (np.zeros((0, 2, 0), dtype=np.float32),
+                    np.zeros((0, 0), dtype=np.float32))
+        return probs, confs
 
     #FIXME this is the basic object, we should have some support for selections
     def get_gdo_iterator(self, mset, data_samples=None, indices = None,
-                         batch_size=100):
-        def get_gdo_iterator_on_list(dos):
-            seen_data_samples = set([])
-            for do in dos:
-                # FIXME we could, in principle, handle other mimetypes too
-                if do.mimetype == mimetypes.GDO_TABLE:
-                    self.kb.logger.debug(do.path)
-                    mset_vid, vid, row_index = self.parse_gdo_path(do.path)
-                    self.kb.logger.debug('%r' % [vid, row_index])
-                    if mset_vid != mset.id:
-                        raise ValueError(
-                            'DataObject %s map to data with a wrong SNPMarkersSet' 
-                            % do.path
-                        )
-                    yield self.get_gdo(mset, vid, row_index, indices)
-                else:
-                    pass
+                         batch_size=None):
+        def iterator(gdos):
+            # FIXME we could, in principle, handle other mimetypes too
+            for ds, set_vid, gdo in gdos:
+                if set_vid != mset.id:
+                    raise ValueError(
+                        'gdo %s of %s maps to data with a wrong SNPMarkersSet'
+                        % (gdo['vid'], ds.id)
+                    )
+                yield gdo
         if data_samples is None:
             return self._get_gdo_iterator(mset.id, indices, batch_size)
+        data_samples = list(data_samples)
+        self.kb.prefetch(data_samples, ['snpMarkersSet'])
         for d in data_samples:
             if d.snpMarkersSet != mset:
                 raise ValueError('data_sample %s snpMarkersSet != mset' % d.id)
-        ids = ','.join('%s' % ds.omero_id for ds in data_samples)
-        query = 'from DataObject do where do.sample.id in (%s)' % ids
-        dos = self.kb.find_all_by_query(query, None)
-        return get_gdo_iterator_on_list(dos)
+        return iterator(self._iter_gdos(data_samples, indices, batch_size,
+                                        self._gdo_chunk_size([mset.id])))
 
     def get_genotype_data_samples(self, individual, markers_set):
         """
@@ -318,11 +667,14 @@ class GenomicsAdapter(object):
         return set_vid
 
     def _fill_markers_array_table(self, table_name_root, set_vid, stream,
-                                  op_vid, batch_size):
-        def rows_to_stream(rows):
-            dtype = rows.dtype
-            for r in rows:
-                yield dict([(k, convert_from_numpy(r[k])) for k in dtype.names])
+                                  op_vid, batch_size=None):
+        def add_op_vid_field(rows):
+            dtype = rows.dtype.descr + [('op_vid', '|S%d' % VID_SIZE)]
+            records = np.empty(len(rows), dtype=dtype)
+            for k in rows.dtype.names:
+                records[k] = rows[k]
+            records['op_vid'] = op_vid
+            return records
         def add_op_vid(stream):
             for r in stream:
                 if not r.has_key('op_vid'):
@@ -330,24 +682,261 @@ class GenomicsAdapter(object):
                 yield r
         table_name = self._markers_array_table_name(table_name_root, set_vid)
         if hasattr(stream, 'dtype'):
-            stream = rows_to_stream(stream)
+            if 'op_vid' not in stream.dtype.names:
+                stream = add_op_vid_field(stream)
+            return self.kb.add_table_rows(table_name, stream, batch_size)
         return self.kb.add_table_rows_from_stream(table_name, 
                                                   add_op_vid(stream),
                                                   batch_size)
-    def _unwrap_gdo(self, row, indices):
+    def _get_gdo_layout(self, set_vid):
+        """
+        Return the layout of the gdo table of set_vid as a (compact,
+        blocks) pair, where blocks is the list of the (column suffix,
+        first marker, last marker + 1) triples of its marker blocks:
+        [('', 0, N)] unless the table was created with a block_size.
+        """
+        return self.__get_gdo_table_info(set_vid)[0]
+
+    def _get_gdo_row_size(self, set_vid):
+        "Return the size, in bytes, of a row of the gdo table of set_vid."
+        return self.__get_gdo_table_info(set_vid)[1]
+
+    def __get_gdo_table_info(self, set_vid):
+        try:
+            return self.__gdo_layouts[set_vid]
+        except KeyError:
+            pass
+        table_name = self._markers_array_table_name(GDO_TABLE_NAME, set_vid)
+        headers = self.kb.get_table_headers(table_name)
+        info = (self._parse_gdo_layout(set_vid, dict(headers)),
+                np.dtype(headers).itemsize)
+        self.__gdo_layouts[set_vid] = info
+        return info
+
+    def _gdo_chunk_size(self, set_vids):
+        """
+        Return the number of data samples whose gdos, from the gdo
+        tables of set_vids, fit in GDO_FETCH_BYTES.
+        """
+        row_size = max([self._get_gdo_row_size(v) for v in set_vids] or [1])
+        return max(1, min(QUERY_PAGE_SIZE, GDO_FETCH_BYTES // row_size))
+
+    def _parse_gdo_layout(self, set_vid, fields):
+        compact = 'confidence' not in fields and 'confidence_0' not in fields
+        conf = 'qconfidence' if compact else 'confidence'
+        if conf in fields:
+            suffixes = ['']
+        else:
+            suffixes = ['_%d' % i for i in it.takewhile(
+              lambda i: '%s_%d' % (conf, i) in fields, it.count()
+              )]
+        if compact:
+            # packed columns are padded, get sizes from the markers set
+            n_markers = self.kb.get_number_of_rows(
+              self._markers_array_table_name(MSET_TABLE_NAME, set_vid)
+              )
+            block_size = 4 * np.dtype(fields[conf + suffixes[0]]).shape[0]
+            sizes = [min(block_size, n_markers - i * block_size)
+                     for i in xrange(len(suffixes))]
+        else:
+            sizes = [np.dtype(fields[conf + s]).shape[0] for s in suffixes]
+        blocks, start = [], 0
+        for suffix, n in it.izip(suffixes, sizes):
+            blocks.append((suffix, start, start + n))
+            start += n
+        return compact, blocks
+
+    @staticmethod
+    def _gdo_mimetype(layout):
+        return mimetypes.GDO_COMPACT_TABLE if layout[0] else mimetypes.GDO_TABLE
+
+    @staticmethod
+    def _gdo_checksum(probs, confs, compact):
+        """
+        Return the sha1 and the size of probs and confs as they will be
+        read back from a table with the given encoding.
+        """
+        if compact:
+            probs = dequantize_probs(quantize_probs(probs))
+            confs = np.asarray(confs, dtype='<f2').astype(np.float32)
+        sha1 = hashlib.sha1()
+        size = 0
+        for a in probs, confs:
+            a = np.ascontiguousarray(a)
+            size += a.nbytes
+            sha1.update(buffer(a))
+        return sha1.hexdigest(), size
+
+    @staticmethod
+    def _make_gdo_records(layout, vids, op_vids, probs, confidence):
+        compact, blocks = layout
+        n, n_markers = len(probs), blocks[-1][2]
+        probs = np.reshape(probs, (n, 2, n_markers))
+        confidence = np.reshape(confidence, (n, n_markers))
+        dtype = [('vid', '|S%d' % VID_SIZE), ('op_vid', '|S%d' % VID_SIZE)]
+        columns = []
+        for suffix, start, stop in blocks:
+            p = np.reshape(probs[:, :, start:stop], (n, 2 * (stop - start)))
+            c = confidence[:, start:stop]
+            if compact:
+                columns.extend([
+                  ('qprobs' + suffix, _pack_longs(quantize_probs(p))),
+                  ('qconfidence' + suffix, _pack_longs(c.astype('<f2'))),
+                  ])
+            else:
+                columns.extend([('probs' + suffix, p),
+                                ('confidence' + suffix, c)])
+        for name, a in columns:
+            dtype.append((name, np.int64 if compact else np.float32,
+                          (a.shape[1],)))
+        records = np.empty(n, dtype=dtype)
+        records['vid'] = vids
+        records['op_vid'] = op_vids
+        for name, a in columns:
+            records[name] = a
+        return records
+
+    @staticmethod
+    def _gdo_blocks(layout, indices):
+        """
+        Return the marker positions selected by indices and, for each
+        of them, the position of the block that contains it.
+        """
+        blocks = layout[1]
+        positions = np.arange(blocks[-1][2])[indices]
+        starts = [start for _, start, _ in blocks]
+        return positions, np.searchsorted(starts, positions, 'right') - 1
+
+    def _gdo_col_names(self, layout, indices):
+        compact, blocks = layout
+        if len(blocks) == 1:
+            return None
+        if indices is not None:
+            _, block_ids = self._gdo_blocks(layout, indices)
+            blocks = [blocks[b] for b in np.unique(block_ids)]
+        prefix = 'q' if compact else ''
+        col_names = ['vid', 'op_vid']
+        for suffix, _, _ in blocks:
+            col_names.extend([prefix + 'probs' + suffix,
+                              prefix + 'confidence' + suffix])
+        return col_names
+
+    @staticmethod
+    def _decode_gdo_block(row, compact, suffix, n):
+        if compact:
+            p = dequantize_probs(_unpack_longs(row['qprobs' + suffix],
+                                               np.uint8, 2 * n))
+            c = _unpack_longs(row['qconfidence' + suffix], '<f2', n)
+            c = c.astype(np.float32)
+        else:
+            p, c = row['probs' + suffix], row['confidence' + suffix]
+        return np.reshape(p, (2, n)), c
+
+    def _unwrap_gdo(self, row, indices, layout=None):
         r = {'vid': row['vid'], 'op_vid': row['op_vid']}
-        p = row['probs']
-        p.shape = (2, p.size/2)
-        r['probs'] = p[:, indices] if indices is not None else p
-        c = row['confidence']
-        r['confidence'] = c[indices] if indices is not None else c
+        if layout is None:
+            layout = (False, [('', 0, row['confidence'].size)])
+        compact, blocks = layout
+        if indices is None or len(blocks) == 1:
+            parts = [self._decode_gdo_block(row, compact, suffix, stop - start)
+                     for suffix, start, stop in blocks]
+            if len(parts) == 1:
+                p, c = parts[0]
+            else:
+                p = np.hstack([x[0] for x in parts])
+                c = np.concatenate([x[1] for x in parts])
+            r['probs'] = p[:, indices] if indices is not None else p
+            r['confidence'] = c[indices] if indices is not None else c
+            return r
+        positions, block_ids = self._gdo_blocks(layout, indices)
+        p = np.empty((2, len(positions)), dtype=np.float32)
+        c = np.empty(len(positions), dtype=np.float32)
+        for b in np.unique(block_ids):
+            suffix, start, stop = blocks[b]
+            bp, bc = self._decode_gdo_block(row, compact, suffix, stop - start)
+            sel = block_ids == b
+            p[:, sel] = bp[:, positions[sel] - start]
+            c[sel] = bc[positions[sel] - start]
+        r['probs'], r['confidence'] = p, c
         return r
 
-    def _get_gdo_iterator(self, set_vid, indices=None, batch_size=100):
-        def iterator(stream):
-          for d in stream:
-            yield self._unwrap_gdo(d, indices)
+    def _iter_gdos(self, data_samples, indices=None, batch_size=None,
+                   chunk_size=QUERY_PAGE_SIZE):
+        """
+        Yield the (data_sample, set_vid, gdo) triples of data_samples,
+        in data_samples order, fetching the gdos of chunk_size data
+        samples at a time.
+        """
+        unique, seen = [], set()
+        for ds in data_samples:
+            if ds.omero_id not in seen:
+                seen.add(ds.omero_id)
+                unique.append(ds)
+        for i in xrange(0, len(unique), chunk_size):
+            for x in self._fetch_gdos(unique[i:i+chunk_size], indices,
+                                      batch_size):
+                yield x
+
+    def _fetch_gdos(self, data_samples, indices=None, batch_size=None):
+        data_samples = list(data_samples)
+        by_id = {}
+        for ds in data_samples:
+            by_id.setdefault(ds.omero_id, ds)
+        query = ('from DataObject do where do.sample.id in (%s) '
+                 'and do.mimetype in (:gdo, :compact_gdo)')
+        params = {'gdo': mimetypes.GDO_TABLE,
+                  'compact_gdo': mimetypes.GDO_COMPACT_TABLE}
+        ids = by_id.keys()
+        futures = []
+        for i in xrange(0, len(ids), QUERY_PAGE_SIZE):
+            q = query % ','.join('%d' % x for x in ids[i:i+QUERY_PAGE_SIZE])
+            futures.append(self.kb.find_all_by_query_async(q, params))
+        dos_by_sample, rows_by_table = {}, {}
+        for do in it.chain(*(f.result() for f in futures)):
+            set_vid, vid, row_index = self.parse_gdo_path(do.path)
+            dos_by_sample.setdefault(do.ome_obj.sample.id._val, []).append(
+                (set_vid, vid, row_index)
+                )
+            rows_by_table.setdefault(set_vid, set()).add(row_index)
+        reads = []
+        for set_vid, rows in rows_by_table.iteritems():
+            table_name = self._markers_array_table_name(GDO_TABLE_NAME, set_vid)
+            layout = self._get_gdo_layout(set_vid)
+            rows = sorted(rows)
+            reads.append((set_vid, layout, rows, self.kb.get_table_slice_async(
+              table_name, rows, self._gdo_col_names(layout, indices),
+              batch_size=batch_size
+              )))
+        gdo_rows = {}
+        while reads:
+            set_vid, layout, rows, f = reads.pop()
+            for row_index, r in it.izip(rows, f.result()):
+                gdo_rows[(set_vid, row_index)] = (layout, r)
+        del reads, rows_by_table
+        res, seen = [], set()
+        for ds in data_samples:
+            if ds.omero_id in seen:
+                continue
+            seen.add(ds.omero_id)
+            for set_vid, vid, row_index in dos_by_sample.get(ds.omero_id, []):
+                # rows are dropped once unwrapped
+                layout, row = gdo_rows.pop((set_vid, row_index))
+                if row['vid'] != vid:
+                    raise ValueError('gdo %s not found in row %d of %s' %
+                                     (vid, row_index, set_vid))
+                res.append((ds, set_vid,
+                            self._unwrap_gdo(row, indices, layout)))
+        return res
+
+    def _get_gdo_iterator(self, set_vid, indices=None, batch_size=None):
+        layout = self._get_gdo_layout(set_vid)
+        def iterator(blocks):
+          for block in blocks:
+            for d in block:
+              yield self._unwrap_gdo(d, indices, layout)
         table_name = self._markers_array_table_name(GDO_TABLE_NAME, set_vid)
         return iterator(
-          self.kb.get_table_rows_iterator(table_name, batch_size=batch_size)
-          )
+          self.kb.get_table_blocks_iterator(
+            table_name, col_names=self._gdo_col_names(layout, indices),
+            batch_size=batch_size
+            ))
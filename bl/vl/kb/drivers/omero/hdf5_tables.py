@@ -0,0 +1,409 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Local HDF5 tables
+=================
+
+A table backend that keeps each table in a local HDF5 file, with the
+same API as the OMERO.tables support in
+:class:`~bl.vl.kb.drivers.omero.proxy_core.ProxyCore`. Columns are
+described by the same tuples passed to ``ProxyCore.create_table``,
+selectors are PyTables conditions just as with OMERO.tables and rows
+are returned with the same numpy record types. This makes it possible
+to run and profile table-heavy code without an OMERO server:
+
+.. code-block:: python
+
+   kb = KB(driver='omero')(host, user, passwd,
+                           table_backend=HDF5TableBackend('/tmp/tables'))
+
+Requires `PyTables <http://www.pytables.org>`_ >= 3.0.
+"""
+
+import os, errno
+import itertools as it
+from contextlib import contextmanager
+
+import numpy as np
+import tables
+import omero.grid
+
+import bl.vl.kb as kb
+from proxy_core import ProxyCore, convert_type, dtype_to_ome_table_column, \
+     convert_from_numpy, TABLE_BYTE_BUDGET, MAX_BATCH_SIZE, MAX_SELECTOR_TERMS
+
+
+TABLE_NODE = 'table'
+
+ARRAY_COLUMN = {
+  np.dtype(np.float32): omero.grid.FloatArrayColumn,
+  np.dtype(np.float64): omero.grid.DoubleArrayColumn,
+  np.dtype(np.int64): omero.grid.LongArrayColumn,
+  }
+
+
+def ome_dtype_to_columns(ome_dtype):
+  """
+  Return the OMERO.tables column objects matching ome_dtype, a list
+  of (name, type) pairs as returned by get_table_headers.
+  """
+  columns = []
+  for name, t in ome_dtype:
+    if t == 'i8':
+      columns.append(omero.grid.LongColumn(name, ''))
+    elif t == 'f8':
+      columns.append(omero.grid.DoubleColumn(name, ''))
+    elif t == 'b':
+      columns.append(omero.grid.BoolColumn(name, ''))
+    else:
+      dtype = np.dtype(t)
+      if dtype.subdtype:
+        base, shape = dtype.subdtype
+        columns.append(ARRAY_COLUMN[base](name, '', shape[0]))
+      else:
+        columns.append(omero.grid.StringColumn(name, '', dtype.itemsize))
+  return columns
+
+
+class HDF5Table(object):
+  """
+  Handle on a local HDF5 table, returned where ProxyCore returns an
+  OMERO.tables handle. Only the calls that do not exchange
+  omero.grid.Data are supported: read and write through the backend's
+  table API instead.
+  """
+
+  def __init__(self, backend, table_name):
+    self.backend = backend
+    self.table_name = table_name
+
+  def getNumberOfRows(self):
+    return self.backend.get_number_of_rows(self.table_name)
+
+  def getHeaders(self):
+    return ome_dtype_to_columns(
+      self.backend.get_table_headers(self.table_name)
+      )
+
+  def close(self):
+    pass
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    raise kb.KBError('%s is not supported by local HDF5 tables, use the '
+                     'table API of the kb' % name)
+
+
+class HDF5TableBackend(object):
+  """
+  Table storage on local HDF5 files, one file per table, all kept
+  within root_dir.
+  """
+
+  def __init__(self, root_dir, table_byte_budget=TABLE_BYTE_BUDGET):
+    self.root_dir = root_dir
+    self.table_byte_budget = table_byte_budget
+    try:
+      os.makedirs(root_dir)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  def _path(self, table_name):
+    return os.path.join(self.root_dir, table_name)
+
+  @contextmanager
+  def _open(self, table_name, mode='r'):
+    path = self._path(table_name)
+    if not os.path.exists(path):
+      raise kb.KBError('the requested %s table is missing' % table_name)
+    f = tables.open_file(path, mode)
+    try:
+      yield f.get_node('/', TABLE_NODE)
+    finally:
+      f.close()
+
+  def _batch_size(self, dtype, batch_size=None):
+    if batch_size:
+      return batch_size
+    return max(1, min(MAX_BATCH_SIZE,
+                      self.table_byte_budget // max(1, dtype.itemsize)))
+
+  @staticmethod
+  def _ome_dtype(table, col_names=None):
+    ome_dtype = table.attrs.ome_dtype
+    if col_names:
+      by_name = dict(ome_dtype)
+      for name in col_names:
+        if name not in by_name:
+          raise ValueError('%s not in table' % name)
+      ome_dtype = [(name, by_name[name]) for name in col_names]
+    return np.dtype(ome_dtype)
+
+  @staticmethod
+  def _to_ome(rows, ome_dtype):
+    res = np.zeros(len(rows), dtype=ome_dtype)
+    for name in ome_dtype.names:
+      res[name] = rows[name]
+    return res
+
+  @staticmethod
+  def _to_storage(table, records):
+    res = np.zeros(len(records), dtype=table.dtype)
+    for name in table.dtype.names:
+      res[name] = records[name]
+    return res
+
+  def _dicts_to_storage(self, table, dicts):
+    res = np.zeros(len(dicts), dtype=table.dtype)
+    for i, d in enumerate(dicts):
+      for name in table.dtype.names:
+        res[i][name] = d[name]
+    return res
+
+  #----------------------------------------------------------------------------
+
+  def create_table(self, table_name, fields):
+    ofields = [ProxyCore.OME_TABLE_COLUMN[f[0]](*f[1:]) for f in fields]
+    return self._create_table(table_name, ofields)
+
+  def _get_table(self, session, table_name):
+    """
+    Return a handle to table_name. session is ignored: it is only
+    there to match ProxyCore._get_table.
+    """
+    if not self.table_exists(table_name):
+      raise kb.KBError('the requested %s table is missing' % table_name)
+    return HDF5Table(self, table_name)
+
+  _open_table = _get_table
+
+  def _create_table(self, table_name, ofields):
+    path = self._path(table_name)
+    if os.path.exists(path):
+      raise kb.KBError('table %s already exists' % table_name)
+    ome_dtype = [(c.name, convert_type(c)) for c in ofields]
+    # OMERO maps bool columns to int8 numpy fields: store them as real
+    # bools, so that selectors such as (valid == True) work as expected
+    storage_dtype = [(n, '?' if t == 'b' else t) for n, t in ome_dtype]
+    f = tables.open_file(path, 'w')
+    try:
+      t = f.create_table('/', TABLE_NODE, np.dtype(storage_dtype))
+      t.attrs.ome_dtype = ome_dtype
+    finally:
+      f.close()
+    return HDF5Table(self, table_name)
+
+  def table_exists(self, table_name):
+    return os.path.exists(self._path(table_name))
+
+  def delete_table(self, table_name):
+    if self.table_exists(table_name):
+      os.remove(self._path(table_name))
+
+  def get_number_of_rows(self, table_name):
+    "returns the number of rows of table table_name"
+    with self._open(table_name) as t:
+      return t.nrows
+
+  def get_table_headers(self, table_name):
+    with self._open(table_name) as t:
+      return list(t.attrs.ome_dtype)
+
+  def store_as_a_table(self, table_name, records, batch_size=None):
+    """
+    Creates a new table called table_name and store in it the
+    contents of records, a numpy records array.
+    """
+    if not hasattr(records, 'dtype') or records.dtype.type != np.void:
+      raise ValueError('records is not a numpy records array')
+    dtype = records.dtype
+    fields = [dtype_to_ome_table_column(k, dtype.fields[k][0])
+              for k in records.dtype.names]
+    self._create_table(table_name, fields)
+    self.add_table_rows(table_name, records, batch_size)
+
+  def read_whole_table(self, table_name, batch_size=None, n_readers=1):
+    """
+    Reads all data contained in the table called table_name and
+    return result as a numpy records array. Rows are read batch_size
+    at a time; reads are local, so n_readers is ignored.
+    """
+    with self._open(table_name) as t:
+      ome_dtype = self._ome_dtype(t)
+      size = self._batch_size(ome_dtype, batch_size)
+      res = np.zeros(t.nrows, dtype=ome_dtype)
+      for i in xrange(0, t.nrows, size):
+        res[i:i+size] = self._to_ome(t.read(i, min(t.nrows, i + size)),
+                                     ome_dtype)
+      return res
+
+  #----------------------------------------------------------------------------
+
+  def add_table_row(self, table_name, row):
+    if hasattr(row, 'dtype'):
+      dtype = row.dtype
+      row = dict([(k, convert_from_numpy(row[k])) for k in dtype.names])
+    return self.add_table_rows_from_stream(table_name, iter([row]))
+
+  def add_table_rows(self, table_name, rows, batch_size=None):
+    with self._open(table_name, 'a') as t:
+      first_index = t.nrows
+      batch_size = self._batch_size(t.dtype, batch_size)
+      for offset in xrange(0, len(rows), batch_size):
+        t.append(self._to_storage(t, rows[offset:offset+batch_size]))
+      t.flush()
+    return range(first_index, first_index + len(rows))
+
+  def add_table_rows_from_stream(self, table_name, stream, batch_size=None):
+    indices = []
+    with self._open(table_name, 'a') as t:
+      batch_size = self._batch_size(t.dtype, batch_size)
+      while True:
+        batch = list(it.islice(stream, batch_size))
+        if not batch:
+          break
+        indices.extend(range(t.nrows, t.nrows + len(batch)))
+        t.append(self._dicts_to_storage(t, batch))
+      t.flush()
+    return indices
+
+  #----------------------------------------------------------------------------
+
+  @staticmethod
+  def _where(table, selector):
+    if isinstance(selector, str):
+      selector = [selector]
+    ids = set()
+    for i in xrange(0, len(selector), MAX_SELECTOR_TERMS):
+      condition = '|'.join('(%s)' % s
+                           for s in selector[i:i+MAX_SELECTOR_TERMS])
+      ids.update(table.get_where_list(condition))
+    return np.array(sorted(ids), dtype=np.int64)
+
+  @staticmethod
+  def _read_coordinates(table, indices):
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) == 0:
+      return table.read(0, 0)
+    uniq, inverse = np.unique(indices, return_inverse=True)
+    return table.read_coordinates(uniq)[inverse]
+
+  def get_table_rows(self, table_name, selector=None, col_names=None,
+                     batch_size=None, n_readers=1):
+    """
+    selector can be one of None, a selection or a list of selections. In
+    the latter case, it is interpreted as an 'or' condition between
+    the list elements. Selected rows are returned in table order, each
+    of them only once.
+    """
+    with self._open(table_name) as t:
+      ome_dtype = self._ome_dtype(t, col_names)
+      if selector is None:
+        rows = t.read()
+      else:
+        rows = self._read_coordinates(t, self._where(t, selector))
+      res = self._to_ome(rows, ome_dtype)
+    return res if len(res) else []
+
+  def get_table_rows_by_indices(self, table_name, indices=None, col_names=None,
+                                batch_size=None, n_readers=1):
+    """
+    indices must be either None or a list of integer values.
+    """
+    if indices is None:
+      return self.get_table_rows(table_name, None, col_names)
+    with self._open(table_name) as t:
+      ome_dtype = self._ome_dtype(t, col_names)
+      res = self._to_ome(self._read_coordinates(t, indices), ome_dtype)
+    return res if len(res) else []
+
+  def get_table_slice(self, table_name, row_numbers, col_names=None,
+                      batch_size=None):
+    return self.get_table_rows_by_indices(table_name, row_numbers, col_names)
+
+  def get_table_rows_iterator(self, table_name, batch_size=None):
+    def iter_on_rows(blocks):
+      for Z in blocks:
+        for k in xrange(len(Z)):
+          yield Z[k]
+    return iter_on_rows(self.get_table_blocks_iterator(table_name,
+                                                       batch_size=batch_size))
+
+  def get_table_blocks_iterator(self, table_name, col_names=None,
+                                batch_size=None, prefetch=2):
+    """
+    Return an iterator over the rows of table table_name, as a
+    sequence of numpy records arrays of at most batch_size rows
+    each. Reads are local, so prefetch is ignored.
+    """
+    if not self.table_exists(table_name):
+      raise kb.KBError('the requested %s table is missing' % table_name)
+    def iter_on_blocks():
+      with self._open(table_name) as t:
+        ome_dtype = self._ome_dtype(t, col_names)
+        size = self._batch_size(ome_dtype, batch_size)
+        for i in xrange(0, t.nrows, size):
+          yield self._to_ome(t.read(i, min(t.nrows, i + size)), ome_dtype)
+    return iter_on_blocks()
+
+  #----------------------------------------------------------------------------
+
+  def update_table_row(self, table_name, selector, row):
+    if hasattr(row, 'dtype'):
+      dtype = row.dtype
+      row = dict([(k, convert_from_numpy(row[k])) for k in dtype.names])
+    with self._open(table_name, 'a') as t:
+      idxs = t.get_where_list(selector)
+      if not len(idxs) == 1:
+        raise ValueError('selector %s does not yield a single row' % selector)
+      data = t.read_coordinates(idxs)
+      for k in data.dtype.names:
+        if k in row:
+          data[0][k] = row[k]
+      t.modify_coordinates(idxs, data)
+      t.flush()
+
+  def update_table_rows(self, table_name, selector, update_items,
+                        batch_size=None):
+    with self._open(table_name, 'a') as t:
+      for x in update_items.keys():
+        if x not in t.dtype.names:
+          raise ValueError('%s is not a valid field for table %s' %
+                           (x, table_name))
+      idxs = t.get_where_list(selector)
+      if len(idxs) == 0:
+        return
+      data = t.read_coordinates(idxs)
+      for k, v in update_items.iteritems():
+        data[k] = v
+      t.modify_coordinates(idxs, data)
+      t.flush()
+
+  def update_table_rows_by_indices(self, table_name, indices, records,
+                                   batch_size=None):
+    """
+    Overwrite the rows of table table_name listed in indices with the
+    corresponding elements of records, a numpy records array with the
+    same length as indices. Only the columns matching a field of
+    records are modified.
+    """
+    if len(indices) != len(records):
+      raise ValueError('indices and records must have the same length')
+    if len(indices) == 0:
+      return
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(np.unique(indices)) != len(indices):
+      raise ValueError('duplicate row indices')
+    with self._open(table_name, 'a') as t:
+      for x in records.dtype.names:
+        if x not in t.dtype.names:
+          raise ValueError('%s is not a valid field for table %s' %
+                           (x, table_name))
+      data = self._read_coordinates(t, indices)
+      for k in records.dtype.names:
+        data[k] = records[k]
+      t.modify_coordinates(indices, data)
+      t.flush()
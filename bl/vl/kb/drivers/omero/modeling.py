@@ -2,45 +2,54 @@
 # END_COPYRIGHT
 
 import wrapper as wp
+from proxy_core import QUERY_PAGE_SIZE
 
 
 class ModelingAdapter(object):
 
   def __init__(self, kb):
     self.kb = kb
+    self.__by_label = {}
+
+  def __get_by_label(self, table, label):
+    # Setup objects are looked up over and over by label: results are
+    # remembered for as long as they are still in the KB object cache
+    # (deleted objects are dropped from it) and keep the same label.
+    o = self.__by_label.get((table, label))
+    if (o is not None and self.kb.get_from_cache(o.ome_obj) is o and
+        o.is_loaded() and o.label == label):
+      return o
+    query = 'select o from %s o where o.label = :label' % table
+    pars = self.kb.ome_query_params({'label': wp.ome_wrap(label, wp.STRING)})
+    result = self.kb.ome_operation("getQueryService", "findByQuery",
+                                   query, pars)
+    if result is None:
+      self.__by_label.pop((table, label), None)
+      return None
+    o = self.kb.factory.wrap(result)
+    self.__by_label[(table, label)] = o
+    return o
 
   def get_device(self, label):
     """
     Return the Device object labeled 'label' or None if nothing
     matches 'label'.
     """
-    query = 'select d from Device d where d.label = :label'
-    pars = self.kb.ome_query_params({'label': wp.ome_wrap(label, wp.STRING)})
-    result = self.kb.ome_operation("getQueryService", "findByQuery",
-                                   query, pars)
-    return None if result is None else self.kb.factory.wrap(result)
+    return self.__get_by_label('Device', label)
 
   def get_action_setup(self, label):
     """
     Return the ActionSetup object labeled 'label' or None if nothing
     matches 'label'.
     """
-    query = 'select a from ActionSetup a where a.label = :label'
-    pars = self.kb.ome_query_params({'label': wp.ome_wrap(label, wp.STRING)})
-    result = self.kb.ome_operation("getQueryService", "findByQuery",
-                                   query, pars)
-    return None if result is None else self.kb.factory.wrap(result)
+    return self.__get_by_label('ActionSetup', label)
 
   def get_study(self, label):
     """
     Return the Study object labeled 'label' or None if nothing
     matches 'label'.
     """
-    query = 'select st from Study st where st.label = :label'
-    pars = self.kb.ome_query_params({'label': wp.ome_wrap(label, wp.STRING)})
-    result = self.kb.ome_operation("getQueryService", "findByQuery",
-                                   query, pars)
-    return None if result is None else self.kb.factory.wrap(result)
+    return self.__get_by_label('Study', label)
 
   def get_vessel(self, label):
     """
@@ -114,6 +123,32 @@ class ModelingAdapter(object):
                                     query, pars)
     return [self.kb.factory.wrap(o) for o in results]
 
+  def get_objects_iterator(self, klass, page_size=QUERY_PAGE_SIZE):
+    """
+    Iterate over all objects of class klass (including subclasses),
+    in id order, fetching page_size objects at a time. Each page
+    starts from the last id seen, so the cost of a page does not grow
+    with the number of objects already read.
+    """
+    query = 'from %s o where o.id > :last_id order by o.id' % \
+            klass.get_ome_table()
+    last_id = -1
+    while True:
+      pars = self.kb.ome_query_params({
+        'last_id': wp.ome_wrap(last_id, wp.LONG),
+        })
+      pars.page(0, page_size)
+      results = self.kb.ome_operation('getQueryService', 'findAllByQuery',
+                                      query, pars)
+      if not results:
+        break
+      for o in results:
+        yield self.kb.factory.wrap(o)
+      if len(results) < page_size:
+        break
+      last_id = results[-1].id.val
+      del results
+
   def get_enrolled(self, study):
     query = """select e
     from Enrollment e
@@ -189,7 +224,7 @@ class ModelingAdapter(object):
       query = "select v from %s v" % klass.get_ome_table()
       pars = None
     elif isinstance(content, self.kb.VesselContent):
-      value = content.ome_obj.value._val
+      value = content.enum_label()
       query = """select v from %s v join fetch v.content as c
       where c.value = :cvalue
       """ % klass.get_ome_table()
@@ -0,0 +1,101 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Object cache
+============
+
+The cache of wrapped KB objects kept by each
+:class:`~bl.vl.kb.drivers.omero.proxy_core.ProxyCore` instance, keyed
+by :func:`~bl.vl.utils.ome_utils.ome_hash`.
+
+At most max_size objects are strongly referenced, in least recently
+used order. Evicted objects are also tracked through weak references,
+so they can still be found for as long as they are alive elsewhere in
+the program: this way, the same OMERO object keeps being wrapped by the
+same KB object while the memory held by the cache stays bounded.
+"""
+
+import threading, weakref
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+class ObjectCache(object):
+
+  def __init__(self, max_size):
+    if max_size < 1:
+      raise ValueError('cache size must be a positive number')
+    self.max_size = max_size
+    self.__lru = OrderedDict()
+    self.__weak = weakref.WeakValueDictionary()
+    self.__lock = threading.RLock()
+    self.hits = self.misses = self.evictions = self.invalidations = 0
+
+  def __len__(self):
+    return len(self.__lru)
+
+  def __contains__(self, key):
+    with self.__lock:
+      return key in self.__lru or key in self.__weak
+
+  def __getitem__(self, key):
+    o = self.get(key, _MISSING)
+    if o is _MISSING:
+      raise KeyError(key)
+    return o
+
+  def get(self, key, default=None):
+    with self.__lock:
+      o = self.__lru.pop(key, _MISSING)
+      if o is _MISSING:
+        o = self.__weak.get(key, _MISSING)
+      if o is _MISSING:
+        self.misses += 1
+        return default
+      self.hits += 1
+      self.__store(key, o)
+      return o
+
+  def put(self, key, obj):
+    with self.__lock:
+      self.__lru.pop(key, None)
+      self.__store(key, obj)
+
+  def __store(self, key, obj):
+    self.__lru[key] = obj
+    try:
+      self.__weak[key] = obj
+    except TypeError:
+      pass  # not weakly referenceable, only kept while in the LRU
+    while len(self.__lru) > self.max_size:
+      self.__lru.popitem(last=False)
+      self.evictions += 1
+
+  def invalidate(self, key):
+    with self.__lock:
+      found = self.__lru.pop(key, _MISSING) is not _MISSING
+      found = self.__weak.pop(key, _MISSING) is not _MISSING or found
+      if found:
+        self.invalidations += 1
+
+  def clear(self):
+    with self.__lock:
+      self.__lru.clear()
+      self.__weak.clear()
+
+  def stats(self):
+    """
+    Return a dictionary with the cache counters and current size.
+    """
+    with self.__lock:
+      return {
+        'size': len(self.__lru),
+        'max_size': self.max_size,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'invalidations': self.invalidations,
+        }
@@ -2,19 +2,28 @@
 # END_COPYRIGHT
 
 import hashlib, time, pwd, json, os
+import itertools as it
 from importlib import import_module
+from multiprocessing.pool import ThreadPool
 
 # This is actually used in the metaclass magic
 import omero.model as om
+import omero.rtypes as ort
+from omero_version import omero_version
+
+import bl.vl
 
 import bl.vl.utils as vlu
+import bl.vl.utils.graph as grconf
 import bl.vl.kb.config as blconf
 from bl.vl.kb.messages import get_events_sender
 from bl.vl.kb.dependency import DependencyTree
 from bl.vl.kb import mimetypes
 
-from proxy_core import ProxyCore
-from wrapper import ObjectFactory, MetaWrapper
+from proxy_core import ProxyCore, TABLE_BYTE_BUDGET, TABLE_POOL_SIZE, \
+     CACHE_SIZE, QUERY_PAGE_SIZE
+from wrapper import ObjectFactory, MetaWrapper, ome_wrap, WRAPPING
+from enum_cache import EnumCache
 import action
 import vessels
 import objects_collections
@@ -40,9 +49,22 @@ from admin import Admin
 
 EXTRA_MODULES_ENV = 'OMERO_BIOBANK_EXTRA_MODULES'
 NO_VCHECK_ENV = 'OMERO_BIOBANK_NO_VCHECK'
+LOCAL_TABLES_ENV = 'OMERO_BIOBANK_LOCAL_TABLES'
+ENUM_CACHE_ENV = 'OMERO_BIOBANK_ENUM_CACHE'
 
 KOK = MetaWrapper.__KNOWN_OME_KLASSES__
 BATCH_SIZE = 5000
+# Reference paths followed by OmeroWrapper.__dump_to_graph__.
+GRAPH_REFERENCES = ['action.target.dataSample', 'action.target.vessel',
+                    'action.device']
+# Default number of values looked up by a single get_by_field query.
+QUERY_BATCH_SIZE = 2000
+# Upper bound for the number of parameters bound to a single query,
+# kept below PostgreSQL's limit of 32767 per statement.
+MAX_QUERY_PARAMS = 30000
+# Upper bound for the number of OR'ed terms of a composite key query:
+# Hibernate parses and plans long disjunctions recursively.
+MAX_COMPOSITE_TERMS = 200
 
 
 class Proxy(ProxyCore):
@@ -50,11 +72,20 @@ class Proxy(ProxyCore):
   An OMERO driver for the knowledge base.
   """
   def __init__(self, host, user, passwd, group=None, session_keep_tokens=1,
-               check_ome_version=True, extra_modules=None):
+               check_ome_version=True, extra_modules=None,
+               table_byte_budget=TABLE_BYTE_BUDGET,
+               table_pool_size=TABLE_POOL_SIZE, table_backend=None,
+               session_pool_size=0, cache_size=CACHE_SIZE, enum_cache=None):
     if os.getenv(NO_VCHECK_ENV):
       check_ome_version = False
+    if table_backend is None and os.getenv(LOCAL_TABLES_ENV):
+      from hdf5_tables import HDF5TableBackend
+      table_backend = HDF5TableBackend(os.getenv(LOCAL_TABLES_ENV),
+                                       table_byte_budget)
     super(Proxy, self).__init__(host, user, passwd, group, session_keep_tokens,
-                                check_ome_version)
+                                check_ome_version, table_byte_budget,
+                                table_pool_size, table_backend,
+                                session_pool_size, cache_size)
     extra_modules = extra_modules or os.getenv(EXTRA_MODULES_ENV)
     if extra_modules:
       if isinstance(extra_modules, basestring):
@@ -66,6 +97,10 @@ class Proxy(ProxyCore):
           import_module(name)
         except ImportError:
           raise ImportError('Optional module "%s" not available' % name)
+    enum_cache = enum_cache or os.getenv(ENUM_CACHE_ENV)
+    if enum_cache:
+      key = '%s/%s/%s' % (host, omero_version, bl.vl.__version__)
+      self.enum_cache = EnumCache(enum_cache, key)
     self.factory = ObjectFactory(proxy=self)
     #-- learn
     for k in KOK:
@@ -78,7 +113,14 @@ class Proxy(ProxyCore):
     self.eadpt = EAVAdapter(self)
     self.admin = Admin(self)
     self.events_sender = get_events_sender(self.logger)
-    self.dt = DependencyTree(self)
+    self.__dt = None
+
+  @property
+  def dt(self):
+    # the graph driver may connect to its server: build it on first use
+    if self.__dt is None:
+      self.__dt = DependencyTree(self)
+    return self.__dt
 
   def __check_type(self, fname, ftype, val):
     if not isinstance(val, ftype):
@@ -103,6 +145,16 @@ class Proxy(ProxyCore):
   def find_all_by_query(self, query, params):
     return super(Proxy, self).find_all_by_query(query, params, self.factory)
 
+  def find_all_by_query_iterator(self, query, params,
+                                 page_size=QUERY_PAGE_SIZE):
+    return super(Proxy, self).find_all_by_query_iterator(
+      query, params, self.factory, page_size
+      )
+
+  def find_all_by_query_async(self, query, params):
+    return super(Proxy, self).find_all_by_query_async(query, params,
+                                                      self.factory)
+
   def get_by_vid(self, klass, vid):
     query = "from %s o where o.vid = :vid" % klass.get_ome_table()
     params = {"vid": vid}
@@ -111,48 +163,102 @@ class Proxy(ProxyCore):
       raise ValueError("%d kb objects map to %s" % (len(res), vid))
     return res[0]
 
-  def get_by_field(self, klass, field_name, values, batch_size=240):
+  def get_by_vid_async(self, klass, vid):
     """
-    FIXME returns a dictionary that map all v in values
-    for which exists an object o of class klass such that o.field_name == v
-    to o.
+    Like get_by_vid, but return a
+    :class:`~bl.vl.kb.drivers.omero.futures.KBFuture` for the object.
     """
-    def get_by_field_helper(values):
-      template = "from %s o where o.{} in (%s)".format(field_name)
-      query = template % (klass.get_ome_table(),
-                          ','.join(map(lambda x: "'%s'" % x, values)))
-      params = {}
-      res = self.find_all_by_query(query, params)
-      return dict(map(lambda o: (getattr(o, field_name), o), res))
-    def values_by_chunk():
-      offset = 0
-      while len(values[offset:]) > 0:
-        yield values[offset:offset+batch_size]
-        offset += batch_size
-
+    query = "from %s o where o.vid = :vid" % klass.get_ome_table()
+    def check(res):
+      if len(res) != 1:
+        raise ValueError("%d kb objects map to %s" % (len(res), vid))
+      return res[0]
+    return self.find_all_by_query_async(query, {"vid": vid}).then(check)
+
+  def get_by_field(self, klass, field_name, values, batch_size=None,
+                   n_workers=1):
+    """
+    Return a dictionary that maps each v in values for which there
+    is an object o of class klass such that o.field_name == v to o.
+
+    field_name can also be a sequence of field names, in which case
+    values must be tuples with one element per field, and objects are
+    matched on all of them (composite keys).
+
+    Values are passed to the server as bound query parameters, in
+    chunks of batch_size (QUERY_BATCH_SIZE by default), never exceeding
+    MAX_QUERY_PARAMS parameters per query, nor MAX_COMPOSITE_TERMS
+    values per query for composite keys; batch_size=0 means as many
+    as allowed. If n_workers is greater than one and the session pool
+    is enabled, up to n_workers chunks are run concurrently.
+    """
+    composite = not isinstance(field_name, basestring)
+    fields = list(field_name) if composite else [field_name]
+    wtypes = []
+    for f in fields:
+      ftype = klass.get_field_type(f)
+      wtypes.append(ftype if ftype in WRAPPING else None)
+    values = list(set(values))
     if len(values) == 0:
       return {}
-    if batch_size == 0:
-      return get_by_field_helper(values)
+    if composite:
+      max_size = min(MAX_QUERY_PARAMS // len(fields), MAX_COMPOSITE_TERMS)
     else:
-      return reduce(lambda x, y: x.update(y) or x,
-                    map(get_by_field_helper, values_by_chunk()))
+      max_size = MAX_QUERY_PARAMS
+    if batch_size is None:
+      batch_size = QUERY_BATCH_SIZE
+    size = min(batch_size or max_size, max_size, len(values))
+    def make_query(n):
+      if composite:
+        terms = ' or '.join(
+          '(%s)' % ' and '.join('o.%s = :%s%d' % (f, f, i) for f in fields)
+          for i in xrange(n)
+          )
+      else:
+        terms = 'o.%s in (:%s)' % (field_name, field_name)
+      return 'from %s o where %s' % (klass.get_ome_table(), terms)
+    def key(o):
+      if composite:
+        return tuple(getattr(o, f) for f in fields)
+      return getattr(o, field_name)
+    def get_by_field_helper(chunk):
+      query = make_query(len(chunk))
+      if composite:
+        params = {}
+        for i, v in enumerate(chunk):
+          for f, wtype, x in it.izip(fields, wtypes, v):
+            params['%s%d' % (f, i)] = ome_wrap(x, wtype)
+      else:
+        params = {field_name: ort.rlist([ome_wrap(v, wtypes[0])
+                                         for v in chunk])}
+      return dict((key(o), o) for o in self.find_all_by_query(query, params))
+    chunks = [values[i:i+size] for i in xrange(0, len(values), size)]
+    n_workers = min(n_workers, len(chunks))
+    if n_workers > 1 and self.session_pool is not None:
+      pool = ThreadPool(n_workers)
+      try:
+        results = pool.map(get_by_field_helper, chunks)
+      finally:
+        pool.close()
+    else:
+      results = map(get_by_field_helper, chunks)
+    return reduce(lambda x, y: x.update(y) or x, results)
 
-  def get_by_vids(self, klass, vids, batch_size=240):
+  def get_by_vids(self, klass, vids, batch_size=None, n_workers=1):
     """
     FIXME Given a list of vids, returns a dictionary that map all vid
     in vids for which exists an object o of class klass such that o.vid == vid
     to o.
     """
-    return self.get_by_field(klass, 'vid', vids, batch_size)
+    return self.get_by_field(klass, 'vid', vids, batch_size, n_workers)
 
-  def get_by_labels(self, klass, labels, batch_size=240):
+  def get_by_labels(self, klass, labels, batch_size=None, n_workers=1):
     """
     FIXME Given a list of labels, returns a dictionary that map all
     label in labels for which exists an object o of class klass such
     that o.label == label, to o.
     """
-    return self.get_by_field(klass, 'label', labels, batch_size)
+    return self.get_by_field(klass, 'label', labels, batch_size, n_workers)
 
   def get_by_label(self, klass, label):
     res = self.get_by_labels(klass, [label])
@@ -163,6 +269,64 @@ class Proxy(ProxyCore):
                          (klass, label))
     return res[label]
 
+  def _prefetch_graph_references(self, objs):
+    # the in-memory graph ignores node and edge updates
+    if self.events_sender is not None or grconf.graph_driver() != 'pygraph':
+      self.prefetch(objs, GRAPH_REFERENCES)
+
+  def prefetch(self, objects, paths, batch_size=240):
+    """
+    Load the objects referenced by objects along each of paths, with
+    one query per referenced class (and per batch_size objects), so
+    that reading them later does not cost one server call per object:
+
+    .. code-block:: python
+
+      enrolls = kb.get_enrolled(study)
+      kb.prefetch(enrolls, ['individual'])
+      individuals = [e.individual for e in enrolls]
+
+    A path is a dot-separated sequence of reference fields, e.g.,
+    'action.target'. Objects that do not have a given field, or for
+    which it is not set, are skipped. Return objects.
+    """
+    if isinstance(paths, basestring):
+      paths = [paths]
+    for path in paths:
+      level = objects
+      for field in path.split('.'):
+        level = self.__prefetch_field(level, field, batch_size)
+    return objects
+
+  def __prefetch_field(self, objects, field, batch_size):
+    targets, missing = [], {}
+    for o in objects:
+      if not isinstance(o.get_field_type(field), type):
+        continue
+      v = getattr(o.ome_obj, field)
+      if v is None:
+        continue
+      cached = self.get_from_cache(v)
+      if cached is not None and cached.is_loaded():
+        setattr(o.ome_obj, field, cached.ome_obj)
+        targets.append(cached)
+      elif v.loaded:
+        targets.append(self.factory.wrap(v))
+      else:
+        table = v.__class__.__name__[:-1]
+        missing.setdefault(table, {}).setdefault(v.id.val, []).append(o)
+    for table, owners in missing.iteritems():
+      ids = owners.keys()
+      for i in xrange(0, len(ids), batch_size):
+        query = 'from %s o where o.id in (%s)' % (
+          table, ','.join('%d' % x for x in ids[i:i+batch_size])
+          )
+        for r in self.find_all_by_query(query, None):
+          for o in owners[r.ome_obj.id.val]:
+            setattr(o.ome_obj, field, r.ome_obj)
+          targets.append(r)
+    return targets
+
   def create_global_tables(self, destructive=False):
     self.eadpt.create_ehr_table(destructive=destructive)
 
@@ -193,6 +357,9 @@ class Proxy(ProxyCore):
   def get_objects(self, klass):
     return self.madpt.get_objects(klass)
 
+  def get_objects_iterator(self, klass, page_size=QUERY_PAGE_SIZE):
+    return self.madpt.get_objects_iterator(klass, page_size)
+
   def get_enrolled(self, study):
     return self.madpt.get_enrolled(study)
 
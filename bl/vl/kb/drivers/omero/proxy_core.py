@@ -3,7 +3,10 @@
 
 from bl.vl.utils import get_logger
 
+import sys, copy, threading, Queue
 import itertools as it
+from collections import OrderedDict
+from contextlib import contextmanager
 import numpy as np
 
 import omero
@@ -17,10 +20,42 @@ import omero_SharedResources_ice
 import bl.vl.kb as kb
 from bl.vl.utils.ome_utils import ome_hash
 
-from wrapper import ome_wrap
+from wrapper import ome_wrap, MetaWrapper
+from session_pool import SessionPool
+from object_cache import ObjectCache
+from futures import KBFuture, ice_call
 
 
 BATCH_SIZE = 5000
+# Upper bound, in bytes, for the data moved by a single OMERO.tables
+# call (read, slice, readCoordinates, addData, update). It must stay
+# well below the Ice.MessageSizeMax configured on client and server.
+TABLE_BYTE_BUDGET = 8 * 2**20
+MAX_BATCH_SIZE = 100000
+# Maximum number of open table handles kept by a ProxyCore instance.
+TABLE_POOL_SIZE = 16
+# Maximum number of KB objects strongly referenced by the object cache.
+CACHE_SIZE = 50000
+# Number of objects fetched by each query of a paginated iterator.
+QUERY_PAGE_SIZE = 1000
+# Maximum number of deletions in flight at the same time in delete_array.
+DELETE_CHUNK_SIZE = 100
+# Suggested number of objects sent by each saveAndReturnArray call,
+# for save_array callers that opt in to chunking.
+SAVE_CHUNK_SIZE = 1000
+# Maximum number of selectors OR-ed together in a single getWhereList.
+MAX_SELECTOR_TERMS = 32
+# Table methods that are routed to an alternative table backend, if any.
+TABLE_API = [
+  'create_table', 'store_as_a_table', 'read_whole_table', 'table_exists',
+  'delete_table', 'get_number_of_rows', 'get_table_headers',
+  'add_table_row', 'add_table_rows', 'add_table_rows_from_stream',
+  'get_table_rows', 'get_table_rows_by_indices', 'get_table_slice',
+  'get_table_rows_iterator', 'get_table_blocks_iterator',
+  'update_table_row', 'update_table_rows', 'update_table_rows_by_indices',
+  ]
+# table handle accessors, also routed to a table backend
+TABLE_HANDLE_API = ['_create_table', '_get_table', '_open_table']
 
 
 def convert_type(o):
@@ -61,6 +96,66 @@ def convert_coordinates_to_np(d):
 def convert_to_numpy_record_type(d):
   return [(c.name, convert_type(c)) for c in d]
 
+def get_row_size(col_objs):
+  """
+  Return the size, in bytes, of a table row described by col_objs.
+  """
+  return np.dtype(convert_to_numpy_record_type(col_objs)).itemsize
+
+def adaptive_batch_size(col_objs, byte_budget=TABLE_BYTE_BUDGET,
+                        max_batch_size=MAX_BATCH_SIZE):
+  """
+  Return the number of rows, with the layout described by col_objs,
+  that can be moved in a single call without exceeding byte_budget.
+  """
+  row_size = max(1, get_row_size(col_objs))
+  return max(1, min(max_batch_size, byte_budget // row_size))
+
+def prefetch_iterator(iterator, depth=2):
+  """
+  Iterate over iterator while a background thread keeps up to depth
+  of its items ready. Exceptions raised by iterator are re-raised in
+  the consumer thread. The background thread starts with the first
+  request for an item and stops when the returned generator is
+  exhausted or closed.
+  """
+  queue = Queue.Queue(maxsize=depth)
+  stop = threading.Event()
+  end = object()
+  def put(item):
+    while not stop.is_set():
+      try:
+        queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+  def worker():
+    try:
+      for x in iterator:
+        if not put((x, None)):
+          break
+      else:
+        put((end, None))
+    except Exception:
+      put((None, sys.exc_info()))
+    finally:
+      if hasattr(iterator, 'close'):
+        iterator.close()
+  thread = threading.Thread(target=worker)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      x, exc_info = queue.get()
+      if exc_info:
+        raise exc_info[0], exc_info[1], exc_info[2]
+      if x is end:
+        break
+      yield x
+  finally:
+    stop.set()
+
 def convert_from_numpy(x):
   if isinstance(x, np.int64):
     return int(x)
@@ -78,6 +173,15 @@ class ProxyCore(object):
   session unless you are using Java. For this reason, we open a new
   session for each new operation on the database and close it when we
   are done, forcing the server to release the allocated memory.
+
+  If session_pool_size is greater than zero, queries and table
+  operations are instead carried out over a pool of up to
+  session_pool_size long-lived sessions (see
+  :class:`~bl.vl.kb.drivers.omero.session_pool.SessionPool`), each
+  thread checking out its own: this allows a single instance to be
+  shared among worker threads. Pooled sessions are bound to the group
+  given at construction time: with the pool enabled, change_group
+  and change_to_user_default_group refuse to move to another group.
   """
 
   OME_TABLE_COLUMN = {
@@ -89,37 +193,53 @@ class ProxyCore(object):
     'double_array': omero.grid.DoubleArrayColumn,
     'long_array': omero.grid.LongArrayColumn,
     }
-  _CACHE = {}
+  events_sender = None
+  # hosts whose OMERO version has already been checked by this process
+  _checked_hosts = set()
 
   def store_to_cache(self, obj):
-    self.__class__._CACHE[ome_hash(obj.ome_obj)] = obj
+    self.object_cache.put(ome_hash(obj.ome_obj), obj)
 
   def del_from_cache(self, ome_obj):
-    try:
-      del self.__class__._CACHE[ome_hash(ome_obj)]
-    except KeyError:
-      pass
+    self.object_cache.invalidate(ome_hash(ome_obj))
 
   def get_from_cache(self, ome_obj):
-    return self._CACHE.get(ome_hash(ome_obj))
+    return self.object_cache.get(ome_hash(ome_obj))
 
   def clear_cache(self):
-    self.__class__._CACHE.clear()
+    self.object_cache.clear()
 
-  def __check_omero_version(self):
-    s = self.connect()
-    conf = s.getConfigService()
+  def cache_stats(self):
+    """
+    Return the object cache counters (hits, misses, evictions and
+    invalidations) together with its current and maximum size.
+    """
+    return self.object_cache.stats()
+
+  def __check_omero_version(self, session):
+    """
+    Check the server version on the first session opened for a host:
+    the check is done once per process and does not require a session
+    of its own.
+    """
+    if not self.__version_unchecked:
+      return
+    conf = session.getConfigService()
     server_version = conf.getConfigValue('omero.version')
     client_version = omero_version
-    self.disconnect()
     if server_version != client_version:
       raise kb.KBError(
         'OMERO client version %s doesn\'t match server version %s' %
         (client_version, server_version))
+    self.__version_unchecked = False
+    ProxyCore._checked_hosts.add(self.host)
 
   def __init__(self, host, user, passwd, group=None, session_keep_tokens=1,
-               check_ome_version=True):
+               check_ome_version=True, table_byte_budget=TABLE_BYTE_BUDGET,
+               table_pool_size=TABLE_POOL_SIZE, table_backend=None,
+               session_pool_size=0, cache_size=CACHE_SIZE):
     self.logger = get_logger('bl.vl.kb.drivers.omero.proxy_core')
+    self.host = host
     self.user = user
     self.passwd = passwd
     self.group_name = group
@@ -129,12 +249,32 @@ class ProxyCore(object):
     self.session_keep_tokens = session_keep_tokens
     self.transaction_tokens = 0
     self.current_session = None
-    if check_ome_version:
-        self.__check_omero_version()
+    self.object_cache = ObjectCache(cache_size)
+    self.table_byte_budget = table_byte_budget
+    self.table_pool_size = table_pool_size
+    self._tables = OrderedDict()
+    self._session_tables = {}
+    self._tables_lock = threading.Lock()
+    self._local = threading.local()
+    self.session_pool = None
+    if session_pool_size > 0:
+      self.session_pool = SessionPool(host, user, passwd, group,
+                                      session_pool_size)
+    self.table_backend = None
+    if table_backend is not None:
+      self.set_table_backend(table_backend)
+    # the session is opened, and the version checked, on first use
+    self.__version_unchecked = (check_ome_version and
+                                host not in ProxyCore._checked_hosts)
     self.context_managers = []
+    self.enum_cache = None
+    # enum classes whose ids were read from self.enum_cache
+    self.__cached_enums = set()
 
   def __del__(self):
+    self.close_session_pool()
     if self.current_session:
+      self.close_tables(self.current_session)
       self.client.closeSession()
 
   def push_context_manager(self, ctx_manager):
@@ -143,7 +283,13 @@ class ProxyCore(object):
   def pop_context_manager(self):
     self.context_managers.pop()
 
+  def __check_group_change(self, group_name):
+    if self.session_pool is not None and group_name != self.group_name:
+      raise kb.KBError('cannot change group with a session pool, '
+                       'pooled sessions stay in group %s' % self.group_name)
+
   def change_group(self, group_name):
+    self.__check_group_change(group_name)
     if not self.current_session:
       self.connect()
     a = self.current_session.getAdminService()
@@ -157,6 +303,7 @@ class ProxyCore(object):
                                  (self.user, group_name))
 
   def change_to_user_default_group(self):
+    self.__check_group_change(None)
     if not self.current_session:
       self.connect()
     a = self.current_session.getAdminService()
@@ -225,6 +372,12 @@ class ProxyCore(object):
     if not self.current_session:
       self.current_session = self.client.createSession(self.user, self.passwd)
       self.transaction_tokens = self.session_keep_tokens
+      try:
+        self.__check_omero_version(self.current_session)
+      except kb.KBError:
+        self.client.closeSession()
+        self.current_session = None
+        raise
       if self.group_name:
         self.change_group(self.group_name)
     self.transaction_tokens -= 1
@@ -232,10 +385,45 @@ class ProxyCore(object):
 
   def disconnect(self):
     if self.transaction_tokens <= 0:
+      self.close_tables(self.current_session)
       self.client.closeSession()
       self.current_session = None
       self.transaction_tokens = 0
 
+  @contextmanager
+  def _session(self):
+    """
+    Provide the session used by a single operation: the current session
+    or, if the session pool is enabled, one checked out from the pool
+    for the calling thread. Nested operations reuse the session already
+    held by the thread.
+    """
+    if self.session_pool is None:
+      yield self.connect()
+      return
+    s = getattr(self._local, 'session', None)
+    if s is not None:
+      yield s
+      return
+    with self.session_pool.session() as s:
+      self.__check_omero_version(s)
+      self._local.session = s
+      try:
+        yield s
+      finally:
+        self._local.session = None
+
+  def close_session_pool(self):
+    """
+    Close all pooled sessions, together with their table handles.
+    """
+    if getattr(self, 'session_pool', None) is None:
+      return
+    for s in self.session_pool.sessions():
+      self.close_tables(s)
+    self.session_pool.close()
+    self.session_pool = None
+
   def start_keep_alive(self, timeout=300):
     self.client.enableKeepAlive(timeout)
     self.client.startKeepAlive()
@@ -250,33 +438,117 @@ class ProxyCore(object):
     return params
 
   def ome_operation(self, operation, action, *action_args):
-    session = self.connect()
-    # try:
-    try:
-      service = getattr(session, operation)()
-    except AttributeError:
-      raise kb.KBError("%r kb operation not supported" % operation)
-    try:
-      result = getattr(service, action)(*action_args)
-    except AttributeError:
-      raise kb.KBError("%r kb action not supported on operation %r" %
-                       (action, operation))
-    # finally:
-    #   self.disconnect()
+    with self._session() as session:
+      try:
+        service = getattr(session, operation)()
+      except AttributeError:
+        raise kb.KBError("%r kb operation not supported" % operation)
+      try:
+        result = getattr(service, action)(*action_args)
+      except AttributeError:
+        raise kb.KBError("%r kb action not supported on operation %r" %
+                         (action, operation))
     return result
 
+  def ome_operation_async(self, operation, action, *action_args):
+    """
+    Like ome_operation, but return a
+    :class:`~bl.vl.kb.drivers.omero.futures.KBFuture` as soon as the
+    request has been sent.
+    """
+    with self._session() as session:
+      try:
+        service = getattr(session, operation)()
+      except AttributeError:
+        raise kb.KBError("%r kb operation not supported" % operation)
+      if not hasattr(service, action):
+        raise kb.KBError("%r kb action not supported on operation %r" %
+                         (action, operation))
+      return ice_call(service, action, *action_args)
+
+  def __wrap_query_params(self, params):
+    xpars = {}
+    for k,v in params.iteritems():
+      xpars[k] = ome_wrap(*v) if type(v) == tuple else ome_wrap(v)
+    return self.ome_query_params(xpars)
+
   def find_all_by_query(self, query, params, factory):
-    if params:
-      xpars = {}
-      for k,v in params.iteritems():
-        xpars[k] = ome_wrap(*v) if type(v) == tuple else ome_wrap(v)
-      pars = self.ome_query_params(xpars)
-    else:
-      pars = None
+    pars = self.__wrap_query_params(params) if params else None
     result = self.ome_operation("getQueryService", "findAllByQuery",
                                 query, pars)
     return [] if result is None else [factory.wrap(r) for r in result]
 
+  def find_all_by_query_async(self, query, params, factory):
+    pars = self.__wrap_query_params(params) if params else None
+    f = self.ome_operation_async("getQueryService", "findAllByQuery",
+                                 query, pars)
+    return f.then(lambda result: [] if result is None else
+                  [factory.wrap(r) for r in result])
+
+  def projection(self, query, params, fields):
+    """
+    Run query, an HQL select of scalar values such as 'select i.vid,
+    a.id from Individual i join i.action a', through
+    QueryService.projection and return the results as a numpy records
+    array, without wrapping any KB object.
+
+    fields is either a list with the names of the selected values, in
+    order, or a list of (name, numpy type) pairs, e.g., [('vid',
+    '|S40'), ('id', 'i8')]. In the former case, types are inferred from
+    the results. Null values become zeros or empty strings.
+    """
+    pars = self.__wrap_query_params(params) if params else None
+    rows = self.ome_operation('getQueryService', 'projection', query, pars)
+    columns = [[] for _ in fields]
+    for r in rows or []:
+      for c, x in it.izip(columns, r):
+        c.append(ort.unwrap(x))
+    del rows
+    if fields and not isinstance(fields[0], tuple):
+      fields = [(name, np.array([x for x in c if x is not None]).dtype)
+                for name, c in it.izip(fields, columns)]
+    records = np.zeros(len(columns[0]) if columns else 0, dtype=list(fields))
+    for (name, _), c in it.izip(fields, columns):
+      null = records.dtype[name].type()
+      records[name] = [null if x is None else x for x in c]
+    return records
+
+  def find_all_by_query_iterator(self, query, params, factory,
+                                 page_size=QUERY_PAGE_SIZE):
+    """
+    Iterate over the results of query, fetching them from the server
+    page_size at a time, so that memory usage does not depend on the
+    size of the whole result set.
+
+    Each page starts from the id of the last object seen, so that its
+    cost does not grow with the number of objects already read: query
+    must select objects with an id greater than :last_id, ordered by
+    id, e.g., 'select i from Individual i where i.id > :last_id and
+    i.action.id = :aid order by i.id'. The value of last_id is set
+    here and must not be given in params.
+    """
+    if ':last_id' not in query or 'order by' not in query.lower():
+      raise ValueError('query must filter on :last_id and order by id')
+    params = params or {}
+    if 'last_id' in params:
+      raise ValueError('last_id is set by find_all_by_query_iterator')
+    last_id = -1
+    while True:
+      pars = self.__wrap_query_params(params)
+      pars.add('last_id', ort.rlong(last_id))
+      pars.page(0, page_size)
+      result = self.ome_operation("getQueryService", "findAllByQuery",
+                                  query, pars)
+      if not result:
+        break
+      for r in result:
+        yield factory.wrap(r)
+      if len(result) < page_size:
+        break
+      last_id = result[-1].id.val
+      # release the current page before fetching the next one
+      del result
+
   def update_by_example(self, o):
     res = self.ome_operation('getQueryService', 'findByExample', o.ome_obj)
     if not res:
@@ -284,6 +556,86 @@ class ProxyCore(object):
     o.ome_obj = res
     o.proxy = self
 
+  def map_enums(self, *klasses):
+    """
+    Map the values of the given enum classes to their OMERO objects,
+    with one query per class.
+
+    If self.enum_cache is set, ids are read from there, and values are
+    mapped to unloaded OMERO objects with those ids. When a class is
+    missing from the cache, all enum classes that are not cached yet
+    are loaded, and the cache is updated. If saving objects that refer
+    to values mapped from the cache fails, save and save_array load
+    those classes from the server and try again.
+    """
+    to_load = []
+    for klass in klasses:
+      if all(o.is_mapped() for o in klass.__enums__):
+        continue
+      ids = None
+      if self.enum_cache is not None:
+        ids = self.enum_cache.get(klass.get_ome_table())
+      if ids is None or any(o.enum_label() not in ids
+                            for o in klass.__enums__):
+        to_load.append(klass)
+        continue
+      for o in klass.__enums__:
+        if not o.is_mapped():
+          o.ome_obj = klass.get_ome_type()(ids[o.enum_label()], False)
+          o.proxy = self
+      self.__cached_enums.add(klass)
+    if not to_load:
+      return
+    if self.enum_cache is not None:
+      to_load = set(to_load)
+      for klass in MetaWrapper.__KNOWN_OME_KLASSES__.itervalues():
+        if klass.is_enum() and (
+          self.enum_cache.get(klass.get_ome_table()) is None
+          ):
+          to_load.add(klass)
+    self.__load_enums(to_load)
+
+  def __load_enums(self, klasses):
+    loaded = {}
+    with self._session() as s:
+      qs = s.getQueryService()
+      for klass in klasses:
+        table = klass.get_ome_table()
+        res = qs.findAllByQuery('from %s e' % table, None) or []
+        by_label = dict((r.value._val, r) for r in res)
+        loaded[table] = dict((l, r.id._val) for l, r in by_label.iteritems())
+        for o in klass.__enums__:
+          try:
+            o.ome_obj = by_label[o.enum_label()]
+          except KeyError:
+            raise ValueError('cannot map %s.%s' % (table, o.enum_label()))
+          o.proxy = self
+    if self.enum_cache is not None:
+      self.enum_cache.update(loaded)
+
+  def __remap_cached_enums(self, objs):
+    """
+    Load from the server the enum classes that were mapped from
+    self.enum_cache, whose ids may be stale, and point the references
+    of objs to the loaded values. Return False if no class was mapped
+    from the cache.
+    """
+    if not self.__cached_enums:
+      return False
+    klasses, self.__cached_enums = self.__cached_enums, set()
+    self.logger.warn('reloading cached enums %s' %
+                     sorted(k.get_ome_table() for k in klasses))
+    # keep the old objects alive, so that their ids are not reused
+    stale = dict((id(o.ome_obj), (o.ome_obj, o))
+                 for k in klasses for o in k.__enums__)
+    self.__load_enums(klasses)
+    for obj in objs:
+      for f in obj.get_reference_fields():
+        _, o = stale.get(id(getattr(obj.ome_obj, f)), (None, None))
+        if o is not None:
+          setattr(obj.ome_obj, f, o.ome_obj)
+    return True
+
   # FIXME this is a hack
   def reload_object(self, o, fields=None):
     def load_ome_obj(ome_obj):
@@ -301,10 +653,53 @@ class ProxyCore(object):
     o.ome_obj = res
     o.proxy = self
 
+  def reload_many(self, objs, batch_size=QUERY_PAGE_SIZE):
+    """
+    Reload all (mapped) KB objects in objs, with one query per OMERO
+    table every batch_size objects. Objects of different classes can
+    be mixed. Wrappers of the same OMERO objects found in the cache
+    are refreshed too.
+    """
+    by_table = {}
+    for o in objs:
+      if not o.is_mapped():
+        raise ValueError('cannot reload unmapped object %s' % o)
+      tbl = o.ome_obj.__class__.__name__[:-1]
+      by_table.setdefault(tbl, {}).setdefault(o.ome_obj.id.val, []).append(o)
+    with self._session() as s:
+      qs = s.getQueryService()
+      for tbl, owners in by_table.iteritems():
+        ids = owners.keys()
+        for i in xrange(0, len(ids), batch_size):
+          query = 'from %s o where o.id in (%s)' % (
+            tbl, ','.join('%d' % x for x in ids[i:i+batch_size])
+            )
+          for res in qs.findAllByQuery(query, None) or []:
+            wrappers = owners.pop(res.id.val)
+            cached = self.get_from_cache(res)
+            if cached is not None and cached not in wrappers:
+              wrappers.append(cached)
+            for o in wrappers:
+              o.ome_obj = res
+              o.proxy = self
+            self.store_to_cache(cached or wrappers[0])
+        if owners:
+          raise ValueError('cannot load %s objects with ids %s' %
+                           (tbl, sorted(owners)))
+    return objs
+
   def save(self, obj):
     """
     Save and return a KB object.
     """
+    try:
+      return self.__save(obj)
+    except (kb.KBError, omero.ServerError):
+      if not self.__remap_cached_enums([obj]):
+        raise
+      return self.__save(obj)
+
+  def __save(self, obj):
     try:
       # check if we are saving a new object or if we are updating an
       # existing one
@@ -323,27 +718,173 @@ class ProxyCore(object):
       self.context_managers[-1].register(obj)
     return obj
 
-  def save_array(self, array):
+  def save_array(self, array, chunk_size=None):
     """
     Save and return an array of KB objects.
+
+    By default, the whole array is sent in a single call, so either
+    all objects are saved or none is. If chunk_size is given (see
+    SAVE_CHUNK_SIZE), objects are sent to the server chunk_size at a
+    time and each chunk is registered in the graph while the next one
+    is being saved, unless the next one refers to objects of the
+    former that were not saved yet: in that case, it is sent only
+    after those references have been replaced with the saved
+    objects. Each chunk is committed on its own: if a chunk fails,
+    the chunks before it, and the one already in flight, if it
+    succeeds, stay saved and registered in the graph, and the error
+    is raised once all started requests are complete.
+
+    If objects in array refer to unsaved objects that are not in array
+    (e.g., a new Action shared by all of them), the whole array is
+    sent in a single call, since each chunk would otherwise create its
+    own copy of the referenced objects.
     """
-    update = [obj.is_mapped() for obj in array]
+    saved = {}
+    try:
+      return self.__save_array(array, chunk_size, saved)
+    except (kb.KBError, omero.ServerError):
+      done = set(id(v) for _, v in saved.itervalues())
+      left = [o for o in array if id(o.ome_obj) not in done]
+      if not self.__remap_cached_enums(left):
+        raise
+      self.__save_array(left, chunk_size, {})
+      return array
+
+  def __save_array(self, array, chunk_size, saved):
+    if chunk_size is None:
+      chunk_size = len(array)
+    chunk_size = max(1, chunk_size)
+    if len(array) > chunk_size and self.__refers_to_unsaved(array):
+      chunk_size = len(array)
+    pending = None
+    with self._session() as s:
+      us = s.getUpdateService()
+      try:
+        for i in xrange(0, len(array), chunk_size):
+          chunk = array[i:i+chunk_size]
+          if pending is not None and self.__refers_to(chunk, pending[0]):
+            previous, pending = pending, None
+            self.__finish_save(us, previous, saved)
+          self.__replace_saved_references(chunk, saved)
+          update = [obj.is_mapped() for obj in chunk]
+          previous, pending = pending, (chunk, update,
+                                        self.__begin_save(us, chunk))
+          if previous is not None:
+            self.__finish_save(us, previous, saved)
+        previous, pending = pending, None
+        if previous is not None:
+          self.__finish_save(us, previous, saved)
+      finally:
+        if pending is not None:
+          self.__drain_save(us, pending, saved)
+    return array
+
+  def save_array_async(self, array):
+    """
+    Send array to the server in a single saveAndReturnArray call and
+    return a future for the saved array. Objects are registered in the
+    graph, and any error is raised, when the result is requested.
+    """
+    with self._session() as s:
+      us = s.getUpdateService()
+      pending = (array, [obj.is_mapped() for obj in array],
+                 self.__begin_save(us, array))
+    def finish():
+      self.__finish_save(us, pending, {})
+      return array
+    r = pending[2]
+    return KBFuture(finish, getattr(r, 'isCompleted', lambda: True))
+
+  @staticmethod
+  def __save_error(e):
+    msg = 'omero.ValidationException: %s' % e.message
+    return kb.KBError(msg)
+
+  def __begin_save(self, us, chunk):
+    ome_objs = [obj.ome_obj for obj in chunk]
     try:
-      result = self.ome_operation("getUpdateService", "saveAndReturnArray",
-                                  [obj.ome_obj for obj in array])
+      # Ice 3.3 does not provide the begin_/end_ asynchronous API
+      if hasattr(us, 'begin_saveAndReturnArray'):
+        return us.begin_saveAndReturnArray(ome_objs)
+      return us.saveAndReturnArray(ome_objs)
     except omero.ValidationException, e:
-      msg = 'omero.ValidationException: %s' % e.message
-      self.logger.error(msg)
-      raise kb.KBError(msg)
-    if len(result) != len(array):
+      self.logger.error('omero.ValidationException: %s' % e.message)
+      raise self.__save_error(e)
+
+  def __finish_save(self, us, pending, saved):
+    chunk, update, r = pending
+    try:
+      result = (us.end_saveAndReturnArray(r)
+                if hasattr(us, 'end_saveAndReturnArray') else r)
+    except omero.ValidationException, e:
+      self.logger.error('omero.ValidationException: %s' % e.message)
+      raise self.__save_error(e)
+    if len(result) != len(chunk):
       raise kb.KBError('bad return array len')
-    for o, v, u in it.izip(array, result, update):
+    for o, v in it.izip(chunk, result):
+      saved[id(o.ome_obj)] = (o.ome_obj, v)
       o.ome_obj = v
       self.store_to_cache(o)
+    self._prefetch_graph_references(chunk)
+    if self.events_sender is not None:
+      with self.events_sender.batch():
+        self.__register_saved(chunk, update)
+    else:
+      self.__register_saved(chunk, update)
+
+  def __drain_save(self, us, pending, saved):
+    # called while another error is being raised: complete the request
+    # in flight, and only log its own failure
+    try:
+      self.__finish_save(us, pending, saved)
+    except Exception, e:
+      self.logger.error('error while saving %d objects: %s' %
+                        (len(pending[0]), e))
+
+  def __register_saved(self, chunk, update):
+    for o, u in it.izip(chunk, update):
       o.__dump_to_graph__(u)
       if self.context_managers:
         self.context_managers[-1].register(o)
-    return array
+
+  @staticmethod
+  def __refers_to(chunk, previous):
+    ome_ids = set(id(o.ome_obj) for o in previous)
+    for o in chunk:
+      for f in o.get_reference_fields():
+        if id(getattr(o.ome_obj, f)) in ome_ids:
+          return True
+    return False
+
+  @staticmethod
+  def __refers_to_unsaved(array):
+    ome_ids = set(id(o.ome_obj) for o in array)
+    for o in array:
+      for f in o.get_reference_fields():
+        v = getattr(o.ome_obj, f)
+        if v is not None and v.id is None and id(v) not in ome_ids:
+          return True
+    return False
+
+  @staticmethod
+  def __replace_saved_references(chunk, saved):
+    if not saved:
+      return
+    for o in chunk:
+      for f in o.get_reference_fields():
+        v = getattr(o.ome_obj, f)
+        old, new = saved.get(id(v), (None, None))
+        if v is not None and old is v:
+          setattr(o.ome_obj, f, new)
+
+  def _prefetch_graph_references(self, objs):
+    """
+    Called by save_array before registering objs in the graph, and by
+    delete_array before deleting them: it can be overridden to load
+    the objects that __dump_to_graph__ and __cleanup__ will need with
+    as few queries as possible.
+    """
+    pass
 
   def delete(self, kb_obj):
     """
@@ -353,25 +894,116 @@ class ProxyCore(object):
     try:
       result = self.ome_operation("getUpdateService", "deleteObject",
                                   kb_obj.ome_obj)
-    except omero.ValidationException:
-      raise kb.KBError("object is referenced by one or more objects")
-    except omero.ApiUsageException:
-      raise kb.KBError("trying to delete non-persistent object")
-    except omero.SecurityViolation:
-      raise kb.KBError("deletion of the object not allowed")
+    except omero.ServerError, e:
+      raise self.__delete_error(e)
     else:
-      self.del_from_cache(kb_obj.ome_obj)
-      kb_obj.__cleanup__()
-      if self.context_managers:
-        self.context_managers[-1].deregister(kb_obj)
+      self.__cleanup_deleted(kb_obj)
     return result
 
+  def delete_array(self, array, chunk_size=DELETE_CHUNK_SIZE):
+    """
+    Delete an array of KB objects, in the given order.
+
+    Consecutive objects of the same class are deleted in chunks of
+    chunk_size: all deletions in a chunk are sent before waiting for
+    their replies, unless objects of that class can reference each
+    other. Graph cleanup is run after the server side deletion, with
+    all graph events sent as a single batch: the objects it needs
+    (e.g., actions and their targets) are loaded before anything is
+    deleted, since array may include them too.
+    """
+    array = list(array)
+    for o in array:
+      o.__precleanup__()
+    self._prefetch_graph_references(array)
+    deleted, error = [], None
+    try:
+      with self._session() as s:
+        us = s.getUpdateService()
+        for klass, run in it.groupby(array, type):
+          run = list(run)
+          size = 1 if klass.is_self_referencing() else max(1, chunk_size)
+          for i in xrange(0, len(run), size):
+            error = self.__delete_chunk(us, run[i:i+size], deleted)
+            if error is not None:
+              break
+          if error is not None:
+            break
+    finally:
+      if self.events_sender is not None:
+        with self.events_sender.batch():
+          self.__cleanup_deleted(*deleted)
+      else:
+        self.__cleanup_deleted(*deleted)
+    if error is not None:
+      raise error
+
+  @staticmethod
+  def __begin_delete(us, ome_obj):
+    # Ice 3.3 does not provide the begin_/end_ asynchronous API
+    if hasattr(us, 'begin_deleteObject'):
+      return us.begin_deleteObject(ome_obj)
+    us.deleteObject(ome_obj)
+    return None
+
+  def __delete_chunk(self, us, chunk, deleted):
+    """
+    Delete the objects in chunk, appending the ones actually deleted to
+    deleted. Return the error raised by the first failed deletion, if
+    any.
+    """
+    pending, error = [], None
+    for o in chunk:
+      try:
+        pending.append((o, self.__begin_delete(us, o.ome_obj)))
+      except omero.ServerError, e:
+        error = self.__delete_error(e)
+        break
+    for o, r in pending:
+      try:
+        if r is not None:
+          us.end_deleteObject(r)
+      except omero.ServerError, e:
+        error = error or self.__delete_error(e)
+      else:
+        deleted.append(o)
+    return error
+
+  @staticmethod
+  def __delete_error(e):
+    if isinstance(e, omero.ValidationException):
+      return kb.KBError("object is referenced by one or more objects")
+    elif isinstance(e, omero.ApiUsageException):
+      return kb.KBError("trying to delete non-persistent object")
+    elif isinstance(e, omero.SecurityViolation):
+      return kb.KBError("deletion of the object not allowed")
+    return e
+
+  def __cleanup_deleted(self, *kb_objs):
+    for o in kb_objs:
+      self.del_from_cache(o.ome_obj)
+      o.__cleanup__()
+      if self.context_managers:
+        self.context_managers[-1].deregister(o)
+
   #----------------------------------------------------------------------------
   #----------------------------------------------------------------------------
   #-- TABLES SUPPORT
   #----------------------------------------------------------------------------
   #----------------------------------------------------------------------------
 
+  def set_table_backend(self, backend):
+    """
+    Route all table operations listed in TABLE_API, and the handle
+    accessors in TABLE_HANDLE_API, to backend, e.g., a
+    :class:`~bl.vl.kb.drivers.omero.hdf5_tables.HDF5TableBackend`,
+    instead of OMERO.tables. The async table reads wrap the routed
+    synchronous ones.
+    """
+    for name in TABLE_API + TABLE_HANDLE_API:
+      setattr(self, name, getattr(backend, name))
+    self.table_backend = backend
+
   def _list_table_copies(self, table_name):
     return self.ome_operation('getQueryService', 'findAllByString',
                               'OriginalFile', 'name', table_name, True, None)
@@ -401,13 +1033,11 @@ class ProxyCore(object):
 
       ${OMERO_HOME}/bin/omero admin cleanse ${OMERO_DATA_DIR}
     """
-    # try:
-    self.connect()
-    ofiles = self._list_table_copies(table_name)
-    for o in ofiles:
-      self.ome_operation('getUpdateService' , 'deleteObject', o)
-    # finally:
-    #   self.disconnect()
+    with self._session():
+      self._close_table(table_name)
+      ofiles = self._list_table_copies(table_name)
+      for o in ofiles:
+        self.ome_operation('getUpdateService' , 'deleteObject', o)
 
   def table_exists(self, table_name):
     # try:
@@ -418,53 +1048,151 @@ class ProxyCore(object):
 
   def get_number_of_rows(self, table_name):
     "returns the number of rows of table table_name"
-    session = self.connect()
-    table = self._get_table(session, table_name)
-    return table.getNumberOfRows()
+    with self._session() as s:
+      return self._get_table(s, table_name).getNumberOfRows()
 
   @staticmethod
-  def _load_columns(table, records):
-    columns = table.getHeaders()
+  def _load_columns(col_objs, records):
+    """
+    Return a fresh copy of the col_objs headers filled with the
+    contents of records, a numpy records array.
+    """
+    columns = [copy.copy(c) for c in col_objs]
     for c in columns:
       c.values = records[c.name].tolist()
     return columns
-    
-  def store_as_a_table(self, table_name, records, batch_size=10000):
+
+  @staticmethod
+  def __begin_add_data(table, columns):
+    # Ice 3.3 does not provide the begin_/end_ asynchronous API
+    if hasattr(table, 'begin_addData'):
+      return table.begin_addData(columns)
+    table.addData(columns)
+    return None
+
+  def __add_records(self, table, col_objs, records, batch_size):
+    """
+    Append records, a numpy records array, to table. Each batch is
+    converted while the previous one is being sent to the server.
+    """
+    pending = None
+    for offset in xrange(0, len(records), batch_size):
+      columns = self._load_columns(col_objs,
+                                   records[offset:offset+batch_size])
+      if pending is not None:
+        table.end_addData(pending)
+      pending = self.__begin_add_data(table, columns)
+    if pending is not None:
+      table.end_addData(pending)
+
+  def _batch_size(self, col_objs, batch_size=None):
+    """
+    Return batch_size, if given, otherwise the number of rows with the
+    layout described by col_objs that fit in self.table_byte_budget.
+    """
+    if batch_size:
+      return batch_size
+    return adaptive_batch_size(col_objs, self.table_byte_budget)
+
+  def store_as_a_table(self, table_name, records, batch_size=None):
     """
     Creates a new omero table called table_name and store in it the
     contents of records, a numpy records array.
+
+    If batch_size is not given, it is computed from the table row size
+    and the table byte budget.
     """
     if not hasattr(records, 'dtype') or records.dtype.type != np.void:
       raise ValueError('records is not a numpy records array')
     dtype = records.dtype
     fields = [dtype_to_ome_table_column(k, dtype.fields[k][0])
               for k in records.dtype.names]
-    table = self._create_table(table_name, fields)
-    offset = 0
-    while offset < len(records):
-      table.addData(self._load_columns(table, 
-                                       records[offset: offset + batch_size]))
-      offset += batch_size
-    
-  def read_whole_table(self, table_name, batch_size=10000):
+    with self._session():
+      table = self._create_table(table_name, fields)
+      col_objs = table.getHeaders()
+      batch_size = self._batch_size(col_objs, batch_size)
+      self.__add_records(table, col_objs, records, batch_size)
+
+  def read_whole_table(self, table_name, batch_size=None, n_readers=1):
     """
     Reads all data contained in the omero table called table_name and
     return result as a numpy records array.
+
+    If batch_size is not given, it is computed from the table row size
+    and the table byte budget. If n_readers is greater than one, the
+    table is read concurrently by n_readers threads, each one with its
+    own table handle.
+    """
+    with self._session() as s:
+      table = self._get_table(s, table_name)
+      col_numbers, dtype, batch_size = self.__read_setup(table, None,
+                                                         batch_size)
+      return self.__read_range(s, table, table_name, col_numbers, dtype,
+                               batch_size, n_readers)
+
+  def __read_range(self, session, table, table_name, col_numbers, dtype,
+                   batch_size, n_readers=1):
+    """
+    Read all rows of table, restricted to col_numbers, into a
+    preallocated numpy records array, in windows of batch_size rows.
+    With n_readers > 1, windows are fetched concurrently over
+    n_readers additional handles to table_name, opened on session or,
+    if the session pool is enabled, on sessions checked out from it.
     """
-    session = self.connect()
-    table = self._get_table(session, table_name)
     n_rows = table.getNumberOfRows()
-    columns = table.getHeaders()
-    dtype = [(c.name, convert_type(c)) for c in columns]
     records = np.zeros(n_rows, dtype=dtype)
-    offset = 0
-    while offset < n_rows:
-      next_offset = offset + batch_size
-      data = table.read(range(len(columns)), offset, next_offset)
-      block = records[offset:next_offset]
+    def read_window(t, start):
+      stop = min(n_rows, start + batch_size)
+      data = t.read(col_numbers, start, stop)
+      block = records[start:stop]
       for c in data.columns:
         block[c.name] = c.values
-      offset = next_offset
+    windows = range(0, n_rows, batch_size)
+    n_readers = min(n_readers, len(windows))
+    pool = self.session_pool
+    if pool is not None:
+      # the calling thread is already holding one of the sessions
+      n_readers = min(n_readers, pool.size - 1)
+    if n_readers <= 1:
+      for start in windows:
+        read_window(table, start)
+      return records
+    queue, errors = Queue.Queue(), []
+    for start in windows:
+      queue.put(start)
+    def reader():
+      try:
+        s = session if pool is None else pool.checkout()
+      except Exception:
+        errors.append(sys.exc_info())
+        return
+      try:
+        t = self._open_table(s, table_name)
+      except Exception:
+        errors.append(sys.exc_info())
+        if pool is not None:
+          pool.checkin(s)
+        return
+      try:
+        while not errors:
+          try:
+            start = queue.get_nowait()
+          except Queue.Empty:
+            break
+          read_window(t, start)
+      except Exception:
+        errors.append(sys.exc_info())
+      finally:
+        self.__close_table_handle(table_name, t)
+        if pool is not None:
+          pool.checkin(s)
+    threads = [threading.Thread(target=reader) for _ in xrange(n_readers)]
+    for th in threads:
+      th.start()
+    for th in threads:
+      th.join()
+    if errors:
+      raise errors[0][0], errors[0][1], errors[0][2]
     return records
     
   def create_table(self, table_name, fields):
@@ -472,18 +1200,42 @@ class ProxyCore(object):
     return self._create_table(table_name, ofields)
     
   def _create_table(self, table_name, fields):
-    s = self.connect()
-    # try:
-    r = s.sharedResources()
-    m = r.repositories()
-    i = m.descriptions[0].id.val
-    t = r.newTable(i, table_name)
-    t.initialize(fields)
-    # finally:
-    #   self.disconnect()
+    with self._session() as s:
+      r = s.sharedResources()
+      m = r.repositories()
+      i = m.descriptions[0].id.val
+      t = r.newTable(i, table_name)
+      t.initialize(fields)
+      self._pool_table(s, table_name, t)
     return t
 
   def _get_table(self, session, table_name):
+    """
+    Return an open handle to table_name. Handles are kept in a LRU
+    pool bound to session, so that repeated operations on the same
+    table do not need to look up and reopen it.
+    """
+    with self._tables_lock:
+      tables = self._table_cache(session)
+      if table_name in tables:
+        t = tables.pop(table_name)
+        tables[table_name] = t
+        return t
+    t = self._open_table(session, table_name)
+    self._pool_table(session, table_name, t)
+    return t
+
+  def _table_cache(self, session):
+    # must be called with self._tables_lock held
+    if session is self.current_session:
+      return self._tables
+    return self._session_tables.setdefault(id(session), OrderedDict())
+
+  def _open_table(self, session, table_name):
+    """
+    Return a new handle to table_name, not managed by the pool: it is
+    up to the caller to close it.
+    """
     s = session
     qs = s.getQueryService()
     ofile = qs.findByString('OriginalFile', 'name', table_name, None)
@@ -495,26 +1247,112 @@ class ProxyCore(object):
       raise ValueError("failed to retrieve table '%s'" % table_name)
     return t
 
-  def get_table_rows_iterator(self, table_name, batch_size=100):
+  def _pool_table(self, session, table_name, table):
+    with self._tables_lock:
+      tables = self._table_cache(session)
+      old = tables.pop(table_name, None)
+      evicted = [] if old is None else [(table_name, old)]
+      tables[table_name] = table
+      while len(tables) > self.table_pool_size:
+        evicted.append(tables.popitem(last=False))
+    for name, t in evicted:
+      self.__close_table_handle(name, t)
+
+  def _close_table(self, table_name):
+    """
+    Close all pooled handles to table_name, whatever their session.
+    """
+    with self._tables_lock:
+      handles = [tables.pop(table_name) for tables in
+                 [self._tables] + self._session_tables.values()
+                 if table_name in tables]
+    for t in handles:
+      self.__close_table_handle(table_name, t)
+
+  def close_tables(self, session=None):
+    """
+    Close all pooled table handles bound to session or, if session is
+    None, all pooled table handles.
+    """
+    with self._tables_lock:
+      if session is None:
+        caches = [self._tables] + self._session_tables.values()
+        self._session_tables = {}
+      elif session is self.current_session:
+        caches = [self._tables]
+      else:
+        caches = [self._session_tables.pop(id(session), OrderedDict())]
+      handles = []
+      for tables in caches:
+        handles.extend(tables.items())
+        tables.clear()
+    for name, t in handles:
+      self.__close_table_handle(name, t)
+
+  def __close_table_handle(self, table_name, table):
+    try:
+      table.close()
+    except Exception, e:
+      self.logger.warning('failed to close table %s: %s' % (table_name, e))
+
+  def get_table_rows_iterator(self, table_name, batch_size=None):
     # TODO add error checking
-    def iter_on_rows(t, n_cols):
-      i, N = 0, t.getNumberOfRows()
-      while i < N:
-        j = min(N, i + batch_size)
-        v = t.read(range(n_cols), i, j)
-        Z = convert_coordinates_to_np(v)
-        for k in range(j - i):
+    def iter_on_rows(blocks):
+      for Z in blocks:
+        for k in xrange(len(Z)):
           yield Z[k]
-        i = j
-      # self.disconnect()  # this closes the connect() below
-    if not self.current_session:
-        self.connect()
-    t = self._get_table(self.current_session, table_name)
-    col_objs = t.getHeaders()
-    return iter_on_rows(t, len(col_objs))
+    return iter_on_rows(self.get_table_blocks_iterator(table_name,
+                                                       batch_size=batch_size))
 
-  def __convert_col_names_to_indices(self, table, col_names):
-    col_objs = table.getHeaders()
+  def get_table_blocks_iterator(self, table_name, col_names=None,
+                                batch_size=None, prefetch=2):
+    """
+    Return an iterator over the rows of table table_name, as a
+    sequence of numpy records arrays of at most batch_size rows
+    each. If batch_size is not given, it is computed from the size of
+    the selected columns and the table byte budget.
+
+    Up to prefetch blocks are read by a background thread while the
+    caller is processing the current one. Set prefetch to 0 to read
+    blocks only when they are requested.
+    """
+    pool = self.session_pool
+    if pool is None:
+      if not self.current_session:
+        self.connect()
+      # the iterator may outlive any pooled handle
+      t = self._open_table(self.current_session, table_name)
+      col_numbers, dtype, batch_size = self.__read_setup(t, col_names,
+                                                         batch_size)
+    else:
+      # the iterator checks out its own session, and opens its own
+      # handle, only when the first block is requested
+      t = None
+      with self._session() as s:
+        col_numbers, dtype, batch_size = self.__read_setup(
+          self._get_table(s, table_name), col_names, batch_size
+          )
+    def iter_on_blocks():
+      s, table = None, t
+      if table is None:
+        s = pool.checkout()
+      try:
+        if table is None:
+          table = self._open_table(s, table_name)
+        i, N = 0, table.getNumberOfRows()
+        while i < N:
+          j = min(N, i + batch_size)
+          yield convert_coordinates_to_np(table.read(col_numbers, i, j))
+          i = j
+      finally:
+        if table is not None:
+          self.__close_table_handle(table_name, table)
+        if s is not None:
+          pool.checkin(s)
+    blocks = iter_on_blocks()
+    return prefetch_iterator(blocks, prefetch) if prefetch > 0 else blocks
+
+  def __convert_col_names_to_indices(self, col_objs, col_names):
     if col_names:
       col_numbers = []
       by_name = dict(((c.name, i) for i, c in enumerate(col_objs)))
@@ -527,101 +1365,185 @@ class ProxyCore(object):
       col_numbers = range(len(col_objs))
     return col_numbers
 
+  def __read_setup(self, table, col_names, batch_size):
+    col_objs = table.getHeaders()
+    col_numbers = self.__convert_col_names_to_indices(col_objs, col_names)
+    col_objs = [col_objs[i] for i in col_numbers]
+    batch_size = self._batch_size(col_objs, batch_size)
+    return col_numbers, convert_to_numpy_record_type(col_objs), batch_size
+
   def get_table_rows(self, table_name, selector=None, col_names=None,
-                     batch_size=BATCH_SIZE):
+                     batch_size=None, n_readers=1):
     """
     selector can be one of None, a selection or a list of selections. In
     the latter case, it is interpreted as an 'or' condition between
-    the list elements.
+    the list elements. Selected rows are returned in table order, each
+    of them only once.
+
+    If batch_size is not given, it is computed from the size of the
+    selected columns and the table byte budget. If selector is None
+    and n_readers is greater than one, the table is read concurrently
+    by n_readers threads, each one with its own table handle.
     """
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_numbers = self.__convert_col_names_to_indices(t, col_names)
-    if selector is None:
-      res = self.__get_table_rows_bulk(t, col_numbers, batch_size)      
-    else:
-      res = self.__get_table_rows_selected(t, selector, col_numbers,
-                                           batch_size)
-    # finally:
-    #   self.disconnect()
+    with self._session() as s:
+      t = self._get_table(s, table_name)
+      col_numbers, dtype, batch_size = self.__read_setup(t, col_names,
+                                                         batch_size)
+      if selector is None:
+        res = self.__get_table_rows_bulk(s, t, table_name, col_numbers, dtype,
+                                         batch_size, n_readers)
+      else:
+        res = self.__get_table_rows_selected(t, selector, col_numbers,
+                                             batch_size)
     return res
 
   def get_table_rows_by_indices(self, table_name, indices=None, col_names=None,
-                                batch_size=BATCH_SIZE):
+                                batch_size=None, n_readers=1):
     """
-    indices must be either None or a list of integer values.
+    indices must be either None or a list of integer values. If
+    indices is None, n_readers has the same meaning as in
+    get_table_rows.
     """
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_numbers = self.__convert_col_names_to_indices(t, col_names)
-    if indices is None:
-      res = self.__get_table_rows_bulk(t, col_numbers, batch_size)      
-    else:
-      res = self.__get_table_rows_by_indices(t, indices, col_numbers,
-                                             batch_size)
-    # finally:
-    #   self.disconnect()
+    with self._session() as s:
+      t = self._get_table(s, table_name)
+      col_numbers, dtype, batch_size = self.__read_setup(t, col_names,
+                                                         batch_size)
+      if indices is None:
+        res = self.__get_table_rows_bulk(s, t, table_name, col_numbers, dtype,
+                                         batch_size, n_readers)
+      else:
+        res = self.__get_table_rows_slice(t, indices, col_numbers, batch_size)
     return res
 
-  def __get_table_rows_by_indices(self, table, row_indices, col_numbers,
-                                  batch_size):
-    d = table.slice(col_numbers, row_indices)
-    res = [convert_coordinates_to_np(d)]
-    return np.concatenate(tuple(res)) if res else []
-    
   def __get_table_rows_selected(self, table, selector, col_numbers, batch_size):
-    res, row_read, max_row = [], 0, table.getNumberOfRows()
     if isinstance(selector, str):
       selector = [selector]
-    while row_read < max_row:
-      for s in selector:
-        ids = table.getWhereList(s, {}, row_read, row_read + batch_size, 1)
-        if ids:
-          d = table.slice(col_numbers, ids)
-          res.append(convert_coordinates_to_np(d))
-      row_read += batch_size
-    return np.concatenate(tuple(res)) if res else []
-
-  def __get_table_rows_bulk(self, table, col_numbers, batch_size=BATCH_SIZE):
+    ids = set()
+    for i in xrange(0, len(selector), MAX_SELECTOR_TERMS):
+      condition = '|'.join('(%s)' % s
+                           for s in selector[i:i+MAX_SELECTOR_TERMS])
+      ids.update(self.__get_where_list(table, condition))
+    return self.__get_table_rows_sorted(table, sorted(ids), col_numbers,
+                                        batch_size)
+
+  def __get_where_list(self, table, condition):
+    # row ids are returned as longs, size the scan window accordingly
     res, row_read, max_row = [], 0, table.getNumberOfRows()
+    window = max(1, self.table_byte_budget // 8)
     while row_read < max_row:
-      d = table.read(col_numbers, row_read, row_read + batch_size)
-      if d:
-        res.append(convert_coordinates_to_np(d))
-      row_read += batch_size
-    return np.concatenate(tuple(res)) if res else []
+      res.extend(table.getWhereList(condition, {}, row_read,
+                                    row_read + window, 1))
+      row_read += window
+    return res
 
-  def __get_table_rows_slice(self, table, row_numbers, col_numbers, batch_size):
+  def __get_table_rows_sorted(self, table, row_numbers, col_numbers,
+                              batch_size):
+    """
+    Read rows listed, in increasing order and without repetitions, in
+    row_numbers. Batches of contiguous rows are fetched with a single
+    read, the others with a slice.
+    """
     res, n_rows, row_read = [], len(row_numbers), 0
     while row_read < n_rows:
       ids = row_numbers[row_read:(row_read+batch_size)]
-      if ids:
+      if ids[-1] - ids[0] + 1 == len(ids):
+        d = table.read(col_numbers, ids[0], ids[-1] + 1)
+      else:
         d = table.slice(col_numbers, ids)
-        res.append(convert_coordinates_to_np(d))
+      res.append(convert_coordinates_to_np(d))
       row_read += batch_size
     return np.concatenate(tuple(res)) if res else []
 
+  def __get_table_rows_bulk(self, session, table, table_name, col_numbers,
+                            dtype, batch_size, n_readers=1):
+    res = self.__read_range(session, table, table_name, col_numbers, dtype,
+                            batch_size, n_readers)
+    return res if len(res) else []
+
+  def __get_table_rows_slice(self, table, row_numbers, col_numbers, batch_size):
+    """
+    Read rows listed in row_numbers, in that order. Each row is
+    fetched once, in increasing order, so that runs of contiguous rows
+    can be read with a single call (see __get_table_rows_sorted).
+    """
+    if not len(row_numbers):
+      return []
+    row_numbers = np.asarray(row_numbers, dtype=np.int64)
+    unique_rows, positions = np.unique(row_numbers, return_inverse=True)
+    res = self.__get_table_rows_sorted(table, unique_rows.tolist(),
+                                       col_numbers, batch_size)
+    if np.array_equal(unique_rows, row_numbers):
+      return res
+    return res[positions]
+
   def get_table_slice(self, table_name, row_numbers, col_names=None,
-                      batch_size=BATCH_SIZE):
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_numbers = self.__convert_col_names_to_indices(t, col_names)
-    res = self.__get_table_rows_slice(t, row_numbers, col_numbers, batch_size)
-    # finally:
-    #   self.disconnect()
+                      batch_size=None):
+    with self._session() as s:
+      t = self._get_table(s, table_name)
+      col_numbers, dtype, batch_size = self.__read_setup(t, col_names,
+                                                         batch_size)
+      res = self.__get_table_rows_slice(t, row_numbers, col_numbers,
+                                        batch_size)
     return res
+
+  def get_table_slice_async(self, table_name, row_numbers, col_names=None,
+                            batch_size=None):
+    """
+    Like get_table_slice, but return a future as soon as the requests
+    for all batches have been sent.
+    """
+    if self.table_backend is not None:
+      return KBFuture.from_call(self.get_table_slice, table_name,
+                                row_numbers, col_names, batch_size)
+    row_numbers = np.asarray(row_numbers, dtype=np.int64)
+    unique_rows, positions = np.unique(row_numbers, return_inverse=True)
+    unique_rows = unique_rows.tolist()
+    futures = []
+    with self._session() as s:
+      t = self._get_table(s, table_name)
+      col_numbers, dtype, batch_size = self.__read_setup(t, col_names,
+                                                         batch_size)
+      for i in xrange(0, len(unique_rows), batch_size):
+        ids = unique_rows[i:i+batch_size]
+        if ids[-1] - ids[0] + 1 == len(ids):
+          futures.append(ice_call(t, 'read', col_numbers, ids[0], ids[-1] + 1))
+        else:
+          futures.append(ice_call(t, 'slice', col_numbers, ids))
+    f = self.__collect_table_reads(futures)
+    if np.array_equal(unique_rows, row_numbers):
+      return f
+    return f.then(lambda res: res[positions] if len(res) else res)
+
+  def read_whole_table_async(self, table_name, batch_size=None):
+    """
+    Like read_whole_table, but return a future as soon as the requests
+    for all windows have been sent.
+    """
+    if self.table_backend is not None:
+      return KBFuture.from_call(self.read_whole_table, table_name,
+                                batch_size)
+    with self._session() as s:
+      t = self._get_table(s, table_name)
+      col_numbers, dtype, batch_size = self.__read_setup(t, None, batch_size)
+      n_rows = t.getNumberOfRows()
+      futures = [ice_call(t, 'read', col_numbers, start,
+                          min(n_rows, start + batch_size))
+                 for start in xrange(0, n_rows, batch_size)]
+    return self.__collect_table_reads(futures, dtype)
+
+  @staticmethod
+  def __collect_table_reads(futures, dtype=None):
+    def collect():
+      res = [convert_coordinates_to_np(f.result()) for f in futures]
+      if res:
+        return np.concatenate(tuple(res))
+      return [] if dtype is None else np.zeros(0, dtype=dtype)
+    return KBFuture(collect, lambda: all(f.done() for f in futures))
   
   def get_table_headers(self, table_name):
     col_objs = None
-    s = self.connect()
-    # try:
-    t = self._get_table(s, table_name)
-    col_objs = t.getHeaders()
-    # finally:
-    #   self.disconnect()
+    with self._session() as s:
+      col_objs = self._get_table(s, table_name).getHeaders()
     if col_objs:
       return convert_to_numpy_record_type(col_objs)
 
@@ -631,40 +1553,42 @@ class ProxyCore(object):
       row = dict([(k, convert_from_numpy(row[k])) for k in dtype.names])
     return self.add_table_rows_from_stream(table_name, iter([row]), 10)
 
-  def add_table_rows(self, table_name, rows, batch_size=BATCH_SIZE):
-    dtype = rows.dtype
-    def stream(rows):
-      for r in rows:
-        yield dict([(k, convert_from_numpy(r[k])) for k in dtype.names])
-    return self.add_table_rows_from_stream(table_name, stream(rows),
-                                           batch_size=batch_size)
+  def add_table_rows(self, table_name, rows, batch_size=None):
+    """
+    Append rows, a numpy records array with a field for each column of
+    table table_name, to the table. Return the indices of the new rows.
+    """
+    with self._session() as s:
+      t = self._get_table(s, table_name)
+      col_objs = t.getHeaders()
+      batch_size = self._batch_size(col_objs, batch_size)
+      first_index = t.getNumberOfRows()
+      self.__add_records(t, col_objs, rows, batch_size)
+      return range(first_index, first_index + len(rows))
 
   def add_table_rows_from_stream(self, table_name, stream,
-                                 batch_size=BATCH_SIZE):
+                                 batch_size=None):
     return self.__extend_table(table_name, self.__load_batch, stream,
                                batch_size=batch_size)
 
   def __extend_table(self, table_name, batch_loader, records_stream,
-                     batch_size=BATCH_SIZE):
-    if not self.current_session:
-        self.connect()
-    indices = []
-    # try:
-    t = self._get_table(self.current_session, table_name)
-    col_objs = t.getHeaders()
-    batch = batch_loader(records_stream, col_objs, batch_size)
-    # First index of the new batch of rows is the number of rows
-    # already stored into the table
-    first_index = t.getNumberOfRows()
-    while batch:
-      t.addData(batch)
-      indices.extend(range(first_index, t.getNumberOfRows()))
+                     batch_size=None):
+    with self._session() as s:
+      indices = []
+      t = self._get_table(s, table_name)
       col_objs = t.getHeaders()
+      batch_size = self._batch_size(col_objs, batch_size)
       batch = batch_loader(records_stream, col_objs, batch_size)
+      # First index of the new batch of rows is the number of rows
+      # already stored into the table
       first_index = t.getNumberOfRows()
-    # finally:
-    #   self.disconnect()
-    return indices
+      while batch:
+        t.addData(batch)
+        n_rows = len(batch[0].values)
+        indices.extend(range(first_index, first_index + n_rows))
+        first_index += n_rows
+        batch = batch_loader(records_stream, col_objs, batch_size)
+      return indices
 
   def __load_batch(self, records_stream, col_objs, chunk_size):
     v = {}
@@ -678,48 +1602,75 @@ class ProxyCore(object):
     return col_objs
 
   def update_table_row(self, table_name, selector, row):
-    if not self.current_session:
-        self.connect()
-    # try:
-    t = self._get_table(self.current_session, table_name)
-    idxs = t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
-    self.logger.debug('\tselector %s results in %s' % (selector, idxs))
-    if not len(idxs) == 1:
-      raise ValueError('selector %s does not yield a single row' % selector)
-    self.logger.debug('\tselected idx: %s' % idxs)
-    data = t.readCoordinates(idxs)
-    self.__update_data_contents(data, row)
-    t.update(data)
-    # finally:
-    #   self.disconnect()
-
-  def update_table_rows(self, table_name, selector, update_items):
-    if not self.current_session:
-        self.connect()
-    # try:
-    t = self._get_table(self.current_session, table_name)
-    idxs = t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
-    self.logger.debug('\tselector %s results in %s' % (selector, idxs))
-    if len(idxs) == 0:
-      self.logger.debug('\tno rows to update') 
+    with self._session() as s:
+      t = self._get_table(s, table_name)
+      idxs = t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
+      self.logger.debug('\tselector %s results in %s' % (selector, idxs))
+      if not len(idxs) == 1:
+        raise ValueError('selector %s does not yield a single row' % selector)
+      self.logger.debug('\tselected idx: %s' % idxs)
+      data = t.readCoordinates(idxs)
+      self.__update_data_contents(data, row)
+      t.update(data)
+
+  def update_table_rows(self, table_name, selector, update_items,
+                        batch_size=None):
+    with self._session() as s:
+      t = self._get_table(s, table_name)
+      col_objs = t.getHeaders()
+      cols = [c.name for c in col_objs]
+      for x in update_items.keys():
+        if x not in cols:
+          raise ValueError('%s is not a valid field for table %s' % (x, table_name))
+      batch_size = self._batch_size(col_objs, batch_size)
+      idxs = t.getWhereList(selector, {}, 0, t.getNumberOfRows(), 1)
+      self.logger.debug('\tselector %s results in %s' % (selector, idxs))
+      if len(idxs) == 0:
+        self.logger.debug('\tno rows to update') 
+        return
+      for offset in xrange(0, len(idxs), batch_size):
+        data = t.readCoordinates(idxs[offset:offset+batch_size])
+        for dc in data.columns:
+          if dc.name in update_items:
+            self.logger.debug('\tcolumn :%s  -> setting value to %s' %
+                              (dc.name, update_items[dc.name]))
+            dc.values = [update_items[dc.name]] * len(dc.values)
+        self.logger.debug('\trecords have been modified')
+        t.update(data)
+      self.logger.debug('\tdata update complete')
+
+  def update_table_rows_by_indices(self, table_name, indices, records,
+                                   batch_size=None):
+    """
+    Overwrite the rows of table table_name listed in indices with the
+    corresponding elements of records, a numpy records array with the
+    same length as indices. Only the columns matching a field of
+    records are modified.
+    """
+    if len(indices) != len(records):
+      raise ValueError('indices and records must have the same length')
+    if len(indices) == 0:
       return
-    data = t.readCoordinates(idxs)
-    cols = [c.name for c in data.columns]
-    for x in update_items.keys():
-      if x not in cols:
-        raise ValueError('%s is not a valid field for table %s' % (x, table_name))
-    for dc in data.columns:
-      if dc.name in update_items.keys():
-        for x in range(0, len(dc.values)):
-          self.logger.debug(
-            '\tcolumn :%s  -> setting value to %s (old value %s)' % 
-            (dc.name, update_items[dc.name], dc.values[x]))
-          dc.values[x] = update_items[dc.name]
-    self.logger.debug('\trecords have been modified')
-    t.update(data)
-    self.logger.debug('\tdata update complete')
-    # finally:
-    #   self.disconnect()
+    with self._session() as s:
+      t = self._get_table(s, table_name)
+      col_objs = t.getHeaders()
+      cols = [c.name for c in col_objs]
+      for x in records.dtype.names:
+        if x not in cols:
+          raise ValueError('%s is not a valid field for table %s' % (x, table_name))
+      indices = np.asarray(indices, dtype=np.int64)
+      order = np.argsort(indices, kind='mergesort')
+      indices, records = indices[order], records[order]
+      if np.any(indices[1:] == indices[:-1]):
+        raise ValueError('duplicate row indices')
+      batch_size = self._batch_size(col_objs, batch_size)
+      for offset in xrange(0, len(indices), batch_size):
+        data = t.readCoordinates(indices[offset:offset+batch_size].tolist())
+        block = records[offset:offset+batch_size]
+        for dc in data.columns:
+          if dc.name in records.dtype.names:
+            dc.values = block[dc.name].tolist()
+        t.update(data)
 
   def __update_data_contents(self, data, row):
     assert len(data.rowNumbers) == 1
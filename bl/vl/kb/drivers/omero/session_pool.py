@@ -0,0 +1,170 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+"""
+Session pool
+============
+
+A bounded pool of authenticated OMERO sessions, each one opened on its
+own client, so that independent operations issued by different
+threads do not have to share a single Ice session:
+
+.. code-block:: python
+
+   pool = SessionPool(host, user, passwd, size=4)
+   with pool.session() as s:
+     qs = s.getQueryService()
+     ...
+   pool.close()
+
+Sessions are created on demand, up to size; checkout blocks when all
+of them are in use. A session whose use raised anything but an OMERO
+server error (e.g., a lost connection), or a session error, is closed
+and dropped from the pool, which opens a new one when needed. Sessions are bound to the
+group given to the pool: they cannot be moved to another group.
+"""
+
+import threading, Queue
+from contextlib import contextmanager
+
+import omero
+import omero_ServerErrors_ice  # magically adds exceptions to the omero module
+
+import bl.vl.kb as kb
+
+
+class SessionPool(object):
+
+  def __init__(self, host, user, passwd, group=None, size=4,
+               keep_alive=300):
+    if size < 1:
+      raise ValueError('pool size must be a positive number')
+    self.host = host
+    self.user = user
+    self.passwd = passwd
+    self.group_name = group
+    self.size = size
+    self.keep_alive = keep_alive
+    self.__idle = Queue.LifoQueue()
+    self.__clients = {}
+    self.__lock = threading.Lock()
+    self.__closed = False
+
+  def __create_session(self):
+    client = omero.client(self.host)
+    s = client.createSession(self.user, self.passwd)
+    if self.group_name:
+      a = s.getAdminService()
+      try:
+        s.setSecurityContext(a.lookupGroup(self.group_name))
+      except omero.ApiUsageException:
+        client.closeSession()
+        raise kb.KBError('%s is not a valid group name' % self.group_name)
+      except omero.SecurityViolation:
+        client.closeSession()
+        raise kb.KBPermissionError('user %s is not a member of group %s' %
+                                   (self.user, self.group_name))
+    if self.keep_alive:
+      client.enableKeepAlive(self.keep_alive)
+    return client, s
+
+  def checkout(self, timeout=None):
+    """
+    Return an idle session, opening a new one if there are none and
+    the pool is not full. Otherwise, wait up to timeout seconds (for
+    ever if timeout is None) for another thread to check a session in.
+    """
+    if self.__closed:
+      raise kb.KBError('session pool is closed')
+    try:
+      return self.__idle.get_nowait()
+    except Queue.Empty:
+      pass
+    with self.__lock:
+      create = len(self.__clients) < self.size
+      if create:
+        # reserve the slot before connecting
+        key = object()
+        self.__clients[key] = None
+    if create:
+      try:
+        client, s = self.__create_session()
+      except:
+        with self.__lock:
+          del self.__clients[key]
+        raise
+      with self.__lock:
+        del self.__clients[key]
+        self.__clients[id(s)] = (client, s)
+      return s
+    try:
+      return self.__idle.get(timeout=timeout)
+    except Queue.Empty:
+      raise kb.KBError('no OMERO session available after %ss' % timeout)
+
+  def checkin(self, session):
+    """
+    Give session back to the pool. Sessions checked in after the pool
+    has been closed were closed with it, and are ignored.
+    """
+    if self.__closed:
+      return
+    if id(session) not in self.__clients:
+      raise ValueError('session does not belong to this pool')
+    self.__idle.put(session)
+
+  def discard(self, session):
+    """
+    Close session and drop it from the pool, instead of checking it
+    in, freeing its slot for a new one.
+    """
+    with self.__lock:
+      entry = self.__clients.pop(id(session), None)
+    if entry is not None:
+      self.__close_client(*entry)
+
+  def __close_client(self, client, session):
+    # the connection may be already broken: closing is best effort
+    try:
+      if self.keep_alive:
+        client.stopKeepAlive()
+      client.closeSession()
+    except Exception:
+      pass
+
+  @contextmanager
+  def session(self, timeout=None):
+    s = self.checkout(timeout)
+    try:
+      yield s
+    except omero.SessionException:
+      self.discard(s)
+      raise
+    except omero.ServerError:
+      # the server did answer: the session is still usable
+      self.checkin(s)
+      raise
+    except:
+      self.discard(s)
+      raise
+    else:
+      self.checkin(s)
+
+  def sessions(self):
+    """
+    Return all sessions opened so far.
+    """
+    with self.__lock:
+      return [v[1] for v in self.__clients.itervalues() if v is not None]
+
+  def close(self):
+    """
+    Close all sessions. Sessions that are still checked out are
+    closed too.
+    """
+    self.__closed = True
+    with self.__lock:
+      entries = [v for v in self.__clients.itervalues() if v is not None]
+      self.__clients.clear()
+    for client, s in entries:
+      self.__close_client(client, s)
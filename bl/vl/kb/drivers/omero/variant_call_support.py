@@ -72,8 +72,8 @@ def _unpack_path(path):
     
 def _get_vcs_data(kb, dos):
     # pylint: disable=C0111
+    kb.reload_many(dos)
     for do in dos:
-        do.reload()
         if do.mimetype == mimetypes.VCS_TABLES:
             table_names = _unpack_path(do.path)
             nodes = kb.read_whole_table(table_names['support']['nodes'])
@@ -121,8 +121,8 @@ def delete_vcs(kb, vcs):
 
 
 def _delete_data(kb, dos):
+    kb.reload_many(dos)
     for do in dos:
-        do.reload()
         if do.mimetype == mimetypes.VCS_TABLES:
             table_names = _unpack_path(do.path)
             kb.delete_table(table_names['support']['nodes'])
@@ -192,8 +192,8 @@ class  VariantCallSupport(DataSample):
         dos = self.proxy.get_data_objects(self)
         if len(dos) > 0:
             kb = self.proxy
+            kb.reload_many(dos)
             for do in dos:
-                do.reload()
                 if do.mimetype == mimetypes.VCS_TABLES:
                     table_names = _unpack_path(do.path)
                     kb.delete_table(table_names['support']['nodes'])
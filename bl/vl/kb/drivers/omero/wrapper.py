@@ -105,7 +105,14 @@ class CoreOmeroWrapper(object):
   def enum_label(self):
     if not self.is_enum():
       raise ValueError('%s is not an enum' % self)
-    return self.ome_obj.value._val
+    if self.ome_obj.loaded:
+      return self.ome_obj.value._val
+    # values mapped from the enum cache are unloaded objects
+    for o, label in zip(self.__enums__, self.__enum_labels__):
+      if o is self or (o.is_mapped() and self.is_mapped() and
+                       o.ome_obj.id._val == self.ome_obj.id._val):
+        return label
+    raise ValueError('cannot find the label of unloaded %s' % self)
 
   def to_omero(self, tcode, v):
     if isinstance(tcode, type):
@@ -285,6 +292,7 @@ class MetaWrapper(type):
         if fields[k][0] == SELF_TYPE:
           fields[k] = (klass,) + fields[k][1:]
     if klass.is_enum():
+      klass.__enum_labels__ = list(klass.__enums__)
       enums = []
       for l in klass.__enums__:
         o = klass(ome_obj=None, proxy=None)
@@ -330,12 +338,53 @@ class OmeroWrapper(CoreOmeroWrapper):
   def is_enum(klass):
     return len(klass.__enums__) > 0
 
+  @classmethod
+  def get_field_type(klass, name):
+    """
+    Return the type of field name, also looking it up in base classes,
+    or None if klass has no such field.
+    """
+    for k in klass.__mro__:
+      fields = k.__dict__.get('__fields__')
+      if isinstance(fields, dict) and name in fields:
+        return fields[name][0]
+    return None
+
+  @classmethod
+  def get_reference_fields(klass):
+    """
+    Return the names of all fields of klass, including inherited ones,
+    that refer to other KB objects.
+    """
+    names = []
+    for k in klass.__mro__:
+      fields = k.__dict__.get('__fields__')
+      if not isinstance(fields, dict):
+        continue
+      names.extend(n for n, f in fields.iteritems()
+                   if isinstance(f[0], type) and n not in names)
+    return names
+
+  @classmethod
+  def is_self_referencing(klass):
+    """
+    Return True if klass has a reference field that can point to
+    another object of the same class.
+    """
+    for k in klass.__mro__:
+      fields = k.__dict__.get('__fields__')
+      if not isinstance(fields, dict):
+        continue
+      for f in fields.itervalues():
+        if isinstance(f[0], type) and (issubclass(klass, f[0]) or
+                                       issubclass(f[0], klass)):
+          return True
+    return False
+
   @classmethod
   def map_enums_values(klass, proxy):
     assert klass.is_enum()
-    for o in klass.__enums__:
-      if not o.is_mapped():
-        proxy.update_by_example(o)
+    proxy.map_enums(klass)
 
   def __preprocess_conf__(self, conf):
     return conf
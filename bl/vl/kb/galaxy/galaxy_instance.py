@@ -134,8 +134,8 @@ class GalaxyInstance(CoreGalaxyInstance):
         if not dos:
             self._raise_exception(RuntimeError,
                   "sample %s has no attached DataObject" % sample)
+        self.kb.reload_many(dos)
         for do in dos:
-            do.reload()
             self.logger.debug('\tdo.path: <%s>'% do.path)
             self.logger.debug('\tdo.mimetype: <%s>'% do.mimetype)
             if do.mimetype == mimetype:
@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+
 import bl.vl.utils.messages as msgconf
 if msgconf.messages_engine_enabled():
     import pika
@@ -154,8 +156,32 @@ class EventsSender(MessagesHandler):
                  queue=None, logger=None):
         super(EventsSender, self).__init__(host, port, user, password,
                                            queue, logger)
+        self._batch = None
+
+    @contextmanager
+    def batch(self):
+        """
+        Hold back events sent within the block and publish them all
+        together when it ends, even if it ends with an exception.
+        """
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        finally:
+            events, self._batch = self._batch, None
+            self.send_events(events)
+
+    def send_events(self, events):
+        for event in events:
+            self.send_event(event)
 
     def send_event(self, event):
+        if self._batch is not None:
+            self._batch.append(event)
+            return
         if not self.connection:
             self.connect()
         try:
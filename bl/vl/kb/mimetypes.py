@@ -2,6 +2,7 @@
 # END_COPYRIGHT
 
 GDO_TABLE = 'x-bl/gdo-table'
+GDO_COMPACT_TABLE = 'x-bl/gdo-compact-table'
 VCS_TABLES = 'x-bb/vcs-tables'
 SSC_FILE = 'x-ssc-messages'
 CEL_FILE = 'x-vl/affymetrix-cel'
@@ -18,6 +19,8 @@ MANIFEST_FILE='x-vl/illumina-manifest'
 FASTQ_64_FILE = 'x-vl/fastq+64'
 VCF_FILE = 'x-vl/vcf'
 
+GDO_TABLES = [GDO_TABLE, GDO_COMPACT_TABLE]
+
 DATA_OBJECT_FILES = [SSC_FILE, CEL_FILE, SAM_FILE, BAM_FILE,
                      QSEQ_FILE, FASTQ_FILE, BCL_FILE,
                      ILLUMINA_RUN_FOLDER, GENERIC_PATHSET,
@@ -40,14 +40,15 @@ class UTCommon(KBObjectCreator):
             )
         return mset, rows
 
-    def create_markers_set(self, N):
+    def create_markers_set(self, N, gdo_block_size=None, compact_gdos=False):
         label = 'ams-%f' % time.time()
         maker, model, release = 'FOO', 'FOO1', '%f' % time.time()
         rows = np.array([('M%d' % i, i, 'AC[A/G]GT', False) 
                          for i in xrange(N)],
                          dtype=MSET_TABLE_COLS_DTYPE)
         mset = self.kb.genomics.create_markers_array(
-            label, maker, model, release, rows, self.action
+            label, maker, model, release, rows, self.action,
+            gdo_block_size=gdo_block_size, compact_gdos=compact_gdos
             )
         return mset, rows
 
@@ -6,8 +6,9 @@ import itertools as it
 import tempfile
 import numpy as np
 
-from bl.vl.kb import KnowledgeBase as KB
-from bl.vl.kb.drivers.omero.genomics import MSET_TABLE_COLS_DTYPE
+from bl.vl.kb import KnowledgeBase as KB, mimetypes
+from bl.vl.kb.drivers.omero.genomics import MSET_TABLE_COLS_DTYPE, \
+     MAX_GDO_BLOCKS, GDO_TABLE_NAME, GDO_TABLE_COLS
 
 from common import UTCommon
 
@@ -98,6 +99,171 @@ class markers_set(UTCommon):
       self.assertEqual(i, 0)
 
 
+  def test_gdo_bulk(self):
+    N, n_samples = 32, 5
+    mset, _ = self.create_markers_set(N)
+    self.kill_list.append(mset)
+    samples, probs, confs = [], [], []
+    for i in xrange(n_samples):
+      data_sample = self.create_data_sample(mset, 'foo-data-%d' % i,
+                                            self.action)
+      self.kill_list.append(data_sample)
+      samples.append(data_sample)
+      p, c = self.make_fake_data(N)
+      probs.append(p)
+      confs.append(c)
+    dos = self.kb.genomics.add_gdo_data_objects(
+      self.action, samples, np.array(probs), np.array(confs), batch_size=2
+      )
+    self.kill_list.extend(dos)
+    self.assertEqual(len(dos), n_samples)
+    for data_sample, do, p, c in it.izip(samples, dos, probs, confs):
+      self.assertEqual(do.sample.id, data_sample.id)
+      probs1, confs1 = data_sample.resolve_to_data()
+      self.assertTrue((p == probs1).all())
+      self.assertTrue((c == confs1).all())
+
+  def test_gdo_fetch(self):
+    N, n_samples = 32, 4
+    msets, samples, data = [], [], {}
+    for _ in xrange(2):
+      mset, _ = self.create_markers_set(N)
+      self.kill_list.append(mset)
+      msets.append(mset)
+    for i in xrange(n_samples):
+      mset = msets[i % 2]
+      data_sample = self.create_data_sample(mset, 'foo-data-%d' % i,
+                                            self.action)
+      self.kill_list.append(data_sample)
+      probs, confs = self.make_fake_data(N)
+      do = self.kb.genomics.add_gdo_data_object(self.action, data_sample,
+                                                probs, confs)
+      self.kill_list.append(do)
+      samples.append(data_sample)
+      data[data_sample.id] = (probs, confs)
+    samples.reverse()
+    gdos = self.kb.genomics.get_gdos(samples, batch_size=2)
+    self.assertEqual([ds.id for ds, _ in gdos], [ds.id for ds in samples])
+    for data_sample, gdo in gdos:
+      probs, confs = data[data_sample.id]
+      self.assertTrue((probs == gdo['probs']).all())
+      self.assertTrue((confs == gdo['confidence']).all())
+    mset_samples = [ds for ds in samples if ds.snpMarkersSet == msets[0]]
+    for ds, gdo in it.izip(mset_samples, self.kb.genomics.get_gdo_iterator(
+      msets[0], data_samples=mset_samples, indices=[1, 5]
+      )):
+      probs, confs = data[ds.id]
+      self.assertTrue((probs[:, [1, 5]] == gdo['probs']).all())
+      self.assertTrue((confs[[1, 5]] == gdo['confidence']).all())
+
+  def test_resolve_to_data(self):
+    N, n_samples = 32, 3
+    indices = [0, 7, 31]
+    mset, _ = self.create_markers_set(N)
+    self.kill_list.append(mset)
+    samples, probs, confs = [], [], []
+    for i in xrange(n_samples):
+      data_sample = self.create_data_sample(mset, 'foo-data-%d' % i,
+                                            self.action)
+      self.kill_list.append(data_sample)
+      p, c = self.make_fake_data(N)
+      do = self.kb.genomics.add_gdo_data_object(self.action, data_sample,
+                                                p, c)
+      self.kill_list.append(do)
+      samples.append(data_sample)
+      probs.append(p)
+      confs.append(c)
+    all_probs, all_confs = self.kb.genomics.resolve_to_data(samples, indices)
+    self.assertEqual(all_probs.shape, (n_samples, 2, len(indices)))
+    self.assertEqual(all_confs.shape, (n_samples, len(indices)))
+    for i, data_sample in enumerate(samples):
+      self.assertTrue((probs[i][:, indices] == all_probs[i]).all())
+      self.assertTrue((confs[i][indices] == all_confs[i]).all())
+      p, c = data_sample.resolve_to_data()
+      self.assertTrue((probs[i] == p).all())
+      self.assertTrue((confs[i] == c).all())
+    data_sample = self.create_data_sample(mset, 'foo-data-nogdo', self.action)
+    self.kill_list.append(data_sample)
+    self.assertRaises(ValueError, self.kb.genomics.resolve_to_data,
+                      samples + [data_sample])
+
+  def test_gdo_blocked(self):
+    N, block_size = 32, 10
+    indices = [31, 2, 15, 3]
+    mset, _ = self.create_markers_set(N, gdo_block_size=block_size)
+    self.kill_list.append(mset)
+    self.assertEqual(self.kb.genomics._get_gdo_layout(mset.id),
+                     (False, [('_0', 0, 10), ('_1', 10, 20), ('_2', 20, 30),
+                              ('_3', 30, 32)]))
+    data_sample = self.create_data_sample(mset, 'foo-data', self.action)
+    self.kill_list.append(data_sample)
+    data_obj, probs, confs = self.create_data_object(data_sample, self.action)
+    self.kill_list.append(data_obj)
+    probs1, confs1 = data_sample.resolve_to_data()
+    self.assertTrue((probs == probs1).all())
+    self.assertTrue((confs == confs1).all())
+    probs1, confs1 = data_sample.resolve_to_data(indices)
+    self.assertTrue((probs[:, indices] == probs1).all())
+    self.assertTrue((confs[indices] == confs1).all())
+    for x in self.kb.genomics.get_gdo_iterator(mset, indices=indices):
+      self.assertTrue((probs[:, indices] == x['probs']).all())
+      self.assertTrue((confs[indices] == x['confidence']).all())
+    self.assertRaises(ValueError, self.create_markers_set,
+                      MAX_GDO_BLOCKS + 1, gdo_block_size=1)
+
+  def test_gdo_compact(self):
+    N, tol = 32, 0.5 / 254 + 1e-6
+    indices = [31, 2, 15]
+    mset, _ = self.create_markers_set(N, gdo_block_size=8, compact_gdos=True)
+    self.kill_list.append(mset)
+    data_sample = self.create_data_sample(mset, 'foo-data', self.action)
+    self.kill_list.append(data_sample)
+    data_obj, probs, confs = self.create_data_object(data_sample, self.action)
+    self.kill_list.append(data_obj)
+    self.assertEqual(data_obj.mimetype, mimetypes.GDO_COMPACT_TABLE)
+    probs1, confs1 = data_sample.resolve_to_data()
+    self.assertTrue((abs(probs - probs1) <= tol).all())
+    self.assertTrue(np.allclose(confs, confs1, rtol=1e-3, atol=0))
+    probs1, confs1 = data_sample.resolve_to_data(indices)
+    self.assertTrue((abs(probs[:, indices] - probs1) <= tol).all())
+    self.assertTrue(np.allclose(confs[indices], confs1, rtol=1e-3, atol=0))
+
+  def test_convert_gdo_table(self):
+    N, tol = 32, 0.5 / 254 + 1e-6
+    mset, _ = self.create_markers_set(N)
+    self.kill_list.append(mset)
+    data_sample = self.create_data_sample(mset, 'foo-data', self.action)
+    self.kill_list.append(data_sample)
+    data_obj, probs, confs = self.create_data_object(data_sample, self.action)
+    self.kill_list.append(data_obj)
+    self.assertEqual(self.kb.genomics.convert_gdo_table(mset), 1)
+    data_obj.reload()
+    self.assertEqual(data_obj.mimetype, mimetypes.GDO_COMPACT_TABLE)
+    probs1, confs1 = data_sample.resolve_to_data()
+    self.assertTrue((abs(probs - probs1) <= tol).all())
+    self.assertTrue(np.allclose(confs, confs1, rtol=1e-3, atol=0))
+    self.assertEqual(
+      self.kb.genomics._gdo_checksum(probs1, confs1, False)[0],
+      data_obj.sha1
+      )
+    # a conversion interrupted after the table was deleted is completed
+    # by the next one, with the layout of the temporary copy
+    self.kb.genomics.convert_gdo_table(mset, compact=False)
+    table_name = self.kb.genomics._markers_array_table_name(GDO_TABLE_NAME,
+                                                            mset.id)
+    tmp_name = '%s.tmp' % table_name
+    self.kb.create_table(tmp_name, GDO_TABLE_COLS(N))
+    for block in self.kb.get_table_blocks_iterator(table_name):
+      self.kb.add_table_rows(tmp_name, block)
+    self.kb.delete_table(table_name)
+    self.assertEqual(self.kb.genomics.convert_gdo_table(mset), 1)
+    self.assertFalse(self.kb.table_exists(tmp_name))
+    data_obj.reload()
+    self.assertEqual(data_obj.mimetype, mimetypes.GDO_TABLE)
+    probs2, confs2 = data_sample.resolve_to_data()
+    self.assertTrue((probs1 == probs2).all())
+    self.assertTrue((confs1 == confs2).all())
+
   def test_speed(self):
     ref_genome = 'g' + ('%f' % time.time())[-14:]
     N1 = 1024*1024
@@ -156,6 +322,12 @@ def suite():
   suite.addTest(markers_set('test_creation_destruction'))
   suite.addTest(markers_set('test_read_ssc'))
   suite.addTest(markers_set('test_gdo'))
+  suite.addTest(markers_set('test_gdo_bulk'))
+  suite.addTest(markers_set('test_gdo_fetch'))
+  suite.addTest(markers_set('test_resolve_to_data'))
+  suite.addTest(markers_set('test_gdo_blocked'))
+  suite.addTest(markers_set('test_gdo_compact'))
+  suite.addTest(markers_set('test_convert_gdo_table'))
   #--
   ## suite.addTest(markers_set('test_speed'))
   ## suite.addTest(markers_set('test_speed_gdo'))
@@ -0,0 +1,52 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest, tempfile, shutil, os
+
+from bl.vl.kb.drivers.omero.enum_cache import EnumCache
+
+
+class TestEnumCache(unittest.TestCase):
+
+  def setUp(self):
+    self.wd = tempfile.mkdtemp()
+    self.path = os.path.join(self.wd, 'enums.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.wd)
+
+  def test_persistence(self):
+    cache = EnumCache(self.path, 'host-a')
+    self.assertTrue(cache.get('Gender') is None)
+    cache.update({'Gender': {'MALE': 1, 'FEMALE': 2}})
+    self.assertEqual(cache.get('Gender'), {'MALE': 1, 'FEMALE': 2})
+    other = EnumCache(self.path, 'host-b')
+    self.assertTrue(other.get('Gender') is None)
+    other.update({'Gender': {'MALE': 7, 'FEMALE': 8}})
+    cache = EnumCache(self.path, 'host-a')
+    self.assertEqual(cache.get('Gender'), {'MALE': 1, 'FEMALE': 2})
+    self.assertEqual(EnumCache(self.path, 'host-b').get('Gender')['MALE'], 7)
+
+  def test_bad_file(self):
+    with open(self.path, 'w') as f:
+      f.write('not json')
+    cache = EnumCache(self.path, 'host-a')
+    self.assertTrue(cache.get('Gender') is None)
+    cache.update({'Gender': {'MALE': 1}})
+    self.assertEqual(EnumCache(self.path, 'host-a').get('Gender'),
+                     {'MALE': 1})
+    cache = EnumCache(os.path.join(self.wd, 'missing', 'enums.json'), 'k')
+    cache.update({'Gender': {'MALE': 1}})
+    self.assertEqual(cache.get('Gender'), {'MALE': 1})
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestEnumCache('test_persistence'))
+  suite.addTest(TestEnumCache('test_bad_file'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -0,0 +1,76 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest
+
+from bl.vl.kb.drivers.omero.futures import KBFuture, ice_call, gather
+
+
+class AsyncResult(object):
+
+  def __init__(self, value):
+    self.value = value
+
+  def isCompleted(self):
+    return True
+
+
+class AsyncService(object):
+
+  def __init__(self):
+    self.log = []
+
+  def begin_double(self, x):
+    self.log.append(('begin', x))
+    return AsyncResult(x)
+
+  def end_double(self, r):
+    self.log.append(('end', r.value))
+    if r.value < 0:
+      raise ValueError('negative value')
+    return 2 * r.value
+
+
+class SyncService(object):
+
+  def double(self, x):
+    if x < 0:
+      raise ValueError('negative value')
+    return 2 * x
+
+
+class TestFutures(unittest.TestCase):
+
+  def test_ice_call(self):
+    service = AsyncService()
+    futures = [ice_call(service, 'double', x) for x in 1, 2]
+    self.assertEqual(service.log, [('begin', 1), ('begin', 2)])
+    self.assertTrue(futures[0].done())
+    self.assertEqual(gather(futures), [2, 4])
+    self.assertEqual(futures[1].then(lambda x: x + 1).result(), 5)
+    self.assertEqual(len(service.log), 4)
+    f = ice_call(service, 'double', -1)
+    for _ in xrange(2):
+      self.assertRaises(ValueError, f.result)
+    self.assertEqual(len(service.log), 6)
+
+  def test_sync_fallback(self):
+    f = ice_call(SyncService(), 'double', 3)
+    self.assertTrue(f.done())
+    self.assertEqual(f.result(), 6)
+    f = ice_call(SyncService(), 'double', -3)
+    self.assertTrue(f.done())
+    self.assertRaises(ValueError, f.then(lambda x: x).result)
+    self.assertEqual(KBFuture.from_call(sum, [1, 2]).result(), 3)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestFutures('test_ice_call'))
+  suite.addTest(TestFutures('test_sync_fallback'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
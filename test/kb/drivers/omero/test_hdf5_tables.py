@@ -0,0 +1,160 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest, uuid, tempfile, shutil
+import itertools as it
+import numpy as np
+
+from bl.vl.kb import KBError
+from bl.vl.kb.drivers.omero.hdf5_tables import HDF5TableBackend
+
+
+RES_SIZE = 256
+VID_SIZE = 64
+ARRAY_SIZE = 64
+
+N_ROWS = 16
+
+
+def get_random_table_name():
+  return '%s.h5' % uuid.uuid4().hex
+
+
+class TestHDF5TableBackend(unittest.TestCase):
+
+  def setUp(self):
+    self.root_dir = tempfile.mkdtemp()
+    self.backend = HDF5TableBackend(self.root_dir)
+    self.table_name = get_random_table_name()
+
+  def tearDown(self):
+    shutil.rmtree(self.root_dir)
+
+  def __make_fields(self):
+    return [
+      ('string', 'r_vid', 'Result object VID', VID_SIZE, None),
+      ('long', 'r_id', 'Result object ID', None),
+      ('bool', 'valid', 'Is this row valid?', None),
+      ('double', 'score', 'A score', None),
+      ('float_array', 'a_f_type', 'FloatArray', ARRAY_SIZE),
+      ]
+
+  def __fill_table(self, n_rows):
+    rec_desc = self.backend.get_table_headers(self.table_name)
+    data = np.zeros(n_rows, dtype=rec_desc)
+    data['r_vid'] = ['r_vid%04d' % i for i in xrange(n_rows)]
+    data['r_id'] = np.arange(n_rows)
+    data['valid'] = np.arange(n_rows) % 2
+    data['score'] = 0.5 * np.arange(n_rows)
+    data['a_f_type'] = np.random.random((n_rows, ARRAY_SIZE))
+    self.backend.add_table_rows(self.table_name, data[:-1])
+    self.backend.add_table_row(self.table_name, data[-1])
+    return data
+
+  def test_create_delete(self):
+    fields = self.__make_fields()
+    self.backend.create_table(self.table_name, fields)
+    self.assertTrue(self.backend.table_exists(self.table_name))
+    rec_desc = self.backend.get_table_headers(self.table_name)
+    self.assertEqual(rec_desc, [('r_vid', '|S%d' % VID_SIZE), ('r_id', 'i8'),
+                                ('valid', 'b'), ('score', 'f8'),
+                                ('a_f_type', '(%d,)float32' % ARRAY_SIZE)])
+    self.backend.delete_table(self.table_name)
+    self.assertFalse(self.backend.table_exists(self.table_name))
+
+  def test_handles(self):
+    fields = self.__make_fields()
+    t = self.backend.create_table(self.table_name, fields)
+    self.assertEqual(t.getNumberOfRows(), 0)
+    self.__fill_table(N_ROWS)
+    t = self.backend._get_table(None, self.table_name)
+    self.assertEqual(t.getNumberOfRows(), N_ROWS)
+    self.assertEqual([(c.__class__.__name__, c.name) for c in t.getHeaders()],
+                     [('StringColumn', 'r_vid'), ('LongColumn', 'r_id'),
+                      ('BoolColumn', 'valid'), ('DoubleColumn', 'score'),
+                      ('FloatArrayColumn', 'a_f_type')])
+    self.assertEqual(t.getHeaders()[-1].size, ARRAY_SIZE)
+    self.assertRaises(KBError, getattr, t, 'read')
+    self.assertRaises(KBError, self.backend._get_table, None,
+                      get_random_table_name())
+
+  def test_table_rows(self):
+    self.backend.create_table(self.table_name, self.__make_fields())
+    data = self.__fill_table(N_ROWS)
+    self.assertEqual(self.backend.get_number_of_rows(self.table_name), N_ROWS)
+    rows = self.backend.get_table_rows(self.table_name, None)
+    self.assertTrue(np.all(data == rows))
+    for i, row in enumerate(
+      self.backend.get_table_rows_iterator(self.table_name, batch_size=3)
+      ):
+      self.assertTrue(row == data[i])
+    idx = [5, 1, 5]
+    rows = self.backend.get_table_rows_by_indices(self.table_name, idx,
+                                                  col_names=['r_id'])
+    self.assertEqual(rows.dtype.names, ('r_id',))
+    self.assertEqual(list(rows['r_id']), idx)
+
+  def test_selections(self):
+    self.backend.create_table(self.table_name, self.__make_fields())
+    data = self.__fill_table(N_ROWS)
+    rows = self.backend.get_table_rows(self.table_name, '(valid == True)')
+    self.assertTrue(np.all(data[1::2] == rows))
+    selectors = ['(r_vid == "%s")' % data[i]['r_vid'] for i in (7, 2, 7)]
+    rows = self.backend.get_table_rows(self.table_name, selectors)
+    self.assertTrue(np.all(data[[2, 7]] == rows))
+    self.assertEqual(
+      len(self.backend.get_table_rows(self.table_name, '(r_id < 0)')), 0
+      )
+
+  def test_update(self):
+    self.backend.create_table(self.table_name, self.__make_fields())
+    data = self.__fill_table(N_ROWS)
+    urow = data[3].copy()
+    urow['score'] = -1.0
+    self.backend.update_table_row(self.table_name,
+                                  '(r_vid == "%s")' % urow['r_vid'], urow)
+    self.backend.update_table_rows(self.table_name, '(r_id > 10)',
+                                   {'valid': False})
+    upd = np.zeros(2, dtype=[('r_id', 'i8')])
+    upd['r_id'] = [100, 101]
+    self.backend.update_table_rows_by_indices(self.table_name, [1, 0], upd)
+    rows = self.backend.read_whole_table(self.table_name)
+    data[3]['score'] = -1.0
+    data['valid'][11:] = False
+    data['r_id'][[1, 0]] = [100, 101]
+    self.assertTrue(np.all(data == rows))
+
+  def test_whole_table_ops(self):
+    n_records = 11
+    dtype = np.dtype([('i', '<i4'), ('l', '<i8'), ('b', '<b1'),
+                      ('f', '<f4'), ('d', '<f8'), ('s', 'S10')])
+    records = np.zeros(n_records, dtype=dtype)
+    d = np.arange(n_records)
+    records['i'] = d
+    records['l'] = n_records + d
+    records['b'] = d & 0x01
+    records['f'] = 0.333 * d
+    records['d'] = 0.90290939209 * d
+    records['s'] = map(str, d)
+    self.backend.store_as_a_table(self.table_name, records, batch_size=4)
+    for batch_size in None, 3:
+      newrec = self.backend.read_whole_table(self.table_name, batch_size)
+      self.assertEqual(len(newrec), len(records))
+      for k in dtype.names:
+        self.assertTrue(np.all(records[k] == newrec[k]))
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestHDF5TableBackend('test_create_delete'))
+  suite.addTest(TestHDF5TableBackend('test_handles'))
+  suite.addTest(TestHDF5TableBackend('test_table_rows'))
+  suite.addTest(TestHDF5TableBackend('test_selections'))
+  suite.addTest(TestHDF5TableBackend('test_update'))
+  suite.addTest(TestHDF5TableBackend('test_whole_table_ops'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
@@ -0,0 +1,59 @@
+# BEGIN_COPYRIGHT
+# END_COPYRIGHT
+
+import unittest, gc
+
+from bl.vl.kb.drivers.omero.object_cache import ObjectCache
+
+
+class Obj(object):
+  pass
+
+
+class TestObjectCache(unittest.TestCase):
+
+  def test_lru(self):
+    cache = ObjectCache(2)
+    objs = [Obj() for _ in xrange(3)]
+    for i, o in enumerate(objs):
+      cache.put(i, o)
+    self.assertEqual(len(cache), 2)
+    # evicted, but still alive
+    self.assertTrue(cache.get(0) is objs[0])
+    self.assertTrue(cache[2] is objs[2])
+    stats = cache.stats()
+    self.assertEqual(stats['size'], 2)
+    self.assertEqual(stats['hits'], 2)
+    self.assertEqual(stats['evictions'], 2)
+    del objs
+    gc.collect()
+    self.assertTrue(cache.get(1) is None)
+    self.assertRaises(KeyError, cache.__getitem__, 1)
+    self.assertEqual(cache.stats()['misses'], 2)
+
+  def test_invalidate(self):
+    cache = ObjectCache(4)
+    o = Obj()
+    cache.put('a', o)
+    self.assertTrue('a' in cache)
+    cache.invalidate('a')
+    cache.invalidate('b')
+    self.assertFalse('a' in cache)
+    self.assertTrue(cache.get('a') is None)
+    self.assertEqual(cache.stats()['invalidations'], 1)
+    cache.put('a', o)
+    cache.clear()
+    self.assertEqual(len(cache), 0)
+    self.assertFalse('a' in cache)
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTest(TestObjectCache('test_lru'))
+  suite.addTest(TestObjectCache('test_invalidate'))
+  return suite
+
+
+if __name__ == '__main__':
+  runner = unittest.TextTestRunner(verbosity=2)
+  runner.run((suite()))
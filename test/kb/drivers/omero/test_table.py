@@ -1,7 +1,7 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import os, unittest, uuid
+import os, unittest, uuid, threading
 import itertools as it
 import numpy as np
 
@@ -109,6 +109,31 @@ class TestProxyCore(unittest.TestCase):
     for i, row in enumerate(row_it):
       self.assertTrue(row == data[i])
 
+  def test_table_blocks_iterator(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      blocks = {}
+      for prefetch in 0, 1, 2:
+        blocks[prefetch] = list(pc.get_table_blocks_iterator(
+          table_name, batch_size=3, prefetch=prefetch
+          ))
+      sub_blocks = list(pc.get_table_blocks_iterator(
+        table_name, col_names=['r_id', 'r_vid']
+        ))
+    finally:
+      pc.delete_table(table_name)
+    for prefetch, bl in blocks.iteritems():
+      self.assertEqual(len(bl), (N_ROWS + 2) / 3)
+      self.assertTrue(all(len(b) <= 3 for b in bl))
+      self.assertTrue(np.all(data == np.concatenate(bl)))
+    sub = np.concatenate(sub_blocks)
+    self.assertEqual(set(sub.dtype.names), set(['r_id', 'r_vid']))
+    self.assertTrue(np.all(data['r_vid'] == sub['r_vid']))
+
   def test_update_row(self):
     fields = self.__make_fields()
     table_name = get_random_table_name()
@@ -130,6 +155,27 @@ class TestProxyCore(unittest.TestCase):
     self.assertEqual(len(r), 1)
     self.assertTrue(urow == r[0])
 
+  def test_update_rows_by_indices(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      idx = [N_ROWS - 1, 0, N_ROWS/2]
+      upd = np.zeros(len(idx), dtype=[('o_vid', data.dtype['o_vid']),
+                                      ('r_id', 'i8')])
+      upd['o_vid'] = ['foo%d' % i for i in idx]
+      upd['r_id'] = [-i for i in idx]
+      pc.update_table_rows_by_indices(table_name, idx, upd, batch_size=2)
+      r = pc.get_table_rows(table_name, None)
+    finally:
+      pc.delete_table(table_name)
+    for i, u in it.izip(idx, upd):
+      data[i]['o_vid'] = u['o_vid']
+      data[i]['r_id'] = u['r_id']
+    self.assertTrue(np.all(data == r))
+
   def test_selections(self):
     fields = self.__make_fields()
     table_name = get_random_table_name()
@@ -154,6 +200,22 @@ class TestProxyCore(unittest.TestCase):
     for i, r in it.izip(irange, rows_lite):
       self.assertTrue(data[i] == r)
 
+  def test_overlapping_selections(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      selectors = ['(r_id < %d)' % (N_ROWS/2), '(r_id > %d)' % (N_ROWS/4),
+                   '(r_vid == "%s")' % data[0]['r_vid']]
+      selectors.reverse()
+      rows = pc.get_table_rows(table_name, selector=selectors)
+    finally:
+      pc.delete_table(table_name)
+    self.assertEqual(len(rows), N_ROWS)
+    self.assertTrue(np.all(data == rows))
+
   def test_array_size(self):
     print
     exp = 5  # large values may trigger a mem overflow (see Ice.MessageSizeMax)
@@ -212,15 +274,175 @@ class TestProxyCore(unittest.TestCase):
     finally:
         pc.delete_table(table_name)
 
+  def test_byte_budget(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      row_size = np.dtype(pc.get_table_headers(table_name)).itemsize
+      # at most 3 rows per call
+      pc.table_byte_budget = 3 * row_size + 1
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      rows = pc.get_table_rows(table_name, None)
+      whole = pc.read_whole_table(table_name)
+      idx = range(0, N_ROWS, 2)
+      sliced = pc.get_table_rows_by_indices(table_name, idx)
+      it_rows = list(pc.get_table_rows_iterator(table_name))
+    finally:
+      pc.delete_table(table_name)
+    self.assertTrue(np.all(data == rows))
+    self.assertTrue(np.all(data == whole))
+    self.assertTrue(np.all(data[idx] == sliced))
+    for i, row in enumerate(it_rows):
+      self.assertTrue(row == data[i])
+
+
+  def test_add_table_rows(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      indices = pc.add_table_rows(table_name, data, batch_size=3)
+      rows = pc.get_table_rows(table_name, None)
+    finally:
+      pc.delete_table(table_name)
+    self.assertEqual(indices, range(N_ROWS, 2 * N_ROWS))
+    self.assertTrue(np.all(data == rows[:N_ROWS]))
+    self.assertTrue(np.all(data == rows[N_ROWS:]))
+
+  def test_parallel_read(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      whole = pc.read_whole_table(table_name, batch_size=3, n_readers=4)
+      rows = pc.get_table_rows(table_name, None, col_names=['r_id', 'r_vid'],
+                               batch_size=5, n_readers=2)
+    finally:
+      pc.delete_table(table_name)
+    self.assertTrue(np.all(data == whole))
+    self.assertEqual(len(rows), N_ROWS)
+    for k in 'r_id', 'r_vid':
+      self.assertTrue(np.all(data[k] == rows[k]))
+
+  def test_async_reads(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      f_whole = pc.read_whole_table_async(table_name, batch_size=3)
+      f_slice = pc.get_table_slice_async(table_name, [7, 2, 11],
+                                         col_names=['r_id'], batch_size=2)
+      whole, rows = f_whole.result(), f_slice.result()
+    finally:
+      pc.delete_table(table_name)
+    self.assertTrue(np.all(data == whole))
+    self.assertEqual(list(rows['r_id']), [7, 2, 11])
+
+  def test_unordered_slice(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    idx = [9, 3, 4, 5, 3, 0, 9]
+    try:
+      pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      sliced = pc.get_table_slice(table_name, idx, batch_size=3)
+      by_indices = pc.get_table_rows_by_indices(table_name, idx)
+      f_slice = pc.get_table_slice_async(table_name, idx, batch_size=3)
+      sliced_async = f_slice.result()
+    finally:
+      pc.delete_table(table_name)
+    self.assertTrue(np.all(data[idx] == sliced))
+    self.assertTrue(np.all(data[idx] == by_indices))
+    self.assertTrue(np.all(data[idx] == sliced_async))
+
+  def test_lazy_session(self):
+    pc = ProxyCore(OME_HOST, OME_USER, OME_PASS)
+    self.assertTrue(pc.current_session is None)
+    self.assertFalse(pc.table_exists(get_random_table_name()))
+    self.assertFalse(pc.current_session is None)
+    self.assertTrue(OME_HOST in ProxyCore._checked_hosts)
+
+  def test_table_pool(self):
+    fields = self.__make_fields()
+    table_names = [get_random_table_name() for _ in xrange(3)]
+    pc = ProxyCore(OME_HOST, OME_USER, OME_PASS, table_pool_size=2)
+    try:
+      for name in table_names:
+        pc.create_table(name, fields)
+      self.assertEqual(pc._tables.keys(), table_names[1:])
+      s = pc.connect()
+      t = pc._get_table(s, table_names[1])
+      self.assertTrue(t is pc._get_table(s, table_names[1]))
+      self.assertEqual(pc._tables.keys(), [table_names[2], table_names[1]])
+      self.__fill_table(pc, table_names[0], N_ROWS)
+      self.assertEqual(pc._tables.keys(), [table_names[1], table_names[0]])
+      self.assertEqual(pc.get_number_of_rows(table_names[0]), N_ROWS)
+    finally:
+      for name in table_names:
+        pc.delete_table(name)
+    self.assertEqual(len(pc._tables), 0)
+
+  def test_session_pool(self):
+    fields = self.__make_fields()
+    table_name = get_random_table_name()
+    pc = ProxyCore(OME_HOST, OME_USER, OME_PASS, session_pool_size=3)
+    try:
+      pc.create_table(table_name, fields)
+      data = self.__fill_table(pc, table_name, N_ROWS)
+      results, errors = [None] * 6, []
+      def read(i):
+        try:
+          results[i] = pc.get_table_rows(table_name, None)
+        except Exception, e:
+          errors.append(e)
+      threads = [threading.Thread(target=read, args=(i,))
+                 for i in xrange(len(results))]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+      whole = pc.read_whole_table(table_name, batch_size=3, n_readers=4)
+      blocks = list(pc.get_table_blocks_iterator(table_name, batch_size=5))
+      self.assertTrue(len(pc.session_pool.sessions()) <= 3)
+    finally:
+      pc.delete_table(table_name)
+      pc.close_session_pool()
+    self.assertEqual(errors, [])
+    for rows in results:
+      self.assertTrue(np.all(data == rows))
+    self.assertTrue(np.all(data == whole))
+    self.assertTrue(np.all(data == np.concatenate(blocks)))
+
+
 def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestProxyCore('test_create_delete'))
   suite.addTest(TestProxyCore('test_table_rows'))
   suite.addTest(TestProxyCore('test_table_rows_iterator'))
+  suite.addTest(TestProxyCore('test_table_blocks_iterator'))
   suite.addTest(TestProxyCore('test_update_row'))
+  suite.addTest(TestProxyCore('test_update_rows_by_indices'))
   suite.addTest(TestProxyCore('test_selections'))
+  suite.addTest(TestProxyCore('test_overlapping_selections'))
   suite.addTest(TestProxyCore('test_array_size'))
   suite.addTest(TestProxyCore('test_whole_table_ops'))
+  suite.addTest(TestProxyCore('test_byte_budget'))
+  suite.addTest(TestProxyCore('test_add_table_rows'))
+  suite.addTest(TestProxyCore('test_parallel_read'))
+  suite.addTest(TestProxyCore('test_async_reads'))
+  suite.addTest(TestProxyCore('test_unordered_slice'))
+  suite.addTest(TestProxyCore('test_lazy_session'))
+  suite.addTest(TestProxyCore('test_table_pool'))
+  suite.addTest(TestProxyCore('test_session_pool'))
   return suite
 
 
@@ -23,8 +23,7 @@ class TestKB(KBObjectCreator):
 
   def tearDown(self):
     self.kill_list.reverse()
-    for x in self.kill_list:
-      self.kb.delete(x)
+    self.kb.delete_array(self.kill_list)
     self.kill_list = []
 
   def create_archetype_record(self):
@@ -26,8 +26,7 @@ class TestKB(KBICObjectCreator):
 
   def tearDown(self):
     self.kill_list.reverse()
-    for x in self.kill_list:
-      self.kb.delete(x)
+    self.kb.delete_array(self.kill_list)
     self.kill_list = []
 
   def check_object(self, o, conf, otype):
@@ -1,10 +1,13 @@
 # BEGIN_COPYRIGHT
 # END_COPYRIGHT
 
-import os, unittest, logging
+import os, unittest, logging, tempfile
 logging.basicConfig(level=logging.ERROR)
 
+import omero.rtypes as ort
+
 from bl.vl.kb import KnowledgeBase as KB
+from bl.vl.kb.drivers.omero.proxy_core import SAVE_CHUNK_SIZE
 from kb_object_creator import KBObjectCreator
 
 
@@ -13,6 +16,12 @@ OME_USER = os.getenv("OME_USER", "root")
 OME_PASS = os.getenv("OME_PASS", "romeo")
 
 
+def unmap_enums(klass):
+  for o, label in zip(klass.__enums__, klass.__enum_labels__):
+    o.ome_obj = klass.get_ome_type()()
+    o.ome_obj.value = ort.wrap(label)
+
+
 class TestKB(KBObjectCreator):
 
   def __init__(self, name):
@@ -24,8 +33,7 @@ class TestKB(KBObjectCreator):
 
   def tearDown(self):
     self.kill_list.reverse()
-    for x in self.kill_list:
-      self.kb.delete(x)
+    self.kb.delete_array(self.kill_list)
     self.kill_list = []
 
   def check_object(self, o, conf, otype):
@@ -64,12 +72,205 @@ class TestKB(KBObjectCreator):
     self.kb.delete(e)
     self.assertEqual(self.kb.get_enrollment(study, conf['studyCode']), None)
 
+  def test_delete_array(self):
+    aconf, action = self.create_action()
+    self.kill_list.append(action.save())
+    people = []
+    for _ in xrange(5):
+      conf, i = self.create_individual(action=action)
+      people.append(i)
+    self.kb.save_array(people)
+    vids = [i.id for i in people]
+    self.kb.delete_array(people, chunk_size=2)
+    self.assertEqual(self.kb.get_by_vids(self.kb.Individual, vids), {})
+
+  def test_delete_array_with_actions(self):
+    aconf, action = self.create_action()
+    action.save()
+    people = []
+    for _ in xrange(5):
+      conf, i = self.create_individual(action=action)
+      people.append(i)
+    self.kb.save_array(people)
+    vids = [i.id for i in people]
+    # actions are only referenced, and no longer cached, when deleting
+    self.kb.clear_cache()
+    people = self.kb.get_by_vids(self.kb.Individual, vids).values()
+    self.kb.delete_array(people + [action], chunk_size=2)
+    self.assertEqual(self.kb.get_by_vids(self.kb.Individual, vids), {})
+    self.assertRaises(ValueError, self.kb.get_by_vid, self.kb.Action,
+                      action.id)
+
+  def test_save_array(self):
+    aconf, action = self.create_action()
+    self.kill_list.append(action.save())
+    people = []
+    for i in xrange(5):
+      father = people[-1] if people else None
+      conf, ind = self.create_individual(action=action, father=father)
+      people.append(ind)
+    self.kb.save_array(people, chunk_size=2)
+    self.kill_list.extend(people)
+    for ind in people:
+      self.assertTrue(ind.is_mapped())
+    for father, child in zip(people, people[1:]):
+      self.assertEqual(child.father.id, father.id)
+    res = self.kb.get_by_vids(self.kb.Individual, [i.id for i in people])
+    self.assertEqual(len(res), len(people))
+
+  def test_save_array_shared_unsaved(self):
+    aconf, action = self.create_action()
+    people = [self.create_individual(action=action)[1]
+              for _ in xrange(SAVE_CHUNK_SIZE + 1)]
+    self.kb.save_array(people, chunk_size=SAVE_CHUNK_SIZE)
+    self.kill_list.append(self.kb.factory.wrap(people[0].ome_obj.action))
+    self.kill_list.extend(people)
+    action_ids = set(ind.ome_obj.action.id.val for ind in people)
+    self.assertEqual(len(action_ids), 1)
+
+  def test_reload_many(self):
+    conf, e = self.create_enrollment()
+    self.kill_list.append(e.save())
+    self.kb.clear_cache()
+    xe = self.kb.get_enrollment(e.study, conf['studyCode'])
+    objs = [xe, self.kb.factory.wrap(xe.ome_obj.individual),
+            self.kb.factory.wrap(xe.ome_obj.study)]
+    self.kb.reload_many(objs)
+    for o in objs:
+      self.assertTrue(o.is_loaded())
+    self.assertEqual(objs[1].id, e.individual.id)
+    self.assertEqual(objs[2].label, e.study.label)
+
+  def test_async(self):
+    conf, e = self.create_enrollment()
+    self.kill_list.append(e.save())
+    f_enroll = self.kb.get_by_vid_async(self.kb.Enrollment, e.id)
+    f_study = self.kb.get_by_vid_async(self.kb.Study, e.study.id)
+    f_none = self.kb.get_by_vid_async(self.kb.Study, 'V0-no-such-vid')
+    self.assertEqual(f_enroll.result().id, e.id)
+    self.assertEqual(f_study.result().id, e.study.id)
+    self.assertRaises(ValueError, f_none.result)
+    aconf, action = self.create_action()
+    self.kill_list.append(action.save())
+    people = [self.create_individual(action=action)[1] for _ in xrange(3)]
+    f_save = self.kb.save_array_async(people)
+    self.kill_list.extend(f_save.result())
+    for i in people:
+      self.assertTrue(i.is_mapped())
+
+  def test_enum_cache(self):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    kb = self.kb
+    try:
+      self.kb = KB(driver='omero')(OME_HOST, OME_USER, OME_PASS,
+                                   enum_cache=path)
+      unmap_enums(self.kb.Gender)
+      self.kb.map_enums(self.kb.Gender)
+      ids = self.kb.enum_cache.get('Gender')
+      self.assertEqual(sorted(ids), ['FEMALE', 'MALE'])
+      # MALE is mapped from valid ids, FEMALE from stale ones
+      stale = dict((l, max(ids.values()) + 1000 + i)
+                   for i, l in enumerate(ids))
+      for label, cached_ids in ('MALE', ids), ('FEMALE', stale):
+        self.kb.enum_cache.update({'Gender': cached_ids})
+        unmap_enums(self.kb.Gender)
+        self.kb.map_enums(self.kb.Gender)
+        gender = getattr(self.kb.Gender, label)
+        self.assertFalse(gender.is_loaded())
+        self.assertEqual(gender.enum_label(), label)
+        conf, ind = self.create_individual(gender=gender)
+        self.kill_list.append(ind.save())
+        self.kb.clear_cache()
+        ind = self.kb.get_by_vid(self.kb.Individual, ind.id)
+        self.assertEqual(ind.gender, getattr(self.kb.Gender, label))
+      self.assertEqual(self.kb.enum_cache.get('Gender'), ids)
+    finally:
+      unmap_enums(kb.Gender)
+      kb.map_enums(kb.Gender)
+      self.kb = kb
+      os.remove(path)
+
+  def test_prefetch(self):
+    conf, e = self.create_enrollment()
+    self.kill_list.append(e.save())
+    self.kb.clear_cache()
+    enrolls = self.kb.get_enrolled(e.study)
+    self.assertEqual(len(enrolls), 1)
+    self.kb.prefetch(enrolls, ['individual.action', 'study'])
+    xe = enrolls[0]
+    self.assertTrue(xe.ome_obj.individual.loaded)
+    self.assertTrue(xe.ome_obj.individual.action.loaded)
+    self.assertTrue(xe.ome_obj.study.loaded)
+    self.assertEqual(xe.individual.id, e.individual.id)
+    self.assertEqual(xe.study.id, e.study.id)
+
+  def test_get_by_field(self):
+    conf, e = self.create_enrollment()
+    self.kill_list.append(e.save())
+    key = (e.id, conf['studyCode'])
+    res = self.kb.get_by_field(self.kb.Enrollment, ('vid', 'studyCode'),
+                               [key, (e.id, 'foo\'bar')])
+    self.assertEqual(res.keys(), [key])
+    self.assertEqual(res[key].id, e.id)
+    res = self.kb.get_by_vids(self.kb.Enrollment, [e.id, 'V0\'"'],
+                              batch_size=1, n_workers=2)
+    self.assertEqual(res.keys(), [e.id])
+
+  def test_objects_iterator(self):
+    aconf, action = self.create_action()
+    self.kill_list.append(action.save())
+    vids = set()
+    for _ in xrange(5):
+      conf, i = self.create_individual(action=action)
+      self.kill_list.append(i.save())
+      vids.add(i.id)
+    seen = [i.id for i in
+            self.kb.get_objects_iterator(self.kb.Individual, page_size=2)]
+    self.assertEqual(len(seen), len(set(seen)))
+    self.assertTrue(vids <= set(seen))
+    query = ('select i from Individual i where i.id > :last_id '
+             'and i.action.id = :aid order by i.id')
+    seen = [i.id for i in self.kb.find_all_by_query_iterator(
+      query, {'aid': action.omero_id}, page_size=2
+      )]
+    self.assertEqual(sorted(seen), sorted(vids))
+
+  def test_projection(self):
+    conf, e = self.create_enrollment()
+    self.kill_list.append(e.save())
+    query = """select e.studyCode, i.vid, i.id
+    from Enrollment e join e.individual i
+    where e.vid = :vid
+    """
+    res = self.kb.projection(query, {'vid': e.id},
+                             [('code', '|S100'), ('vid', '|S100'),
+                              ('id', 'i8')])
+    self.assertEqual(len(res), 1)
+    self.assertEqual(res['code'][0], conf['studyCode'])
+    self.assertEqual(res['vid'][0], e.individual.id)
+    self.assertEqual(res['id'][0], e.individual.omero_id)
+    res = self.kb.projection(query, {'vid': e.id}, ['code', 'vid', 'id'])
+    self.assertEqual(res.dtype.names, ('code', 'vid', 'id'))
+    self.assertEqual(res['vid'][0], e.individual.id)
+
 
 def suite():
   suite = unittest.TestSuite()
   suite.addTest(TestKB('test_individual'))
   suite.addTest(TestKB('test_enrollment'))
   suite.addTest(TestKB('test_enrollment_ops'))
+  suite.addTest(TestKB('test_delete_array'))
+  suite.addTest(TestKB('test_delete_array_with_actions'))
+  suite.addTest(TestKB('test_save_array'))
+  suite.addTest(TestKB('test_save_array_shared_unsaved'))
+  suite.addTest(TestKB('test_reload_many'))
+  suite.addTest(TestKB('test_async'))
+  suite.addTest(TestKB('test_enum_cache'))
+  suite.addTest(TestKB('test_prefetch'))
+  suite.addTest(TestKB('test_get_by_field'))
+  suite.addTest(TestKB('test_objects_iterator'))
+  suite.addTest(TestKB('test_projection'))
   return suite
 
 